@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Register many simulated Nodes at once with AsyncAggregator, sharing keep-alive connections, and report how long
+it takes for all of them and their resources to be registered. Without a Registration API href, a minimal one is
+run in the same process.
+
+Usage: python benchmarks/async_registration.py [number of nodes] [resources per node] [registration api href]"""
+
+from __future__ import print_function
+
+import asyncio
+import logging
+import sys
+import time
+import uuid
+
+from nmoscommon.asyncaggregator import AsyncAggregator
+
+
+async def handle(reader, writer):
+    while True:
+        request_line = await reader.readline()
+        if not request_line:
+            break
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line == b"\r\n":
+                break
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+        await reader.readexactly(length)
+        status = b"204 No Content" if request_line.startswith(b"DELETE") else b"200 OK"
+        writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Length: 0\r\n\r\n")
+    writer.close()
+
+
+async def main(nodes, resources, href):
+    server = None
+    if href is None:
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        href = "http://127.0.0.1:{}".format(server.sockets[0].getsockname()[1])
+
+    clients = {}
+    aggregators = [AsyncAggregator(api_href=href, clients=clients) for _ in range(nodes)]
+    logging.getLogger("async_aggregator").setLevel(logging.WARNING)
+    start = time.time()
+    for aggregator in aggregators:
+        await aggregator.start()
+        node_id = str(uuid.uuid4())
+        aggregator.register("node", node_id, id=node_id, label="Simulated Node")
+        for _ in range(resources):
+            device_id = str(uuid.uuid4())
+            aggregator.register("device", device_id, id=device_id, node_id=node_id)
+    while not all(aggregator.status()["registered"] and aggregator.queue_stats()["pending"] == 0
+                  for aggregator in aggregators):
+        await asyncio.sleep(0.01)
+    duration = time.time() - start
+    requests = nodes * (3 + resources)
+    print("{} nodes with {} resources each registered in {:.2f}s ({:.0f} requests/s over {} connections)".format(
+        nodes, resources, duration, requests / duration,
+        sum(len(client._connections) for client in clients.values())))
+
+    await asyncio.gather(*[aggregator.stop() for aggregator in aggregators])
+    for client in clients.values():
+        await client.close()
+    if server is not None:
+        server.close()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+                                                     int(sys.argv[2]) if len(sys.argv) > 2 else 10,
+                                                     sys.argv[3] if len(sys.argv) > 3 else None))
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+#
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the per-request cost of MostAcceptableType. The "reparse" figures use the previous algorithm, which
+built new MediaType objects from the Accept string for every candidate type (with its cmp based sort converted
+via cmp_to_key so that it runs on Python 3).
+
+Usage: python benchmarks/content_negotiation.py"""
+
+from __future__ import print_function
+
+import timeit
+from functools import cmp_to_key
+
+from nmoscommon import webapi
+from nmoscommon.webapi import MediaType, MostAcceptableType
+
+CANDIDATES = ["application/json", "text/html", "application/sdp"]
+ACCEPT_STRINGS = {
+    "browser": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
+    "curl": "*/*",
+    "controller": "application/json",
+}
+
+
+def reparse_most_acceptable_type(type_strings, accept_string):
+    def acceptable_type(mt):
+        for idx, t in enumerate([MediaType(x.strip()) for x in accept_string.split(',')]):
+            if t.matches(mt):
+                t.accept_index = idx
+                return t
+        return None
+
+    def cmp(a, b):
+        if a is None and b is None:
+            return 0
+        elif a is None:
+            return 1
+        elif b is None:
+            return -1
+        elif a.priority == b.priority:
+            return (a.accept_index > b.accept_index) - (a.accept_index < b.accept_index)
+        else:
+            return -((a.priority > b.priority) - (a.priority < b.priority))
+
+    return sorted([(mt, acceptable_type(MediaType(mt))) for mt in type_strings],
+                  key=cmp_to_key(lambda a, b: cmp(a[1], b[1])))[0][0]
+
+
+def cold_most_acceptable_type(type_strings, accept_string):
+    webapi._accept_string_cache.clear()
+    webapi._most_acceptable_cache.clear()
+    return MostAcceptableType(type_strings, accept_string)
+
+
+def main():
+    number = 20000
+    print("{:<12} {:>14} {:>14} {:>14}".format("client", "reparse (us)", "cold (us)", "cached (us)"))
+    for client, accept in ACCEPT_STRINGS.items():
+        assert reparse_most_acceptable_type(CANDIDATES, accept) == MostAcceptableType(CANDIDATES, accept)
+        timings = [timeit.timeit(lambda: fn(CANDIDATES, accept), number=number) * 1e6 / number
+                   for fn in (reparse_most_acceptable_type, cold_most_acceptable_type, MostAcceptableType)]
+        print("{:<12} {:>14.2f} {:>14.2f} {:>14.2f}".format(client, *timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+#
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the time and memory allocated to attach CORS headers to responses, for IppResponse construction on its
+own and for dispatching GET and OPTIONS requests to a crossdomain route with a number of other routes registered. Memory is the
+peak traced by tracemalloc during a single operation, so includes short lived copies.
+
+Usage: python3 benchmarks/cors_headers.py [number of routes]"""
+
+from __future__ import print_function
+
+import sys
+import timeit
+import tracemalloc
+
+from flask import Flask
+from nmoscommon.flask_cors import crossdomain
+from nmoscommon.webapi import IppResponse
+
+
+def make_app(count):
+    app = Flask(__name__)
+    app.response_class = IppResponse
+    for i in range(count):
+        def view():
+            return IppResponse('{}', headers={'Content-Type': 'application/json'})
+        view.__name__ = "view_{}".format(i)
+        app.route('/route_{}/'.format(i), methods=["GET", "HEAD", "OPTIONS"])(
+            crossdomain(origin='*', methods=["GET", "HEAD"], headers=['Content-Type', 'Authorization'])(view))
+    return app
+
+
+def peak_bytes(fn):
+    fn()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - base
+
+
+def bench(label, fn, number):
+    duration = timeit.timeit(fn, number=number)
+    print("{:<24} {:>10.1f} us {:>10} bytes".format(label, duration * 1e6 / number, peak_bytes(fn)))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    app = make_app(count)
+    path = '/route_{}/'.format(count - 1)
+
+    bench("IppResponse()", lambda: IppResponse('{}'), 20000)
+    bench("IppResponse(headers)", lambda: IppResponse('{}', headers={'Content-Type': 'application/json'}), 20000)
+    for method in ("GET", "OPTIONS"):
+        # The request context is set up once, so that only dispatch and response construction are measured
+        with app.test_request_context(path, method=method):
+            bench(method, app.full_dispatch_request, 5000)
+
+
+if __name__ == "__main__":
+    main()
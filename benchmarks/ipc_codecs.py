@@ -0,0 +1,140 @@
+#!/usr/bin/python
+#
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the round-trip latency and throughput of Facade-style IPC calls for each codec available to
+MultiplexedProxy, against a MultiplexedHost in a child process, with a Host and Proxy for comparison. The calls
+register a full flow, or send a block of bytes to show the cost of copying large payloads.
+
+Usage: python benchmarks/ipc_codecs.py [number of calls] [concurrent calls] [payload size in bytes]"""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import gevent
+
+from nmoscommon.ipc import Host, Proxy, MultiplexedHost, MultiplexedProxy, CODECS
+
+
+def make_flow():
+    return {
+        "id": str(uuid.uuid4()),
+        "version": "1441812152:154331951",
+        "label": "Test Card",
+        "description": "Test Card",
+        "format": "urn:x-nmos:format:video",
+        "tags": {"urn:x-nmos:tag:grouphint/v1.0": ["Video 1:Video"]},
+        "source_id": str(uuid.uuid4()),
+        "device_id": str(uuid.uuid4()),
+        "parents": [],
+        "grain_rate": {"numerator": 25, "denominator": 1},
+        "frame_width": 1920,
+        "frame_height": 1080,
+        "interlace_mode": "interlaced_tff",
+        "colorspace": "BT709",
+        "media_type": "video/raw",
+        "components": [
+            {"name": "Y", "width": 1920, "height": 1080, "bit_depth": 10},
+            {"name": "Cb", "width": 960, "height": 1080, "bit_depth": 10},
+            {"name": "Cr", "width": 960, "height": 1080, "bit_depth": 10},
+        ]
+    }
+
+
+def serve(host_class, address):
+    host = host_class(address)
+
+    @host.ipcmethod()
+    def res_register(srv_type, pid, type, key, value):
+        return 0
+
+    @host.ipcmethod()
+    def put_data(srv_type, pid, data):
+        return len(data)
+
+    host.start()
+    host.greenlet.join()
+
+
+def start_host(host_class, address):
+    process = multiprocessing.Process(target=serve, args=(host_class, address))
+    process.start()
+    while not os.path.exists(address[6:]):
+        time.sleep(0.01)
+    return process
+
+
+def stop_host(process):
+    process.terminate()
+    process.join()
+
+
+def bench(label, proxy, method, args, number, concurrency):
+    getattr(proxy, method)(*args)
+
+    start = time.time()
+    for _ in range(number):
+        getattr(proxy, method)(*args)
+    latency = (time.time() - start) / number
+
+    def calls(count):
+        for _ in range(count):
+            getattr(proxy, method)(*args)
+
+    start = time.time()
+    gevent.joinall([gevent.spawn(calls, number // concurrency) for _ in range(concurrency)], raise_error=True)
+    throughput = (number // concurrency) * concurrency / (time.time() - start)
+
+    print("{:<16} {:<12} {:>10.1f} us/call {:>12.0f} calls/s".format(label, method, latency * 1e6, throughput))
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 1024 * 1024
+    tmpdir = tempfile.mkdtemp()
+    address = "ipc://" + os.path.join(tmpdir, "ipc_codecs")
+    flow = make_flow()
+    data = bytearray(os.urandom(size))
+    try:
+        host = start_host(Host, address)
+        proxy = Proxy(address, timeout=5000)
+        bench("Host/Proxy", proxy, "res_register", ("node", os.getpid(), "flow", flow["id"], flow), number, 1)
+        proxy.close()
+        stop_host(host)
+        os.remove(address[6:])
+
+        host = start_host(MultiplexedHost, address)
+        for name in CODECS:
+            proxy = MultiplexedProxy(address, timeout=5000, codecs=[name])
+            bench(name, proxy, "res_register", ("node", os.getpid(), "flow", flow["id"], flow), number,
+                  concurrency)
+            if name != "json":
+                bench(name, proxy, "put_data", ("node", os.getpid(), data), max(1, number // 20), concurrency)
+            proxy.close()
+        stop_host(host)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
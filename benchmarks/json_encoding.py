@@ -0,0 +1,95 @@
+#!/usr/bin/python
+#
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the throughput and payload size of indented and compact JSON encoding for lists of NMOS resources,
+as returned by the Node API /flows/ and /senders/ endpoints.
+
+Usage: python benchmarks/json_encoding.py [number of resources]"""
+
+from __future__ import print_function
+
+import json
+import sys
+import timeit
+import uuid
+
+from mediajson import NMOSJSONEncoder
+from nmoscommon.webapi import dumps_json, _fast_json_dumps
+
+
+def make_flow():
+    return {
+        "id": str(uuid.uuid4()),
+        "version": "1441812152:154331951",
+        "label": "Test Card",
+        "description": "Test Card",
+        "format": "urn:x-nmos:format:video",
+        "tags": {"urn:x-nmos:tag:grouphint/v1.0": ["Video 1:Video"]},
+        "source_id": str(uuid.uuid4()),
+        "device_id": str(uuid.uuid4()),
+        "parents": [],
+        "grain_rate": {"numerator": 25, "denominator": 1},
+        "frame_width": 1920,
+        "frame_height": 1080,
+        "interlace_mode": "interlaced_tff",
+        "colorspace": "BT709",
+        "media_type": "video/raw",
+        "components": [
+            {"name": "Y", "width": 1920, "height": 1080, "bit_depth": 10},
+            {"name": "Cb", "width": 960, "height": 1080, "bit_depth": 10},
+            {"name": "Cr", "width": 960, "height": 1080, "bit_depth": 10},
+        ]
+    }
+
+
+def make_sender():
+    return {
+        "id": str(uuid.uuid4()),
+        "version": "1441812152:154331951",
+        "label": "Camera 1 Video",
+        "description": "Camera 1 Video",
+        "tags": {},
+        "flow_id": str(uuid.uuid4()),
+        "transport": "urn:x-nmos:transport:rtp.mcast",
+        "device_id": str(uuid.uuid4()),
+        "manifest_href": "http://172.29.80.65/x-manufacturer/senders/{}/stream.sdp".format(uuid.uuid4()),
+        "interface_bindings": ["eth0", "eth1"],
+        "subscription": {"receiver_id": None, "active": False},
+    }
+
+
+def bench(label, fn, resources, number):
+    duration = timeit.timeit(lambda: fn(resources), number=number)
+    size = len(fn(resources))
+    print("{:<24} {:>10.1f} lists/s {:>12.0f} resources/s {:>10} bytes".format(
+        label, number / duration, number * len(resources) / duration, size))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    number = max(1, 20000 // count)
+    print("Fast compact encoder: {}".format("available" if _fast_json_dumps is not None else "unavailable"))
+    for name, factory in (("flows", make_flow), ("senders", make_sender)):
+        resources = [factory() for _ in range(count)]
+        print("\n{} x {}".format(count, name))
+        bench("indented", lambda r: dumps_json(r), resources, number)
+        bench("compact (json module)", lambda r: json.dumps(r, separators=(',', ':'), cls=NMOSJSONEncoder),
+              resources, number)
+        bench("compact", lambda r: dumps_json(r, compact=True), resources, number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the rate at which MDNSRegistration can publish changes to its TXT record, updating in place compared to
+the previous approach of unregistering, sleeping and registering again.
+
+Usage: python benchmarks/mdns_update.py [interface IP] [number of updates]"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from nmoscommon.mdns.mdnsInterface import MDNSInterface
+from nmoscommon.mdns.mdnsRegistration import MDNSRegistration
+
+
+def reregister_update(registration, txt_record):
+    registration.txtRecord = registration._conformTxtRecord(txt_record)
+    registration.unRegister()
+    time.sleep(1)
+    registration.register()
+
+
+def bench(label, update, registration, count):
+    start = time.time()
+    for n in range(count):
+        update(registration, {"api_ver": "v1.3", "ver_dvc": n})
+    duration = time.time() - start
+    print("{:<16} {:>8.2f} updates/s {:>10.3f} s/update".format(label, count / duration, duration / count))
+
+
+def main():
+    ip = sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    interface = MDNSInterface(ip)
+    registration = MDNSRegistration([interface], "benchmark", "_nmos-node._tcp", 12345, {"api_ver": "v1.3"})
+    registration.register()
+    try:
+        bench("in place", lambda r, txt: r.update(txtRecord=txt), registration, count)
+        bench("re-register", reregister_update, registration, max(1, count // 5))
+    finally:
+        registration.unRegister()
+        interface.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+#
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the time taken to construct a WebAPI subclass with a given number of routes, and to add the same
+routes again under further basepaths, as done by APIs which serve several versions.
+
+Usage: python benchmarks/webapi_startup.py [number of routes]"""
+
+from __future__ import print_function
+
+import sys
+import timeit
+
+from nmoscommon.webapi import WebAPI, route, resource_route
+
+
+def make_api_class(count):
+    attrs = {}
+    for i in range(count):
+        def handler(self):
+            return {}
+        handler.__name__ = "route_{}".format(i)
+        attrs[handler.__name__] = route('/route_{}/'.format(i))(handler)
+
+        def resource(self):
+            return {}
+        resource.__name__ = "resource_{}".format(i)
+        attrs[resource.__name__] = resource_route('/resource_{}/'.format(i))(resource)
+    return type("BenchmarkAPI", (WebAPI, ), attrs)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    number = 20
+    cls = make_api_class(count)
+
+    duration = timeit.timeit(cls, number=number)
+    print("{:<24} {:>10.2f} ms".format("construct", duration * 1000 / number))
+
+    api = cls()
+    basepaths = ["/x-nmos/v1.{}".format(i) for i in range(number)]
+    duration = timeit.timeit(lambda: api.add_routes(api, basepath=basepaths.pop()), number=number)
+    print("{:<24} {:>10.2f} ms".format("add_routes (basepath)", duration * 1000 / number))
+
+
+if __name__ == "__main__":
+    main()
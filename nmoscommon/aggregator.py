@@ -17,14 +17,21 @@ from six.moves.urllib.parse import urljoin
 
 import requests
 import json
+import os
 import time
+import heapq
+import itertools
+import random
+from collections import OrderedDict
 
 import gevent
-import gevent.queue
+import gevent.event
+import gevent.pool
+from requests.adapters import HTTPAdapter
 
 from .logger import Logger
 from .mdnsbridge import IppmDNSBridge
-from .mdnsExceptions import ServiceNotFoundException
+from .mdns.mdnsExceptions import ServiceNotFoundException
 
 from .nmoscommonconfig import config as _config
 import traceback
@@ -36,6 +43,42 @@ AGGREGATOR_APINAME = "registration"
 LEGACY_REG_MDNSTYPE = "nmos-registration"
 REGISTRATION_MDNSTYPE = "nmos-register"
 
+# The maximum number of queued requests taken from the queue together, and the number of those sent at once
+REGISTRATION_BATCH_SIZE = 64
+REGISTRATION_CONCURRENCY = 8
+
+# Seconds between heartbeats, the fraction by which each interval is randomly varied, and the longest interval
+# after repeated failures
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_JITTER = 0.1
+HEARTBEAT_MAX_BACKOFF = 40
+
+# Seconds to wait for a response from a Registration API
+REGISTRATION_TIMEOUT = 1.0
+
+# Weight of each new sample in the moving averages of a Registration API's response time and error rate, the
+# number of consecutive failures after which no requests are sent to it for a number of seconds, and the seconds
+# between refreshing the Registration APIs found by mDNS
+REGISTRY_EWMA_WEIGHT = 0.3
+REGISTRY_FAILURE_THRESHOLD = 3
+REGISTRY_CIRCUIT_TIMEOUT = 30
+REGISTRY_REFRESH_INTERVAL = 30
+
+# Methods of requests which may be hedged. Hedging a registration or heartbeat could leave it with two Registration
+# APIs, so only reads are hedged.
+HEDGED_METHODS = ("GET", "HEAD")
+
+# Seconds over which journal records are batched before being written, when the journal is synced to disk ("always"
+# after each record, after each "batch", or "never"), and how large the journal may grow, relative to the number of
+# live records plus a minimum, before it is compacted
+JOURNAL_FLUSH_INTERVAL = 0.1
+JOURNAL_FSYNC = "batch"
+JOURNAL_COMPACT_RATIO = 2
+JOURNAL_COMPACT_MIN = 1000
+
+# Seconds over which changes to the mDNS TXT records are collected, so that only the latest are published
+MDNS_UPDATE_DEBOUNCE = 0.5
+
 
 class NoAggregator(Exception):
     def __init__(self, mdns_updater=None):
@@ -59,11 +102,425 @@ class TooManyRetries(Exception):
         super(TooManyRetries, self).__init__("Too many retries.")
 
 
+# Position of a resource type in the registration order, with unordered types after all of the ordered ones
+def registration_tier(res_type, registration_order):
+    try:
+        return registration_order.index(res_type)
+    except ValueError:
+        return len(registration_order)
+
+
+# Split a batch of queued requests into stages, each of which may be sent concurrently. A request starts a new stage
+# if it is for the Node, uses a different method, is for a resource already in the stage, or may depend on a request
+# in the stage: a POST on one for a type earlier in registration_order, or a DELETE on one for a later type (as
+# children are unregistered before their parents).
+def batch_stages(batch, registration_order):
+    stages = []
+    stage = []
+    stage_keys = set()
+    stage_tiers = []
+    for queue_item in batch:
+        tier = registration_tier(queue_item["res_type"], registration_order)
+        key = (queue_item["namespace"], queue_item["res_type"], queue_item["key"])
+        if stage:
+            first = stage[0]
+            if (queue_item["res_type"] == "node" or first["res_type"] == "node" or
+                    queue_item["method"] != first["method"] or key in stage_keys or
+                    (queue_item["method"] == "POST" and tier > min(stage_tiers)) or
+                    (queue_item["method"] != "POST" and tier < max(stage_tiers))):
+                stages.append(stage)
+                stage = []
+                stage_keys = set()
+                stage_tiers = []
+        stage.append(queue_item)
+        stage_keys.add(key)
+        stage_tiers.append(tier)
+    if stage:
+        stages.append(stage)
+    return stages
+
+
+# Group (namespace, res_type, key) resources into tiers which are registered in turn: one for each type in
+# registration_order, then one for each other type
+def registration_tiers(resources, registration_order):
+    res_types = list(registration_order)
+    tiers = {}
+    for res in resources:
+        if res[1] not in tiers:
+            tiers[res[1]] = []
+            if res[1] not in res_types:
+                res_types.append(res[1])
+        tiers[res[1]].append(res)
+    return [tiers[res_type] for res_type in res_types if res_type in tiers]
+
+
+class HeartbeatScheduler(object):
+    """Calls the heartbeat functions of any number of Aggregators, each in its own greenlet when it is due, from a
+    single greenlet which sleeps until the next is due. A heartbeat function returns the number of seconds until it
+    should next be called, or None to stop. A heartbeat function is never called again whilst a call to it is still
+    in progress; if it becomes due meanwhile, it is called again as soon as that call completes."""
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._entries = {}
+        self._in_progress = {}
+        self._due = set()
+        self._wakeup = gevent.event.Event()
+        self._greenlet = None
+
+    def __len__(self):
+        return len(set(self._entries) | set(self._in_progress) | self._due)
+
+    def add(self, heartbeat, delay=0):
+        """Schedule a heartbeat function, replacing any existing schedule for it"""
+        old_entry = self._entries.get(heartbeat)
+        if old_entry is not None:
+            old_entry[2] = None
+        entry = [time.time() + delay, next(self._order), heartbeat]
+        self._entries[heartbeat] = entry
+        heapq.heappush(self._heap, entry)
+        self._wakeup.set()
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+    def remove(self, heartbeat, wait=True):
+        """Stop calling a heartbeat function, waiting for any call in progress to complete"""
+        entry = self._entries.pop(heartbeat, None)
+        if entry is not None:
+            entry[2] = None
+        self._due.discard(heartbeat)
+        self._wakeup.set()
+        greenlet = self._in_progress.pop(heartbeat, None)
+        if wait and greenlet is not None and greenlet is not gevent.getcurrent():
+            greenlet.join()
+
+    def _run(self):
+        while self._entries:
+            self._wakeup.clear()
+            while self._heap[0][2] is None:
+                heapq.heappop(self._heap)
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                self._wakeup.wait(delay)
+                continue
+            heartbeat = heapq.heappop(self._heap)[2]
+            del self._entries[heartbeat]
+            if heartbeat in self._in_progress:
+                self._due.add(heartbeat)
+            else:
+                self._in_progress[heartbeat] = gevent.spawn(self._call, heartbeat)
+        self._greenlet = None
+
+    def _call(self, heartbeat):
+        delay = heartbeat()
+        if self._in_progress.get(heartbeat) is not gevent.getcurrent():
+            # Removed whilst in progress
+            return
+        del self._in_progress[heartbeat]
+        if heartbeat in self._due:
+            self._due.discard(heartbeat)
+            self.add(heartbeat)
+        elif delay is not None and heartbeat not in self._entries:
+            self.add(heartbeat, delay)
+
+
+class RegistrationQueue(object):
+    """An ordered set of pending Registration API requests, holding at most one request per resource. Queueing a
+    request for a resource which already has one pending collapses them to the latest intent: a repeated request
+    keeps its place, a changed request moves to the back (so that DELETEs stay behind those of child resources), and
+    a DELETE cancels a pending POST for a resource which is new to the Registration API."""
+    def __init__(self):
+        self._pending = OrderedDict()
+        self.coalesced = 0
+        self.replaced = 0
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def empty(self):
+        return not self._pending
+
+    def put(self, method, namespace, res_type, key, new=False):
+        """Queue a request. 'new' indicates that the Registration API can't already have the resource, so that a
+        later DELETE may cancel this POST"""
+        res_id = (namespace, res_type, key)
+        pending = self._pending.get(res_id)
+        if pending is None:
+            self._pending[res_id] = {"method": method, "namespace": namespace, "res_type": res_type, "key": key,
+                                     "new": new and method == "POST"}
+        elif pending["method"] == method:
+            self.coalesced += 1
+        elif method == "DELETE" and pending["new"]:
+            del self._pending[res_id]
+            self.cancelled += 1
+        else:
+            del self._pending[res_id]
+            self._pending[res_id] = {"method": method, "namespace": namespace, "res_type": res_type, "key": key,
+                                     "new": False}
+            self.replaced += 1
+
+    def get(self):
+        """Remove and return the oldest pending request. Raises KeyError if there are none."""
+        return self._pending.popitem(last=False)[1]
+
+    def clear(self):
+        self._pending.clear()
+
+    def stats(self):
+        return {"pending": len(self._pending),
+                "coalesced": self.coalesced,
+                "replaced": self.replaced,
+                "cancelled": self.cancelled}
+
+
+class RegistryEndpoint(object):
+    """The health of one Registration API: moving averages of its response time and error rate, and the number of
+    consecutive failures, after too many of which its circuit is opened until a given time."""
+    def __init__(self, href, priority):
+        self.href = href
+        self.priority = priority
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0
+
+    def stats(self):
+        return {"priority": self.priority,
+                "latency": self.latency,
+                "error_rate": self.error_rate,
+                "failures": self.failures,
+                "circuit_open": self.open_until > time.time()}
+
+
+class RegistryPool(object):
+    """The Registration APIs found by mDNS, scored on their health. The highest priority API whose circuit isn't open
+    is preferred, and amongst APIs of the same priority the one with the lowest expected response time, counting an
+    error as a timeout. APIs which haven't been used yet are tried first, so that each is scored. The discover
+    function returns a list of (href, priority) pairs."""
+    def __init__(self, discover, weight=REGISTRY_EWMA_WEIGHT, failure_threshold=REGISTRY_FAILURE_THRESHOLD,
+                 circuit_timeout=REGISTRY_CIRCUIT_TIMEOUT, refresh_interval=REGISTRY_REFRESH_INTERVAL,
+                 failure_cost=REGISTRATION_TIMEOUT):
+        self._discover = discover
+        self.weight = weight
+        self.failure_threshold = failure_threshold
+        self.circuit_timeout = circuit_timeout
+        self.refresh_interval = refresh_interval
+        self.failure_cost = failure_cost
+        self._endpoints = {}
+        self._refreshed = None
+
+    def __len__(self):
+        return len(self._endpoints)
+
+    def refresh(self):
+        """Update the Registration APIs from mDNS, keeping the scores of those already known"""
+        endpoints = {}
+        for (href, priority) in self._discover():
+            endpoint = self._endpoints.get(href)
+            if endpoint is None:
+                endpoint = RegistryEndpoint(href, priority)
+            endpoint.priority = priority
+            endpoints[href] = endpoint
+        self._endpoints = endpoints
+        self._refreshed = time.time()
+
+    def _cost(self, endpoint):
+        latency = endpoint.latency if endpoint.latency is not None else 0
+        return (1 - endpoint.error_rate) * latency + endpoint.error_rate * self.failure_cost
+
+    def ranked(self, exclude=()):
+        """Registration APIs whose circuits are closed, best first, with ties broken at random"""
+        now = time.time()
+        available = [endpoint for endpoint in self._endpoints.values()
+                     if endpoint.open_until <= now and endpoint.href not in exclude]
+        return [endpoint.href for endpoint in
+                sorted(available, key=lambda e: (e.priority, self._cost(e), random.random()))]
+
+    def select(self, exclude=()):
+        """The href of the best Registration API not in exclude, or of the best overall if all are excluded, or an
+        empty string if none are available"""
+        if (self._refreshed is None or time.time() - self._refreshed >= self.refresh_interval or
+                not self.ranked(exclude)):
+            self.refresh()
+        ranked = self.ranked(exclude) or self.ranked()
+        return ranked[0] if ranked else ""
+
+    def _endpoint(self, href):
+        endpoint = self._endpoints.get(href)
+        if endpoint is None:
+            # Not found by mDNS, so as the lowest priority, until the next refresh
+            endpoint = self._endpoints[href] = RegistryEndpoint(href, 99)
+        return endpoint
+
+    def record_success(self, href, latency):
+        endpoint = self._endpoint(href)
+        if endpoint.latency is None:
+            endpoint.latency = latency
+        else:
+            endpoint.latency += self.weight * (latency - endpoint.latency)
+        endpoint.error_rate -= self.weight * endpoint.error_rate
+        endpoint.failures = 0
+        endpoint.open_until = 0
+
+    def record_failure(self, href):
+        endpoint = self._endpoint(href)
+        endpoint.error_rate += self.weight * (1 - endpoint.error_rate)
+        endpoint.failures += 1
+        if endpoint.failures >= self.failure_threshold:
+            # Opened again by a single failure once the timeout has passed
+            endpoint.open_until = time.time() + self.circuit_timeout
+
+    def stats(self):
+        return dict((href, endpoint.stats()) for (href, endpoint) in self._endpoints.items())
+
+
+class RegistrationJournal(object):
+    """An append-only file of the changes made to an Aggregator's local mirror, and of the versions acknowledged by
+    the Registration API, from which the mirror can be loaded when the Node restarts. Records are JSON objects, one per
+    line, written in batches. When the file has grown enough it is compacted by rewriting it with one record for each
+    resource and acknowledgement held."""
+    def __init__(self, path, fsync=JOURNAL_FSYNC, flush_interval=JOURNAL_FLUSH_INTERVAL,
+                 compact_ratio=JOURNAL_COMPACT_RATIO, compact_min=JOURNAL_COMPACT_MIN):
+        if fsync not in ("always", "batch", "never"):
+            raise ValueError("Unknown journal fsync policy: {}".format(fsync))
+        self.path = path
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self._node = None
+        self._entities = {}
+        self._acked = {}
+        self._records = 0
+        self._pending = []
+        self._flusher = None
+        self._file = None
+
+    def load(self):
+        """Read the journal, returning the node, entities and acknowledged versions it holds in the form of the
+        Aggregator's local mirror. An incomplete last record, left by a crash part way through a write, is ignored
+        and truncated away so that the records appended after it can be read back."""
+        if os.path.exists(self.path):
+            # The offset of the end of the last complete record
+            end = 0
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        break
+                    self._apply(record)
+                    self._records += 1
+                    end += len(line)
+            if end < os.path.getsize(self.path):
+                with open(self.path, "r+b") as f:
+                    f.truncate(end)
+                    self._sync(f)
+        self._file = open(self.path, "a")
+        entities = {"resource": {}}
+        for namespace, types in self._entities.items():
+            entities[namespace] = dict((res_type, dict(resources)) for (res_type, resources) in types.items())
+        return {"node": self._node, "entities": entities, "acked": dict(self._acked)}
+
+    def _apply(self, record):
+        res = (record["namespace"], record["res_type"], record["key"])
+        if record["op"] == "ack":
+            if record["version"] is None:
+                self._acked.pop(res, None)
+            else:
+                self._acked[res] = record["version"]
+        elif res[:2] == ("resource", "node"):
+            self._node = record["obj"] if record["op"] == "register" else None
+        elif record["op"] == "register":
+            self._entities.setdefault(res[0], {}).setdefault(res[1], {})[res[2]] = record["obj"]
+        else:
+            self._entities.get(res[0], {}).get(res[1], {}).pop(res[2], None)
+
+    def register(self, namespace, res_type, key, obj):
+        self._append({"op": "register", "namespace": namespace, "res_type": res_type, "key": key, "obj": obj})
+
+    def unregister(self, namespace, res_type, key):
+        self._append({"op": "unregister", "namespace": namespace, "res_type": res_type, "key": key})
+
+    def ack(self, namespace, res_type, key, version):
+        self._append({"op": "ack", "namespace": namespace, "res_type": res_type, "key": key, "version": version})
+
+    def _append(self, record):
+        self._apply(record)
+        self._records += 1
+        self._pending.append(json.dumps(record) + "\n")
+        if self.fsync == "always":
+            self.flush()
+        elif self._flusher is None:
+            self._flusher = gevent.spawn_later(self.flush_interval, self.flush)
+
+    def _live_records(self):
+        return (self._node is not None) + len(self._acked) + sum(
+            len(resources) for types in self._entities.values() for resources in types.values())
+
+    def flush(self):
+        """Write any pending records, compacting the journal instead if it has grown enough"""
+        self._flusher = None
+        if not self._pending or self._file is None:
+            return
+        if self._records > self.compact_ratio * self._live_records() + self.compact_min:
+            self.compact()
+            return
+        lines = self._pending
+        self._pending = []
+        self._file.write("".join(lines))
+        self._sync(self._file)
+
+    def compact(self):
+        """Replace the journal with the records needed to load its current state"""
+        records = []
+        if self._node is not None:
+            records.append({"op": "register", "namespace": "resource", "res_type": "node",
+                            "key": self._node["data"]["id"], "obj": self._node})
+        for namespace, types in self._entities.items():
+            for res_type, resources in types.items():
+                for key, obj in resources.items():
+                    records.append({"op": "register", "namespace": namespace, "res_type": res_type, "key": key,
+                                    "obj": obj})
+        for (namespace, res_type, key), version in self._acked.items():
+            records.append({"op": "ack", "namespace": namespace, "res_type": res_type, "key": key,
+                            "version": version})
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+            self._sync(f)
+        self._file.close()
+        os.rename(tmp_path, self.path)
+        self._file = open(self.path, "a")
+        self._records = len(records)
+        self._pending = []
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync != "never":
+            os.fsync(f.fileno())
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.kill()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
 class Aggregator(object):
     """This class serves as a proxy for the distant aggregation service running elsewhere on the network.
     It will search out aggregators and locate them, falling back to other ones if the one it is connected to
     disappears, and resending data as needed."""
-    def __init__(self, logger=None, mdns_updater=None):
+    def __init__(self, logger=None, mdns_updater=None, concurrency=REGISTRATION_CONCURRENCY,
+                 batch_size=REGISTRATION_BATCH_SIZE, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 heartbeat_jitter=HEARTBEAT_JITTER, heartbeat_max_backoff=HEARTBEAT_MAX_BACKOFF,
+                 heartbeat_scheduler=None, parallel_reregister=True, hedge_delay=None, delta_sync=None,
+                 journal_path=None, journal_fsync=JOURNAL_FSYNC):
         self.logger = Logger("aggregator_proxy", logger)
         self.logger.writeWarning("This class is deprecated. Please use the matching one in nmos-node instead.")
         self.mdnsbridge = IppmDNSBridge(logger=self.logger)
@@ -78,114 +535,221 @@ class Aggregator(object):
             'entities': {
                 'resource': {
                 }
-            }
+            },
+            # The version of each resource last acknowledged by the Registration API, keyed on
+            # (namespace, res_type, key), which is the state it is believed to hold
+            'acked': {}
         }
         self._running = True
-        self._reg_queue = gevent.queue.Queue()
-        self.heartbeat_thread = gevent.spawn(self._heartbeat)
+        self._reg_queue = RegistrationQueue()
+        self._queue_wakeup = gevent.event.Event()
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+        self._send_pool = gevent.pool.Pool(concurrency)
+        # Pooled HTTP connections to each Registration API used, keyed on its href
+        self._sessions = {}
+        self._registries = RegistryPool(self._discover_registries)
+        # If set, requests which haven't been answered within this many seconds are also sent to the next best
+        # Registration API, and the first response is used
+        self.hedge_delay = hedge_delay
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_jitter = heartbeat_jitter
+        self.heartbeat_max_backoff = heartbeat_max_backoff
+        self._heartbeat_failures = 0
+        # A scheduler may be shared by many Aggregators in the same process
+        self._heartbeat_scheduler = HeartbeatScheduler() if heartbeat_scheduler is None else heartbeat_scheduler
+        # Heartbeats are no longer sent from a thread of their own, but for compatibility heartbeat_thread is still a
+        # greenlet which runs until heartbeats stop, so that it may be joined or checked
+        self._heartbeats_stopped = gevent.event.Event()
+        self.heartbeat_thread = gevent.spawn(self._heartbeats_stopped.wait)
+        # The first heartbeat is soon after starting, but spread out a little as with the rest
+        self._heartbeat_scheduler.add(self._heartbeat, random.uniform(0, heartbeat_jitter * heartbeat_interval))
+        # Replay the local mirror concurrently, one registration tier at a time, on re-registration rather than
+        # queueing each resource to be sent in turn
+        self.parallel_reregister = parallel_reregister
+        self._reregistering = False
+        self._replay_thread = None
+        self._reregistration = {"state": "idle", "total": 0, "registered": 0, "failed": 0, "unchanged": 0,
+                                "deleted": 0, "started": None, "time_to_registered": None}
+        # If the Registration API still has the Node on reconnection, only send it the changes since the versions it
+        # last acknowledged rather than deleting the Node and registering everything again. By default this is only
+        # done when there is a journal, from which the local mirror is loaded on restart.
+        self.delta_sync = journal_path is not None if delta_sync is None else delta_sync
+        self._journal = None
+        if journal_path is not None:
+            self._journal = RegistrationJournal(journal_path, fsync=journal_fsync)
+            loaded = self._journal.load()
+            self._registered["node"] = loaded["node"]
+            self._registered["entities"] = loaded["entities"]
+            self._registered["acked"] = loaded["acked"]
+            self.logger.writeInfo("Loaded {} resources from registration journal {}"
+                                  .format(sum(len(resources) for types in loaded["entities"].values()
+                                              for resources in types.values()), journal_path))
         self.queue_thread = gevent.spawn(self._process_queue)
 
-    # The heartbeat thread runs in the background every five seconds.
-    # If when it runs the Node is believed to be registered it will perform a heartbeat
+    # The heartbeat is called by the scheduler, every five seconds by default.
+    # If when it runs the Node is believed to be registered it will perform a heartbeat, otherwise it re-registers
+    # Returns the delay until the next heartbeat, or None to stop
     def _heartbeat(self):
-        self.logger.writeDebug("Starting heartbeat thread")
-        while self._running:
-            heartbeat_wait = 5
-            if not self._registered["registered"]:
-                self._process_reregister()
-            elif self._registered["node"]:
-                # Do heartbeat
-                try:
-                    self.logger.writeDebug("Sending heartbeat for Node {}"
-                                           .format(self._registered["node"]["data"]["id"]))
-                    self._SEND("POST", "/health/nodes/" + self._registered["node"]["data"]["id"])
-                except InvalidRequest as e:
-                    if e.status_code == 404:
-                        # Re-register
-                        self.logger.writeWarning("404 error on heartbeat. Marking Node for re-registration")
-                        self._registered["registered"] = False
-
-                        if(self._mdns_updater is not None):
-                            self._mdns_updater.inc_P2P_enable_count()
-                    else:
-                        # Client side error. Report this upwards via exception, but don't resend
-                        self.logger.writeError("Unrecoverable error code {} received from Registration API on heartbeat"
-                                               .format(e.status_code))
-                        self._running = False
-                except Exception:
+        if not self._running:
+            return None
+        success = True
+        if not self._registered["registered"]:
+            self._process_reregister()
+            # Having no Node to register yet isn't a failure
+            success = self._registered["registered"] or self._registered.get("node", None) is None
+        elif self._registered["node"]:
+            # Do heartbeat
+            try:
+                self.logger.writeDebug("Sending heartbeat for Node {}"
+                                       .format(self._registered["node"]["data"]["id"]))
+                self._SEND("POST", "/health/nodes/" + self._registered["node"]["data"]["id"])
+            except InvalidRequest as e:
+                if e.status_code == 404:
                     # Re-register
-                    self.logger.writeWarning("Unexpected error on heartbeat. Marking Node for re-registration")
+                    self.logger.writeWarning("404 error on heartbeat. Marking Node for re-registration")
                     self._registered["registered"] = False
-            else:
+
+                    if(self._mdns_updater is not None):
+                        self._mdns_updater.inc_P2P_enable_count()
+                    # Re-register straight away rather than backing off
+                    return 0
+                else:
+                    # Client side error. Report this upwards via exception, but don't resend
+                    self.logger.writeError("Unrecoverable error code {} received from Registration API on heartbeat"
+                                           .format(e.status_code))
+                    self._running = False
+                    self._queue_wakeup.set()
+                    self._heartbeats_stopped.set()
+                    return None
+            except Exception:
+                # Re-register
+                self.logger.writeWarning("Unexpected error on heartbeat. Marking Node for re-registration")
                 self._registered["registered"] = False
-                if(self._mdns_updater is not None):
-                    self._mdns_updater.inc_P2P_enable_count()
-            while heartbeat_wait > 0 and self._running:
-                gevent.sleep(1)
-                heartbeat_wait -= 1
-        self.logger.writeDebug("Stopping heartbeat thread")
-
-    # Provided the Node is believed to be correctly registered, hand off a single request to the SEND method
+                success = False
+        else:
+            self._registered["registered"] = False
+            if(self._mdns_updater is not None):
+                self._mdns_updater.inc_P2P_enable_count()
+        return self._next_heartbeat_delay(success)
+
+    # The heartbeat interval, doubling after each consecutive failure up to a limit, and randomly varied so that
+    # Nodes which started together don't send their heartbeats at the same moment
+    def _next_heartbeat_delay(self, success):
+        if success:
+            self._heartbeat_failures = 0
+            delay = self.heartbeat_interval
+        else:
+            self._heartbeat_failures += 1
+            delay = min(self.heartbeat_max_backoff, self.heartbeat_interval * 2 ** (self._heartbeat_failures - 1))
+        return delay * (1 + random.uniform(-self.heartbeat_jitter, self.heartbeat_jitter))
+
+    # Provided the Node is believed to be correctly registered, hand off batches of requests to the SEND method
     # On client error, clear the resource from the local mirror
     # On other error, mark Node as unregistered and trigger re-registration
     def _process_queue(self):
         self.logger.writeDebug("Starting HTTP queue processing thread")
         # Checks queue not empty before quitting to make sure unregister node gets done
         while self._running or (self._registered["registered"] and not self._reg_queue.empty()):
-            if not self._registered["registered"] or self._reg_queue.empty():
-                gevent.sleep(1)
+            self._queue_wakeup.clear()
+            if not self._registered["registered"] or self._reregistering or self._reg_queue.empty():
+                # Woken when a request is queued, with a timeout to notice other changes such as re-registration
+                # Requests wait while the local mirror is replayed, as they might otherwise overtake the replay
+                self._queue_wakeup.wait(1)
             else:
-                try:
-                    queue_item = self._reg_queue.get()
-                    namespace = queue_item["namespace"]
-                    res_type = queue_item["res_type"]
-                    res_key = queue_item["key"]
-                    if queue_item["method"] == "POST":
-                        if res_type == "node":
-                            data = self._registered["node"]
-                            try:
-                                self.logger.writeInfo("Attempting registration for Node {}"
-                                                      .format(self._registered["node"]["data"]["id"]))
-                                self._SEND("POST", "/{}".format(namespace), data)
-                                self._SEND("POST", "/health/nodes/" + self._registered["node"]["data"]["id"])
-                                self._registered["registered"] = True
-                                if self._mdns_updater is not None:
-                                    self._mdns_updater.P2P_disable()
-
-                            except Exception:
-                                self.logger.writeWarning("Error registering Node: %r" % (traceback.format_exc(),))
-
-                        elif res_key in self._registered["entities"][namespace][res_type]:
-                            data = self._registered["entities"][namespace][res_type][res_key]
-                            try:
-                                self._SEND("POST", "/{}".format(namespace), data)
-                            except InvalidRequest as e:
-                                self.logger.writeWarning("Error registering {} {}: {}".format(res_type, res_key, e))
-                                self.logger.writeWarning("Request data: {}".format(data))
-                                del self._registered["entities"][namespace][res_type][res_key]
-
-                    elif queue_item["method"] == "DELETE":
-                        translated_type = res_type + 's'
-                        try:
-                            self._SEND("DELETE", "/{}/{}/{}".format(namespace, translated_type, res_key))
-                        except InvalidRequest as e:
-                            self.logger.writeWarning("Error deleting resource {} {}: {}"
-                                                     .format(translated_type, res_key, e))
+                batch = []
+                while len(batch) < self._batch_size and not self._reg_queue.empty():
+                    batch.append(self._reg_queue.get())
+                for stage in self._batch_stages(batch):
+                    if not self._registered["registered"]:
+                        # Re-registration will queue everything in the local mirror again
+                        break
+                    if len(stage) == 1:
+                        self._process_queue_item(stage[0])
                     else:
-                        self.logger.writeWarning("Method {} not supported for Registration API interactions"
-                                                 .format(queue_item["method"]))
-                except Exception:
-                    self._registered["registered"] = False
-                    if(self._mdns_updater is not None):
-                        self._mdns_updater.P2P_disable()
+                        self._send_pool.map(self._process_queue_item, stage)
         self.logger.writeDebug("Stopping HTTP queue processing thread")
 
+    def _batch_stages(self, batch):
+        return batch_stages(batch, self.registration_order)
+
+    # Returns True if the request was sent, False if it failed, or None if there was nothing to send
+    def _process_queue_item(self, queue_item):
+        try:
+            namespace = queue_item["namespace"]
+            res_type = queue_item["res_type"]
+            res_key = queue_item["key"]
+            if queue_item["method"] == "POST":
+                if res_type == "node":
+                    data = self._registered["node"]
+                    try:
+                        self.logger.writeInfo("Attempting registration for Node {}"
+                                              .format(self._registered["node"]["data"]["id"]))
+                        self._SEND("POST", "/{}".format(namespace), data)
+                        self._SEND("POST", "/health/nodes/" + self._registered["node"]["data"]["id"])
+                        self._ack(namespace, res_type, data["data"]["id"], data)
+                        self._registered["registered"] = True
+                        if self._mdns_updater is not None:
+                            self._mdns_updater.P2P_disable()
+                        return True
+
+                    except Exception:
+                        self.logger.writeWarning("Error registering Node: %r" % (traceback.format_exc(),))
+                        return False
+
+                elif res_key in self._registered["entities"][namespace][res_type]:
+                    data = self._registered["entities"][namespace][res_type][res_key]
+                    try:
+                        self._SEND("POST", "/{}".format(namespace), data)
+                        self._ack(namespace, res_type, res_key, data)
+                        return True
+                    except InvalidRequest as e:
+                        self.logger.writeWarning("Error registering {} {}: {}".format(res_type, res_key, e))
+                        self.logger.writeWarning("Request data: {}".format(data))
+                        del self._registered["entities"][namespace][res_type][res_key]
+                        self._ack(namespace, res_type, res_key, None)
+                        return False
+
+            elif queue_item["method"] == "DELETE":
+                translated_type = res_type + 's'
+                try:
+                    self._SEND("DELETE", "/{}/{}/{}".format(namespace, translated_type, res_key))
+                    self._ack(namespace, res_type, res_key, None)
+                    return True
+                except InvalidRequest as e:
+                    self.logger.writeWarning("Error deleting resource {} {}: {}"
+                                             .format(translated_type, res_key, e))
+                    self._ack(namespace, res_type, res_key, None)
+                    return False
+            else:
+                self.logger.writeWarning("Method {} not supported for Registration API interactions"
+                                         .format(queue_item["method"]))
+        except Exception:
+            self._registered["registered"] = False
+            if(self._mdns_updater is not None):
+                self._mdns_updater.P2P_disable()
+            return False
+
+    # Record the version of a resource which the Registration API has acknowledged, or that it no longer has it
+    def _ack(self, namespace, res_type, key, data):
+        version = None if data is None else data["data"].get("version")
+        if version is None:
+            if self._registered["acked"].pop((namespace, res_type, key), None) is None:
+                return
+        elif self._registered["acked"].get((namespace, res_type, key)) == version:
+            return
+        else:
+            self._registered["acked"][(namespace, res_type, key)] = version
+        if self._journal is not None:
+            self._journal.ack(namespace, res_type, key, version)
+
     # Queue a request to be processed. Handles all requests except initial Node POST which is done in _process_reregister
-    def _queue_request(self, method, namespace, res_type, key):
-        self._reg_queue.put({"method": method, "namespace": namespace, "res_type": res_type, "key": key})
+    def _queue_request(self, method, namespace, res_type, key, new=False):
+        self._reg_queue.put(method, namespace, res_type, key, new=new)
+        self._queue_wakeup.set()
 
     # Register 'resource' type data including the Node
-    # NB: Node registration is managed by heartbeat thread so may take up to 5 seconds!
+    # NB: Node registration is managed by the heartbeat, which is run as soon as a new Node is registered
     def register(self, res_type, key, **kwargs):
         self.register_into("resource", res_type, key, **kwargs)
 
@@ -203,11 +767,24 @@ class Aggregator(object):
 
         if namespace == "resource" and res_type == "node":
             # Handle special Node type
+            old = self._registered["node"]
             self._registered["node"] = send_obj
+            if old is None and not self._registered["registered"] and self._running:
+                # Register the Node on the next heartbeat, which is brought forward
+                self._heartbeat_scheduler.add(self._heartbeat)
+            acked_key = (namespace, res_type, data["id"])
         else:
             self._add_mirror_keys(namespace, res_type)
+            old = self._registered["entities"][namespace][res_type].get(key)
             self._registered["entities"][namespace][res_type][key] = send_obj
-        self._queue_request("POST", namespace, res_type, key)
+            acked_key = (namespace, res_type, key)
+        if (self.delta_sync and old == send_obj and data.get("version") is not None and
+                self._registered["acked"].get(acked_key) == data["version"]):
+            # The Registration API already has this version, as when services register again after a restart
+            return
+        if self._journal is not None:
+            self._journal.register(namespace, res_type, key, send_obj)
+        self._queue_request("POST", namespace, res_type, key, new=old is None)
 
     # General unregister method for 'resource' types
     def unregister_from(self, namespace, res_type, key):
@@ -218,6 +795,8 @@ class Aggregator(object):
             self._add_mirror_keys(namespace, res_type)
             if key in self._registered["entities"][namespace][res_type]:
                 del self._registered["entities"][namespace][res_type][key]
+        if self._journal is not None:
+            self._journal.unregister(namespace, res_type, key)
         self._queue_request("DELETE", namespace, res_type, key)
 
     # Deal with missing keys in local mirror
@@ -227,12 +806,25 @@ class Aggregator(object):
         if res_type not in self._registered["entities"][namespace]:
             self._registered["entities"][namespace][res_type] = {}
 
-    # Re-register just the Node, and queue requests in order for other resources
+    # Re-register the Node, then the other resources in the local mirror in registration order
     def _process_reregister(self):
         if self._registered.get("node", None) is None:
             self.logger.writeDebug("No node registered, re-register returning")
             return
 
+        # Any replay still running is for a registration since lost
+        self._stop_replay()
+
+        # Time to register is measured from the first attempt, so is kept over any retries
+        started = self._reregistration["started"]
+        if self._reregistration["state"] not in ("in_progress", "failed"):
+            started = time.time()
+        self._reregistration = {"state": "in_progress", "total": 0, "registered": 0, "failed": 0, "unchanged": 0,
+                                "deleted": 0, "started": started, "time_to_registered": None}
+
+        if self.delta_sync and self._process_delta_sync():
+            return
+
         try:
             self.logger.writeDebug("Clearing old Node from API prior to re-registration")
             self._SEND("DELETE", "/resource/nodes/" + self._registered["node"]["data"]["id"])
@@ -249,11 +841,8 @@ class Aggregator(object):
             self._mdns_updater.inc_P2P_enable_count()
 
         # Drain the queue
-        while not self._reg_queue.empty():
-            try:
-                self._reg_queue.get(block=False)
-            except gevent.queue.Queue.Empty:
-                break
+        self._reg_queue.clear()
+        self._registered["acked"].clear()
 
         try:
             # Register the node, and immediately heartbeat if successful to avoid race with garbage collect.
@@ -261,6 +850,7 @@ class Aggregator(object):
                                   .format(self._registered["node"]["data"]["id"]))
             self._SEND("POST", "/resource", self._registered["node"])
             self._SEND("POST", "/health/nodes/" + self._registered["node"]["data"]["id"])
+            self._ack("resource", "node", self._registered["node"]["data"]["id"], self._registered["node"])
             self._registered["registered"] = True
             if self._mdns_updater is not None:
                 self._mdns_updater.P2P_disable()
@@ -269,50 +859,249 @@ class Aggregator(object):
             self.aggregator = ""  # Fallback to prevent us getting stuck if the Reg API issues a 4XX error incorrectly
             return
 
-        # Re-register items that must be ordered
-        # Re-register things we have in the local cache.
-        # "namespace" is e.g. "resource"
-        # "entities" are the things associated under that namespace.
-        for res_type in self.registration_order:
-            for namespace, entities in self._registered["entities"].items():
-                if res_type in entities:
-                    self.logger.writeInfo("Ordered re-registration for type: '{}' in namespace '{}'"
-                                          .format(res_type, namespace))
-                    for key in entities[res_type]:
-                        self._queue_request("POST", namespace, res_type, key)
-
-        # Re-register everything else
-        # Re-register things we have in the local cache.
-        # "namespace" is e.g. "resource"
-        # "entities" are the things associated under that namespace.
-        for namespace, entities in self._registered["entities"].items():
-            for res_type in entities:
-                if res_type not in self.registration_order:
-                    self.logger.writeInfo("Unordered re-registration for type: '{}' in namespace '{}'"
-                                          .format(res_type, namespace))
-                    for key in entities[res_type]:
-                        self._queue_request("POST", namespace, res_type, key)
+        tiers = self._reregistration_tiers()
+        if not self.parallel_reregister:
+            for tier in tiers:
+                for (namespace, res_type, key) in tier:
+                    self._queue_request("POST", namespace, res_type, key)
+            self._reregistration["state"] = "queued"
+            return
+
+        self._start_replay(tiers)
+
+    # Bring the Registration API up to date with the local mirror, provided it still has the Node: delete resources
+    # it has which have since been unregistered, and register those it doesn't have or has an old version of.
+    # Returns False if it doesn't have the Node, when everything must be registered again.
+    def _process_delta_sync(self):
+        node = self._registered["node"]
+        try:
+            self.logger.writeDebug("Checking Registration API has Node {} prior to delta sync"
+                                   .format(node["data"]["id"]))
+            self._SEND("POST", "/health/nodes/" + node["data"]["id"])
+        except InvalidRequest as e:
+            self.logger.writeInfo("Node not found by Registration API, re-registering everything: {}".format(e))
+            return False
+        except Exception as e:
+            self.logger.writeWarning("Error re-registering Node: {}".format(e))
+            return True
+
+        # Queued requests are superseded by comparing the local mirror to what the Registration API has acknowledged
+        self._reg_queue.clear()
+
+        node_key = ("resource", "node", node["data"]["id"])
+        if node["data"].get("version") is None or self._registered["acked"].get(node_key) != node["data"]["version"]:
+            if not self._process_queue_item({"method": "POST", "namespace": "resource", "res_type": "node",
+                                             "key": node["data"]["id"]}):
+                return True
+        else:
+            self._registered["registered"] = True
+            if self._mdns_updater is not None:
+                self._mdns_updater.P2P_disable()
+
+        deleted = [res for res in self._registered["acked"]
+                   if res[1] != "node" and res[2] not in self._registered["entities"].get(res[0], {}).get(res[1], {})]
+        self._start_replay(self._reregistration_tiers(), self._registration_tiers(deleted))
+        return True
+
+    # Replay the local mirror in its own greenlet, as it may take longer than the Registration API's garbage
+    # collection interval and heartbeats must continue meanwhile. The queue isn't processed until it completes.
+    def _start_replay(self, tiers, deleted_tiers=()):
+        self._reregistering = True
+        self._replay_thread = gevent.spawn(self._run_replay, tiers, deleted_tiers)
+
+    def _run_replay(self, tiers, deleted_tiers):
+        try:
+            self._replay_registrations(tiers, deleted_tiers)
+        finally:
+            self._reregistering = False
+            self._queue_wakeup.set()
+
+    def _stop_replay(self):
+        if self._replay_thread is not None:
+            self._replay_thread.kill()
+            self._replay_thread = None
+
+    def _registration_tiers(self, resources):
+        return registration_tiers(resources, self.registration_order)
+
+    # Tiers of the resources in the local mirror.
+    # "namespace" is e.g. "resource"
+    # "entities" are the things associated under that namespace.
+    def _reregistration_tiers(self):
+        return self._registration_tiers((namespace, res_type, key)
+                                        for namespace, entities in self._registered["entities"].items()
+                                        for res_type in entities
+                                        for key in entities[res_type])
+
+    # Send each tier of resources from the local mirror with bounded parallelism, stopping if registration is lost.
+    # Resources in deleted_tiers are unregistered first, children before their parents. Resources from the local
+    # mirror which the Registration API has acknowledged are only sent again if it no longer has the same version.
+    def _replay_registrations(self, tiers, deleted_tiers=()):
+        progress = self._reregistration
+        progress["total"] = sum(len(tier) for tier in tiers) + sum(len(tier) for tier in deleted_tiers)
+        stages = ([("Unregistering", self._replay_deletion, tier) for tier in reversed(deleted_tiers)] +
+                  [("Re-registering", self._replay_registration, tier) for tier in tiers])
+        for (action, replay, tier) in stages:
+            self.logger.writeInfo("{} {} resources of type '{}'".format(action, len(tier), tier[0][1]))
+            self._send_pool.map(replay, tier)
+            if not self._registered["registered"]:
+                self.logger.writeWarning("Registration lost during re-registration after {} of {} resources"
+                                         .format(progress["registered"] + progress["failed"] + progress["unchanged"] +
+                                                 progress["deleted"], progress["total"]))
+                progress["state"] = "failed"
+                return
+        progress["state"] = "complete"
+        progress["time_to_registered"] = time.time() - progress["started"]
+        self.logger.writeInfo("Re-registered {} resources in {:.3f}s"
+                              .format(progress["registered"], progress["time_to_registered"]))
+
+    def _replay_registration(self, res):
+        (namespace, res_type, key) = res
+        if self._registered_version_unchanged(res):
+            self._reregistration["unchanged"] += 1
+            return
+        result = self._process_queue_item({"method": "POST", "namespace": namespace, "res_type": res_type,
+                                           "key": key})
+        if result:
+            self._reregistration["registered"] += 1
+        elif result is False:
+            self._reregistration["failed"] += 1
+
+    def _replay_deletion(self, res):
+        (namespace, res_type, key) = res
+        if self._process_queue_item({"method": "DELETE", "namespace": namespace, "res_type": res_type, "key": key}):
+            self._reregistration["deleted"] += 1
+        else:
+            self._reregistration["failed"] += 1
+
+    # Whether the Registration API still has the version of a resource which it last acknowledged, and which is still
+    # the version in the local mirror. Resources without versions are always sent again.
+    def _registered_version_unchanged(self, res):
+        (namespace, res_type, key) = res
+        version = self._registered["acked"].get(res)
+        data = self._registered["entities"].get(namespace, {}).get(res_type, {}).get(key)
+        if version is None or data is None or data["data"].get("version") != version:
+            return False
+        try:
+            current = self._SEND("GET", "/{}/{}s/{}".format(namespace, res_type, key))
+        except Exception:
+            # Not found, or left to the POST to deal with other errors
+            return False
+        if isinstance(current, dict):
+            current = current.get("data", current)
+            return isinstance(current, dict) and current.get("version") == version
+        return False
 
     # Stop the Aggregator object running
     def stop(self):
         self.logger.writeDebug("Stopping aggregator proxy")
         self._running = False
-        self.heartbeat_thread.join()
+        self._queue_wakeup.set()
+        self._heartbeat_scheduler.remove(self._heartbeat)
+        self._heartbeats_stopped.set()
+        self._stop_replay()
         self.queue_thread.join()
+        for session in self._sessions.values():
+            session.close()
+        self._sessions = {}
+        if self._journal is not None:
+            self._journal.close()
+
+    # Counts of pending requests, and of requests which were collapsed into others before being sent
+    def queue_stats(self):
+        return self._reg_queue.stats()
+
+    # Progress of the most recent re-registration: its state, the number of resources in the local mirror and how
+    # many have been registered or failed so far, and once complete, the seconds taken from first trying to
+    # re-register the Node
+    def reregistration_stats(self):
+        return dict(self._reregistration)
 
     def status(self):
         return {"api_href": self.aggregator,
                 "api_version": AGGREGATOR_APIVERSION,
-                "registered": self._registered["registered"]}
+                "registered": self._registered["registered"],
+                "reregistration": self.reregistration_stats()}
 
-    def _get_api_href(self):
+    # Registration APIs advertised by mDNS, as (href, priority) pairs
+    def _discover_registries(self):
         protocol = "http"
         if _config.get('https_mode') == "enabled":
             protocol = "https"
-        api_href = self.mdnsbridge.getHref(REGISTRATION_MDNSTYPE, None, AGGREGATOR_APIVERSION, protocol)
-        if api_href == "":
-            api_href = self.mdnsbridge.getHref(LEGACY_REG_MDNSTYPE, None, AGGREGATOR_APIVERSION, protocol)
-        return api_href
+        hrefs = self.mdnsbridge.getHrefs(REGISTRATION_MDNSTYPE, None, AGGREGATOR_APIVERSION, protocol)
+        if not hrefs:
+            hrefs = self.mdnsbridge.getHrefs(LEGACY_REG_MDNSTYPE, None, AGGREGATOR_APIVERSION, protocol)
+        return hrefs
+
+    # The healthiest Registration API, preferring any not already tried
+    def _get_api_href(self, exclude=()):
+        return self._registries.select(exclude)
+
+    # Health of each known Registration API
+    def registry_stats(self):
+        return self._registries.stats()
+
+    # Sessions keep connections to the Registration API open between requests
+    def _get_session(self, href=None):
+        if href is None:
+            href = self.aggregator
+        session = self._sessions.get(href)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._sessions[href] = session
+        return session
+
+    # Send a request to one Registration API, recording its response time, or its failure to respond successfully
+    def _timed_request(self, href, method, url, data, headers):
+        start = time.time()
+        try:
+            session = self._get_session(href)
+            if _config.get('prefer_ipv6') is False:
+                R = session.request(method, urljoin(href, url), data=data, timeout=REGISTRATION_TIMEOUT,
+                                    headers=headers)
+            else:
+                R = session.request(method, urljoin(href, url), data=data, timeout=REGISTRATION_TIMEOUT,
+                                    headers=headers, proxies={'http': ''})
+        except Exception:
+            self._registries.record_failure(href)
+            raise
+        if R is None or R.status_code >= 500:
+            self._registries.record_failure(href)
+        else:
+            self._registries.record_success(href, time.time() - start)
+        return R
+
+    # Send a request to the current Registration API. If hedging is enabled, the request only reads, and there is no
+    # response in time, send it to the next best Registration API too, and use the first successful response. The
+    # slower request is left to finish, so that its response time is still recorded. Returns the href which responded
+    # and the response.
+    def _send_request(self, method, url, data, headers, tried):
+        href = self.aggregator
+        if self.hedge_delay is None or method not in HEDGED_METHODS:
+            return (href, self._timed_request(href, method, url, data, headers))
+
+        first = gevent.spawn(self._timed_request, href, method, url, data, headers)
+        first.join(self.hedge_delay)
+        if first.ready():
+            return (href, first.get())
+        hedge_href = self._registries.select(tried)
+        if hedge_href == "" or hedge_href in tried:
+            return (href, first.get())
+
+        self.logger.writeDebug("No response from {} in {}s, also sending {} {} to {}"
+                               .format(href, self.hedge_delay, method, url, hedge_href))
+        tried.append(hedge_href)
+        second = gevent.spawn(self._timed_request, hedge_href, method, url, data, headers)
+        hrefs = {first: href, second: hedge_href}
+        pending = [first, second]
+        while True:
+            done = gevent.wait(pending, count=1)[0]
+            pending.remove(done)
+            if not pending or (done.successful() and done.value is not None and done.value.status_code < 500):
+                return (hrefs[done], done.get())
 
     # Handle sending all requests to the Registration API, and searching for a new 'aggregator' if one fails
     def _SEND(self, method, url, data=None):
@@ -325,24 +1114,23 @@ class Aggregator(object):
             headers = {"Content-Type": "application/json"}
 
         url = AGGREGATOR_APINAMESPACE + "/" + AGGREGATOR_APINAME + "/" + AGGREGATOR_APIVERSION + url
+        tried = []
         for i in range(0, 3):
             if self.aggregator == "":
                 self.logger.writeWarning("No aggregator available on the network or mdnsbridge unavailable")
                 raise NoAggregator(self._mdns_updater)
 
             self.logger.writeDebug("{} {}".format(method, urljoin(self.aggregator, url)))
+            tried.append(self.aggregator)
 
-            # We give a long(ish) timeout below, as the async request may succeed after the timeout period
+            # We give a long(ish) timeout, as the async request may succeed after the timeout period
             # has expired, causing the node to be registered twice (potentially at different aggregators).
             # Whilst this isn't a problem in practice, it may cause excessive churn in websocket traffic
             # to web clients - so, sacrifice a little timeliness for things working as designed the
             # majority of the time...
             try:
-                if _config.get('prefer_ipv6') is False:
-                    R = requests.request(method, urljoin(self.aggregator, url), data=data, timeout=1.0, headers=headers)
-                else:
-                    R = requests.request(method, urljoin(self.aggregator, url), data=data, timeout=1.0,
-                                         headers=headers, proxies={'http': ''})
+                (href, R) = self._send_request(method, url, data, headers, tried)
+                self.aggregator = href
                 if R is None:
                     # Try another aggregator
                     self.logger.writeWarning("No response from aggregator {}".format(self.aggregator))
@@ -356,7 +1144,7 @@ class Aggregator(object):
                 elif R.status_code == 204:
                     return
 
-                elif (R.status_code/100) == 4:
+                elif (R.status_code // 100) == 4:
                     self.logger.writeWarning("{} response from aggregator: {} {}"
                                              .format(R.status_code, method, urljoin(self.aggregator, url)))
                     raise InvalidRequest(R.status_code, self._mdns_updater)
@@ -370,7 +1158,7 @@ class Aggregator(object):
                 self.logger.writeWarning("{} from aggregator {}".format(ex, self.aggregator))
 
             # This aggregator is non-functional
-            self.aggregator = self._get_api_href()
+            self.aggregator = self._get_api_href(tried)
             self.logger.writeInfo("Updated aggregator to {} (try {})".format(self.aggregator, i))
 
         raise TooManyRetries(self._mdns_updater)
@@ -378,7 +1166,7 @@ class Aggregator(object):
 
 class MDNSUpdater(object):
     def __init__(self, mdns_engine, mdns_type, mdns_name, mappings, port, logger, p2p_enable=False, p2p_cut_in_count=5,
-                 txt_recs=None):
+                 txt_recs=None, debounce=MDNS_UPDATE_DEBOUNCE):
         self.mdns = mdns_engine
         self.mdns_type = mdns_type
         self.mdns_name = mdns_name
@@ -400,24 +1188,47 @@ class MDNSUpdater(object):
         self.mdns.register(self.mdns_name, self.mdns_type, self.port, self.txt_rec_base)
 
         self._running = True
-        self._mdns_update_queue = gevent.queue.Queue()
+        # Only the latest TXT records are kept, replacing any which haven't been published yet
+        self.debounce = debounce
+        self._pending_txt_recs = None
+        self.mdns_updates_coalesced = 0
+        self._mdns_update_wakeup = gevent.event.Event()
+        self._mdns_stopping = gevent.event.Event()
         self.mdns_thread = gevent.spawn(self._modify_mdns)
 
     def _modify_mdns(self):
         while self._running:
-            if self._mdns_update_queue.empty():
-                gevent.sleep(0.2)
-            else:
-                try:
-                    txt_recs = self._mdns_update_queue.get()
-                    self.mdns.update(self.mdns_name, self.mdns_type, txt_recs)
-                except ServiceNotFoundException:
-                    self.logger.writeError("Unable to update mDNS record of type {} and name {}"
-                                           .format(self.mdns_name, self.mdns_type))
+            self._mdns_update_wakeup.wait()
+            if not self._running:
+                break
+            # Wait for any further changes in a burst before publishing the latest TXT records
+            self._mdns_stopping.wait(self.debounce)
+            self._mdns_update_wakeup.clear()
+            self._publish_pending()
+
+    def _publish_pending(self):
+        txt_recs = self._pending_txt_recs
+        self._pending_txt_recs = None
+        if txt_recs is not None:
+            try:
+                self.mdns.update(self.mdns_name, self.mdns_type, txt_recs)
+            except ServiceNotFoundException:
+                self.logger.writeError("Unable to update mDNS record of type {} and name {}"
+                                       .format(self.mdns_name, self.mdns_type))
+
+    def _queue_mdns_update(self, txt_recs):
+        if self._pending_txt_recs is not None:
+            self.mdns_updates_coalesced += 1
+        self._pending_txt_recs = txt_recs
+        self._mdns_update_wakeup.set()
 
     def stop(self):
         self._running = False
+        self._mdns_stopping.set()
+        self._mdns_update_wakeup.set()
         self.mdns_thread.join()
+        # Changes made since the last update are still published rather than being lost
+        self._publish_pending()
 
     def _p2p_txt_recs(self):
         txt_recs = self.txt_rec_base.copy()
@@ -429,7 +1240,7 @@ class MDNSUpdater(object):
             if (action == "register") or (action == "update") or (action == "unregister"):
                 self.logger.writeDebug("mDNS action: {} {}".format(action, type))
                 self._increment_service_version(type)
-                self._mdns_update_queue.put(self._p2p_txt_recs())
+                self._queue_mdns_update(self._p2p_txt_recs())
 
     def _increment_service_version(self, type):
         self.service_versions[self.mappings[type]] = self.service_versions[self.mappings[type]]+1
@@ -450,14 +1261,14 @@ class MDNSUpdater(object):
         if not self.p2p_enable:
             self.logger.writeInfo("Enabling P2P Discovery")
             self.p2p_enable = True
-            self._mdns_update_queue.put(self._p2p_txt_recs())
+            self._queue_mdns_update(self._p2p_txt_recs())
 
     def P2P_disable(self):
         if self.p2p_enable:
             self.logger.writeInfo("Disabling P2P Discovery")
             self.p2p_enable = False
             self._reset_P2P_enable_count()
-            self._mdns_update_queue.put(self.txt_rec_base)
+            self._queue_mdns_update(self.txt_rec_base)
         else:
             self._reset_P2P_enable_count()
 
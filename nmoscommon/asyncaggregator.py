@@ -0,0 +1,596 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# An asyncio counterpart of the Aggregator, for Python 3 only
+
+import asyncio
+import collections
+import json
+import random
+from urllib.parse import urljoin, urlsplit
+
+from .aggregator import (AGGREGATOR_APINAME, AGGREGATOR_APINAMESPACE, AGGREGATOR_APIVERSION, HEARTBEAT_INTERVAL,
+                         HEARTBEAT_JITTER, HEARTBEAT_MAX_BACKOFF, LEGACY_REG_MDNSTYPE, REGISTRATION_BATCH_SIZE,
+                         REGISTRATION_CONCURRENCY, REGISTRATION_MDNSTYPE, REGISTRATION_TIMEOUT, InvalidRequest,
+                         NoAggregator, RegistrationQueue, TooManyRetries, batch_stages, registration_tiers)
+from .logger import Logger
+from .mdnsbridge import IppmDNSBridge
+from .nmoscommonconfig import config as _config
+
+# The number of requests which may be sent on each connection before the responses to earlier ones are received
+HTTP_PIPELINE_DEPTH = 8
+
+# Seconds allowed for queued requests to be sent when stopping, such as to unregister the Node
+STOP_TIMEOUT = 5
+
+
+class HTTPResponse(object):
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+
+class _PipelinedConnection(object):
+    """A keep-alive HTTP/1.1 connection on which requests are written as soon as they are made. Responses are read in
+    order by a task of their own and matched to the requests waiting for them. A response to a request whose caller
+    has gone away, such as by being cancelled, is read and discarded so that later responses stay in step. on_ready
+    is called whenever the connection may accept another request, or has closed."""
+    def __init__(self, reader, writer, on_ready):
+        self._reader = reader
+        self._writer = writer
+        self._on_ready = on_ready
+        self._waiting = collections.deque()
+        # The number of requests waiting which must not have others pipelined behind them
+        self._unpipelined = 0
+        self.closed = False
+        self._read_task = asyncio.ensure_future(self._read_responses())
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def accepts(self, pipelined, depth):
+        """Whether a request may be sent now, given whether it may be pipelined and the most which may be waiting"""
+        if self.closed:
+            return False
+        return not self._waiting or (pipelined and not self._unpipelined and len(self._waiting) < depth)
+
+    async def send(self, request, pipelined):
+        """Write a request, returning a future of its response once the write has been flushed to the socket"""
+        future = asyncio.get_event_loop().create_future()
+        self._waiting.append((future, pipelined))
+        if not pipelined:
+            self._unpipelined += 1
+        self._writer.write(request)
+        try:
+            await self._writer.drain()
+        except Exception as e:
+            self._fail(e if isinstance(e, OSError) else ConnectionError(repr(e)))
+        return future
+
+    async def _read_responses(self):
+        try:
+            while True:
+                status_line = await self._reader.readline()
+                if not status_line:
+                    raise ConnectionError("Connection closed by server")
+                status_code = int(status_line.split()[1])
+                headers = {}
+                while True:
+                    line = await self._reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    (name, _, value) = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if 100 <= status_code < 200:
+                    # An interim response, such as 100 Continue, which is followed by the final one
+                    continue
+                if not self._waiting:
+                    raise ConnectionError("Unsolicited response from server")
+                content = await self._read_body(status_code, headers)
+                (future, pipelined) = self._waiting.popleft()
+                if not pipelined:
+                    self._unpipelined -= 1
+                if not future.done():
+                    future.set_result(HTTPResponse(status_code, headers, content))
+                if headers.get("connection", "").lower() == "close" or self.closed:
+                    raise ConnectionError("Connection closed by server")
+                self._on_ready()
+        except asyncio.CancelledError:
+            self._fail(ConnectionError("Connection closed"))
+            raise
+        except Exception as e:
+            self._fail(e if isinstance(e, OSError) else ConnectionError(repr(e)))
+
+    async def _read_body(self, status_code, headers):
+        if status_code in (204, 304):
+            return b""
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    break
+                chunks.append(await self._reader.readexactly(size))
+                await self._reader.readline()
+            while (await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            return b"".join(chunks)
+        if "content-length" in headers:
+            return await self._reader.readexactly(int(headers["content-length"]))
+        # The body runs to the end of the connection
+        self.closed = True
+        return await self._reader.read()
+
+    def _fail(self, exc):
+        # Requests still waiting can't tell whether they were acted on, which is why only idempotent ones are
+        # pipelined
+        self.closed = True
+        self._writer.close()
+        (waiting, self._waiting) = (self._waiting, collections.deque())
+        self._unpipelined = 0
+        for (future, _) in waiting:
+            if not future.done():
+                future.set_exception(exc)
+        self._on_ready()
+
+    def close(self):
+        self._read_task.cancel()
+        if not self.closed:
+            self._fail(ConnectionError("Connection closed"))
+
+
+class PipelinedHTTPClient(object):
+    """Sends requests to one HTTP server over up to a number of keep-alive connections, opening another when all of
+    those open are busy. Once that limit is reached, requests which are safe to repeat (PIPELINED_METHODS) are
+    pipelined on the least busy connection up to a depth, while others wait for a connection with nothing in flight
+    and have nothing pipelined behind them, so that a dropped connection can't leave it unclear which of them were
+    acted on. A request which times out closes its connection, as the responses on it would otherwise be out of
+    step."""
+    # Only safe methods are pipelined, as registrations must not be repeated or lost when a connection fails
+    PIPELINED_METHODS = ("GET", "HEAD")
+
+    def __init__(self, href, connections=REGISTRATION_CONCURRENCY, pipeline_depth=HTTP_PIPELINE_DEPTH,
+                 timeout=REGISTRATION_TIMEOUT, ssl=None):
+        parts = urlsplit(href)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self._host_header = parts.netloc
+        self._ssl = ssl if ssl is not None else parts.scheme == "https"
+        self.max_connections = connections
+        self.pipeline_depth = pipeline_depth
+        self.timeout = timeout
+        self._connections = []
+        self._opening = 0
+        self._ready = None
+
+    async def request(self, method, path, data=None, headers=None):
+        pipelined = method in self.PIPELINED_METHODS
+        connection = await self._connection(pipelined)
+        future = await connection.send(self._encode(method, path, data, headers), pipelined)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            connection.close()
+            raise
+
+    async def _connection(self, pipelined):
+        # The connection returned must be sent on before anything else runs, so that no other request can take it
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        while True:
+            self._connections = [connection for connection in self._connections if not connection.closed]
+            ready = [connection for connection in self._connections
+                     if connection.accepts(pipelined, self.pipeline_depth)]
+            idle = [connection for connection in ready if len(connection) == 0]
+            if idle:
+                return idle[0]
+            if len(self._connections) + self._opening < self.max_connections:
+                self._opening += 1
+                try:
+                    connection = await self._open()
+                finally:
+                    self._opening -= 1
+                    self._ready.set()
+                self._connections.append(connection)
+                return connection
+            if ready:
+                return min(ready, key=len)
+            self._ready.clear()
+            await self._ready.wait()
+
+    async def _open(self):
+        (reader, writer) = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self._ssl or None), self.timeout)
+        return _PipelinedConnection(reader, writer, self._ready.set)
+
+    def _encode(self, method, path, data, headers):
+        if data is None:
+            data = b""
+        elif not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        lines = ["{} {} HTTP/1.1".format(method, path),
+                 "Host: {}".format(self._host_header),
+                 "Content-Length: {}".format(len(data))]
+        for (header, value) in (headers or {}).items():
+            lines.append("{}: {}".format(header, value))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data
+
+    async def close(self):
+        connections = self._connections
+        self._connections = []
+        for connection in connections:
+            connection.close()
+        await asyncio.gather(*[connection._read_task for connection in connections], return_exceptions=True)
+
+
+class AsyncAggregator(object):
+    """An asyncio counterpart of Aggregator with the same register, unregister and status methods. Requests are sent
+    over keep-alive connections from a task started by start() and stopped by stop(), which may be used through
+    'async with'. If no api_href is given one is found using the mDNS bridge. Clients, which are keyed on href, may be
+    shared so that many instances simulating different Nodes use the same connections. P2P discovery via an
+    MDNSUpdater isn't supported."""
+    def __init__(self, logger=None, api_href=None, concurrency=REGISTRATION_CONCURRENCY,
+                 pipeline_depth=HTTP_PIPELINE_DEPTH, batch_size=REGISTRATION_BATCH_SIZE, timeout=REGISTRATION_TIMEOUT,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_jitter=HEARTBEAT_JITTER,
+                 heartbeat_max_backoff=HEARTBEAT_MAX_BACKOFF, clients=None):
+        self.logger = Logger("async_aggregator", logger)
+        self.aggregator = api_href or ""
+        self._api_href = api_href
+        self.mdnsbridge = None if api_href is not None else IppmDNSBridge(logger=self.logger)
+        self.registration_order = ["device", "source", "flow", "sender", "receiver"]
+        self._registered = {
+            'node': None,
+            'registered': False,
+            'entities': {
+                'resource': {
+                }
+            }
+        }
+        self._running = False
+        self._reg_queue = RegistrationQueue()
+        self._concurrency = concurrency
+        self._pipeline_depth = pipeline_depth
+        self._batch_size = batch_size
+        self.timeout = timeout
+        self._own_clients = clients is None
+        self._clients = {} if clients is None else clients
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_jitter = heartbeat_jitter
+        self.heartbeat_max_backoff = heartbeat_max_backoff
+        self._heartbeat_failures = 0
+        self._reregistering = False
+        self._queue_wakeup = None
+        self._heartbeat_wakeup = None
+        self._queue_task = None
+        self._heartbeat_task = None
+        self._replay_task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    async def start(self):
+        self._running = True
+        self._queue_wakeup = asyncio.Event()
+        self._heartbeat_wakeup = asyncio.Event()
+        self._queue_task = asyncio.ensure_future(self._process_queue())
+        self._heartbeat_task = asyncio.ensure_future(self._run_heartbeats())
+
+    async def stop(self, timeout=STOP_TIMEOUT):
+        """Stop heartbeats, allowing queued requests a while to be sent, and close any connections"""
+        self.logger.writeDebug("Stopping aggregator proxy")
+        self._running = False
+        tasks = [task for task in (self._heartbeat_task, self._queue_task) if task is not None]
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        await self._stop_replay()
+        if self._queue_task is not None:
+            self._queue_wakeup.set()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._queue_task), timeout)
+            except Exception:
+                self._queue_task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._heartbeat_task = self._queue_task = None
+        if self._own_clients:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            await asyncio.gather(*[client.close() for client in clients], return_exceptions=True)
+
+    async def _run_heartbeats(self):
+        delay = random.uniform(0, self.heartbeat_jitter * self.heartbeat_interval)
+        while self._running:
+            try:
+                await asyncio.wait_for(self._heartbeat_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._heartbeat_wakeup.clear()
+            delay = await self._heartbeat()
+            if delay is None:
+                return
+
+    # As Aggregator._heartbeat, returning the delay until the next heartbeat, or None to stop
+    async def _heartbeat(self):
+        if not self._running:
+            return None
+        success = True
+        if not self._registered["registered"]:
+            await self._process_reregister()
+            success = self._registered["registered"] or self._registered.get("node", None) is None
+        elif self._registered["node"]:
+            try:
+                await self._SEND("POST", "/health/nodes/" + self._registered["node"]["data"]["id"])
+            except InvalidRequest as e:
+                if e.status_code == 404:
+                    self.logger.writeWarning("404 error on heartbeat. Marking Node for re-registration")
+                    self._registered["registered"] = False
+                    return 0
+                else:
+                    self.logger.writeError("Unrecoverable error code {} received from Registration API on heartbeat"
+                                           .format(e.status_code))
+                    self._running = False
+                    self._queue_wakeup.set()
+                    return None
+            except Exception:
+                self.logger.writeWarning("Unexpected error on heartbeat. Marking Node for re-registration")
+                self._registered["registered"] = False
+                success = False
+        else:
+            self._registered["registered"] = False
+        return self._next_heartbeat_delay(success)
+
+    def _next_heartbeat_delay(self, success):
+        if success:
+            self._heartbeat_failures = 0
+            delay = self.heartbeat_interval
+        else:
+            self._heartbeat_failures += 1
+            delay = min(self.heartbeat_max_backoff, self.heartbeat_interval * 2 ** (self._heartbeat_failures - 1))
+        return delay * (1 + random.uniform(-self.heartbeat_jitter, self.heartbeat_jitter))
+
+    async def _process_queue(self):
+        while self._running or (self._registered["registered"] and not self._reg_queue.empty()):
+            self._queue_wakeup.clear()
+            if not self._registered["registered"] or self._reregistering or self._reg_queue.empty():
+                if not self._running and not self._reregistering:
+                    break
+                try:
+                    await asyncio.wait_for(self._queue_wakeup.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                batch = []
+                while len(batch) < self._batch_size and not self._reg_queue.empty():
+                    batch.append(self._reg_queue.get())
+                for stage in batch_stages(batch, self.registration_order):
+                    if not self._registered["registered"]:
+                        break
+                    await asyncio.gather(*[self._process_queue_item(queue_item) for queue_item in stage])
+
+    # As Aggregator._process_queue_item, returning True if the request was sent, False if it failed, or None if
+    # there was nothing to send
+    async def _process_queue_item(self, queue_item):
+        namespace = queue_item["namespace"]
+        res_type = queue_item["res_type"]
+        res_key = queue_item["key"]
+        try:
+            if queue_item["method"] == "POST":
+                if res_type == "node":
+                    try:
+                        await self._register_node()
+                        return True
+                    except Exception as e:
+                        self.logger.writeWarning("Error registering Node: {}".format(e))
+                        return False
+                elif res_key in self._registered["entities"][namespace][res_type]:
+                    data = self._registered["entities"][namespace][res_type][res_key]
+                    try:
+                        await self._SEND("POST", "/{}".format(namespace), data)
+                        return True
+                    except InvalidRequest as e:
+                        self.logger.writeWarning("Error registering {} {}: {}".format(res_type, res_key, e))
+                        del self._registered["entities"][namespace][res_type][res_key]
+                        return False
+            elif queue_item["method"] == "DELETE":
+                translated_type = res_type + 's'
+                try:
+                    await self._SEND("DELETE", "/{}/{}/{}".format(namespace, translated_type, res_key))
+                    return True
+                except InvalidRequest as e:
+                    self.logger.writeWarning("Error deleting resource {} {}: {}".format(translated_type, res_key, e))
+                    return False
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._registered["registered"] = False
+            return False
+
+    async def _register_node(self):
+        node = self._registered["node"]
+        await self._SEND("POST", "/resource", node)
+        await self._SEND("POST", "/health/nodes/" + node["data"]["id"])
+        self._registered["registered"] = True
+
+    def _queue_request(self, method, namespace, res_type, key, new=False):
+        self._reg_queue.put(method, namespace, res_type, key, new=new)
+        if self._queue_wakeup is not None:
+            self._queue_wakeup.set()
+
+    def register(self, res_type, key, **kwargs):
+        self.register_into("resource", res_type, key, **kwargs)
+
+    def unregister(self, res_type, key):
+        self.unregister_from("resource", res_type, key)
+
+    def register_into(self, namespace, res_type, key, **kwargs):
+        data = kwargs
+        send_obj = {"type": res_type, "data": data}
+        if 'id' not in send_obj["data"]:
+            self.logger.writeWarning("No 'id' present in data, using key='{}': {}".format(key, data))
+            send_obj["data"]["id"] = key
+
+        if namespace == "resource" and res_type == "node":
+            new = self._registered["node"] is None
+            self._registered["node"] = send_obj
+            if new and not self._registered["registered"] and self._heartbeat_wakeup is not None:
+                # Register the Node straight away
+                self._heartbeat_wakeup.set()
+        else:
+            self._registered["entities"].setdefault(namespace, {}).setdefault(res_type, {})
+            new = key not in self._registered["entities"][namespace][res_type]
+            self._registered["entities"][namespace][res_type][key] = send_obj
+        self._queue_request("POST", namespace, res_type, key, new=new)
+
+    def unregister_from(self, namespace, res_type, key):
+        if namespace == "resource" and res_type == "node":
+            self._registered["node"] = None
+        else:
+            self._registered["entities"].get(namespace, {}).get(res_type, {}).pop(key, None)
+        self._queue_request("DELETE", namespace, res_type, key)
+
+    # Register the Node again, then send the resources in the local mirror a registration tier at a time
+    async def _process_reregister(self):
+        node = self._registered.get("node", None)
+        if node is None:
+            self.logger.writeDebug("No node registered, re-register returning")
+            return
+        await self._stop_replay()
+
+        try:
+            await self._SEND("DELETE", "/resource/nodes/" + node["data"]["id"])
+        except InvalidRequest as e:
+            self.logger.writeInfo("Invalid request when deleting Node prior to registration: {}".format(e))
+        except Exception as e:
+            self.logger.writeError("Aborting Node re-register! {}".format(e))
+            return
+
+        self._registered["registered"] = False
+        self._reg_queue.clear()
+
+        try:
+            self.logger.writeInfo("Attempting re-registration for Node {}".format(node["data"]["id"]))
+            await self._register_node()
+        except Exception as e:
+            self.logger.writeWarning("Error re-registering Node: {}".format(e))
+            if self._api_href is None:
+                self.aggregator = ""
+            return
+
+        resources = [(namespace, res_type, key)
+                     for namespace, entities in self._registered["entities"].items()
+                     for res_type in entities
+                     for key in entities[res_type]]
+        self._start_replay(registration_tiers(resources, self.registration_order))
+
+    # As Aggregator._start_replay, replaying the local mirror in its own task so that heartbeats continue meanwhile.
+    # Queued requests wait until the replay is complete so that they can't overtake it.
+    def _start_replay(self, tiers):
+        self._reregistering = True
+        self._replay_task = asyncio.ensure_future(self._run_replay(tiers))
+
+    async def _run_replay(self, tiers):
+        try:
+            for tier in tiers:
+                await asyncio.gather(*[self._process_queue_item({"method": "POST", "namespace": namespace,
+                                                                 "res_type": res_type, "key": key})
+                                       for (namespace, res_type, key) in tier])
+                if not self._registered["registered"]:
+                    return
+        finally:
+            self._reregistering = False
+            self._queue_wakeup.set()
+
+    async def _stop_replay(self):
+        task, self._replay_task = self._replay_task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def queue_stats(self):
+        return self._reg_queue.stats()
+
+    def status(self):
+        return {"api_href": self.aggregator,
+                "api_version": AGGREGATOR_APIVERSION,
+                "registered": self._registered["registered"]}
+
+    def _discover_api_href(self):
+        protocol = "http"
+        if _config.get('https_mode') == "enabled":
+            protocol = "https"
+        api_href = self.mdnsbridge.getHref(REGISTRATION_MDNSTYPE, None, AGGREGATOR_APIVERSION, protocol)
+        if api_href == "":
+            api_href = self.mdnsbridge.getHref(LEGACY_REG_MDNSTYPE, None, AGGREGATOR_APIVERSION, protocol)
+        return api_href
+
+    async def _get_api_href(self):
+        if self._api_href is not None:
+            return self._api_href
+        # The mDNS bridge makes blocking requests
+        return await asyncio.get_event_loop().run_in_executor(None, self._discover_api_href)
+
+    def _get_client(self):
+        client = self._clients.get(self.aggregator)
+        if client is None:
+            client = PipelinedHTTPClient(self.aggregator, connections=self._concurrency,
+                                         pipeline_depth=self._pipeline_depth, timeout=self.timeout)
+            self._clients[self.aggregator] = client
+        return client
+
+    # As Aggregator._SEND, trying up to three times and finding another Registration API after each failure
+    async def _SEND(self, method, url, data=None):
+        if self.aggregator == "":
+            self.aggregator = await self._get_api_href()
+
+        headers = None
+        if data is not None:
+            data = json.dumps(data)
+            headers = {"Content-Type": "application/json"}
+
+        url = "/" + AGGREGATOR_APINAMESPACE + "/" + AGGREGATOR_APINAME + "/" + AGGREGATOR_APIVERSION + url
+        for i in range(0, 3):
+            if self.aggregator == "":
+                self.logger.writeWarning("No aggregator available on the network or mdnsbridge unavailable")
+                raise NoAggregator()
+
+            try:
+                R = await self._get_client().request(method, url, data, headers)
+                if R.status_code in [200, 201]:
+                    if R.headers.get("content-type", "text/plain").startswith("application/json"):
+                        return R.json()
+                    else:
+                        return R.content
+                elif R.status_code == 204:
+                    return
+                elif (R.status_code // 100) == 4:
+                    self.logger.writeWarning("{} response from aggregator: {} {}"
+                                             .format(R.status_code, method, urljoin(self.aggregator, url)))
+                    raise InvalidRequest(R.status_code)
+                else:
+                    self.logger.writeWarning("Unexpected status from aggregator {}: {}, {}"
+                                             .format(self.aggregator, R.status_code, R.content))
+            except (OSError, asyncio.TimeoutError) as ex:
+                self.logger.writeWarning("{!r} from aggregator {}".format(ex, self.aggregator))
+
+            self.aggregator = await self._get_api_href()
+            self.logger.writeInfo("Updated aggregator to {} (try {})".format(self.aggregator, i))
+
+        raise TooManyRetries()
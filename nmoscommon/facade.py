@@ -15,11 +15,12 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import os
-from .ipc import Proxy
+from .ipc import MultiplexedProxy, RemoteException
 import gevent
 from threading import Lock
-from .logger import Logger
+from contextlib import contextmanager
 from copy import deepcopy
+from .logger import Logger
 
 FAC_SUCCESS = 0
 FAC_EXISTS = 1
@@ -28,10 +29,96 @@ FAC_UNAUTHORISED = 3
 FAC_UNSUPPORTED = 4
 FAC_OTHERERROR = 5
 
+# The most resource calls sent in one IPC message by Facade.batch, so that a slow facade answers each message
+# within the time allowed for it, and a failure loses no more than one message's worth of status codes
+FACADE_BATCH_SIZE = 20
+
+# Receiver properties which are implementation details, and are not re-registered
+RECEIVER_HIDDEN_KEYS = ("pipel_id", "pipeline_id")
+
+
+def _immutable(self, *args, **kwargs):
+    raise TypeError("{} cannot be modified".format(type(self).__name__))
+
+
+class FrozenDict(dict):
+    """A dict which cannot be modified in place, which Facade stores without copying. Copying one, including with
+    deepcopy, returns it unchanged, and copy_with makes a modified version which shares everything else with it.
+    Use freeze to make one from a dict."""
+    __slots__ = ()
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _immutable
+
+    def __new__(cls, *args, **kwargs):
+        self = dict.__new__(cls)
+        dict.__init__(self, *args, **kwargs)
+        return self
+
+    def __init__(self, *args, **kwargs):
+        # The contents are set by __new__, so that calling __init__ again can't change them
+        pass
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+    def copy_with(self, changes=None, remove=()):
+        """Return a FrozenDict with the values in changes (which are frozen) set and the keys in remove removed"""
+        items = dict((k, v) for (k, v) in self.items() if k not in remove)
+        if changes:
+            items.update((k, freeze(v)) for (k, v) in changes.items())
+        return FrozenDict(items)
+
+
+class FrozenList(list):
+    """A list which cannot be modified in place, as found in FrozenDicts"""
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = remove = pop = sort = reverse = clear = _immutable
+    __setslice__ = __delslice__ = _immutable  # Python 2
+
+    def __new__(cls, *args):
+        self = list.__new__(cls)
+        list.__init__(self, *args)
+        return self
+
+    def __init__(self, *args):
+        # As for FrozenDict, calling __init__ again can't change the contents
+        pass
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+def freeze(value):
+    """Return a copy of a JSON-like value made of FrozenDicts and FrozenLists, or the value itself if it is already
+    frozen or immutable"""
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    elif isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for (k, v) in value.items())
+    elif isinstance(value, (list, tuple)):
+        return FrozenList(freeze(v) for v in value)
+    return value
+
 
 class Facade(object):
     """This class serves as a proxy for the Facade running on the same machine if it exists. If no facade exists
-    on this machine then it will do nothing, but calls will still function without throwing any exceptions."""
+    on this machine then it will do nothing, but calls will still function without throwing any exceptions.
+
+    Calls to the facade share a single MultiplexedProxy, so may be made from many greenlets at once, but only from
+    greenlets of one OS thread, as zmq sockets aren't thread-safe. Applications using threads should monkey patch
+    them with gevent, or give each thread a Facade of its own."""
     def __init__(self, srv_type, address="ipc:///tmp/ips-nodefacade", logger=None):
 
         self.logger = Logger("facade_proxy", logger)
@@ -44,18 +131,26 @@ class Facade(object):
         self.srv_type_urn = "urn:x-ipstudio:service:" + self.srv_type
         self.pid = os.getpid()
         self.resources = {}
+        self._receiver_views = {}  # Frozen receivers as re-registered, by key, with the resource they were made from
         self.controls = {}
         self.href = None
         self.proxy_path = None
-        self.lock = Lock()  # Protect access to IPC socket
+        self.lock = Lock()  # Protect creation of the IPC proxy, which itself allows concurrent calls
+        self._batched_calls = None  # Resource calls deferred by batch()
 
     def setup_ipc(self):
         with self.lock:
             try:
-                self.ipc = Proxy(self.address)
+                self.ipc = MultiplexedProxy(self.address)
             except Exception:
                 self.ipc = None
 
+    def _ipc_failed(self):
+        # The proxy is set up again only once it has closed, as when a call times out it is left open for the calls
+        # still waiting on it
+        if self.ipc is not None and self.ipc.socket is None:
+            self.ipc = None
+
     def register_service(self, href, proxy_path):
         self.logger.writeInfo("Register service")
         self.href = href
@@ -65,15 +160,14 @@ class Facade(object):
         if not self.ipc:
             return
         try:
-            with self.lock:
-                s = self.ipc.srv_register(self.srv_type, self.srv_type_urn, self.pid, href, proxy_path)
-                if s == FAC_SUCCESS:
-                    self.srv_registered = True
-                else:
-                    self.logger.writeInfo("Service registration failed: {}".format(self.debug_message(s)))
+            s = self.ipc.srv_register(self.srv_type, self.srv_type_urn, self.pid, href, proxy_path)
+            if s == FAC_SUCCESS:
+                self.srv_registered = True
+            else:
+                self.logger.writeInfo("Service registration failed: {}".format(self.debug_message(s)))
         except Exception as e:
             self.logger.writeError("Exception when registering service: {}".format(str(e)))
-            self.ipc = None
+            self._ipc_failed()
 
     def unregister_service(self):
         if not self.ipc:
@@ -81,12 +175,11 @@ class Facade(object):
         if not self.ipc:
             return
         try:
-            with self.lock:
-                self.ipc.srv_unregister(self.srv_type, self.pid)
-                self.srv_registered = False
+            self.ipc.srv_unregister(self.srv_type, self.pid)
+            self.srv_registered = False
         except Exception as e:
             self.logger.writeError("Exception when unregistering service: {}".format(str(e)))
-            self.ipc = None
+            self._ipc_failed()
 
     def heartbeat_service(self):
         if not self.ipc:
@@ -94,20 +187,19 @@ class Facade(object):
         if not self.ipc:
             return
         try:
-            with self.lock:
-                s = self.ipc.srv_heartbeat(self.srv_type, self.pid)
-                if s != FAC_SUCCESS:
-                    self.srv_registered = False
-                    self.logger.writeInfo("Heartbeat failed: {}".format(self.debug_message(s)))
-                else:
-                    self.srv_registered = True
+            s = self.ipc.srv_heartbeat(self.srv_type, self.pid)
+            if s != FAC_SUCCESS:
+                self.srv_registered = False
+                self.logger.writeInfo("Heartbeat failed: {}".format(self.debug_message(s)))
+            else:
+                self.srv_registered = True
             if not self.srv_registered or self.reregister:
                 # Handle reconnection if facade disappears
                 self.logger.writeInfo("Reregistering all services")
                 self.reregister_all()
         except Exception as e:
             self.logger.writeError("Exception when heartbeating service: {}".format(str(e)))
-            self.ipc = None
+            self._ipc_failed()
 
     # ONLY call this directly from within heartbeat_service!
     # To cause a re-registration on failure, set self.reregister!
@@ -119,40 +211,22 @@ class Facade(object):
         if not self.srv_registered:
             return
 
-        # TODO(clyntp): the following blocks are so similar...
-
-        # re-register resources
+        # re-register resources and controls together
+        calls = []
         for type in self.resources:
             for key in self.resources[type]:
-                try:
-                    with self.lock:
-                        resource = self.resources[type][key]
-                        # Hide some implementation details for receivers
-                        if type == "receiver":
-                            resource = deepcopy(self.resources[type][key])
-                            if "pipel_id" in self.resources[type][key]:
-                                resource.pop('pipel_id')
-                            if "pipeline_id" in self.resources[type][key]:
-                                resource.pop('pipeline_id')
-                        self.ipc.res_register(self.srv_type, self.pid, type, key, resource)
-                except Exception as e:
-                    self.logger.writeError("Exception when re-registering resource: {}".format(str(e)))
-                    self.ipc = None
-                    gevent.sleep(0)
-                    return
-
-        # re-register controls
+                resource = self.resources[type][key]
+                # Hide some implementation details for receivers
+                if type == "receiver":
+                    resource = self._receiver_view(key, resource)
+                calls.append(("res_register", type, key, resource))
         for device_id in self.controls:
             for control_href in self.controls[device_id]:
-                control_data = self.controls[device_id][control_href]
-                try:
-                    with self.lock:
-                        self.ipc.control_register(self.srv_type, self.pid, device_id, control_data)
-                except Exception as e:
-                    self.logger.writeError("Exception when re-registering control: {}".format(str(e)))
-                    self.ipc = None
-                    gevent.sleep(0)
-                    return
+                calls.append(("control_register", device_id, self.controls[device_id][control_href]))
+        (_, sent) = self._call_ipc_batch(calls)
+        if not sent:
+            gevent.sleep(0)
+            return
 
         self.reregister = False
 
@@ -167,28 +241,114 @@ class Facade(object):
             self.reregister = True
             return
         try:
-            with self.lock:
-                return self.ipc.invoke_named(method, self.srv_type, self.pid, *args, **kwargs)
+            return self.ipc.invoke_named(method, self.srv_type, self.pid, *args, **kwargs)
         except Exception as e:
             self.logger.writeError("Exception when calling IPC method: {}".format(str(e)))
-            self.ipc = None
+            self._ipc_failed()
             self.reregister = True
 
-    def addResource(self, type, key, value):
-        value = deepcopy(value)
-        if type not in self.resources:
-            self.resources[type] = {}
-        self.resources[type][key] = value
-        self._call_ipc_method("res_register", type, key, value)
+    # Make a list of (method, *args) calls with as few IPC messages as possible, returning the status code of each, or
+    # None for those which could not be sent, and whether they all were
+    def _call_ipc_batch(self, calls):
+        statuses = []
+        if not calls:
+            return (statuses, True)
+        if not self.srv_registered:
+            self.reregister = True
+            return ([None] * len(calls), False)
+        if not self.ipc:
+            self.setup_ipc()
+        if not self.ipc:
+            self.reregister = True
+            return ([None] * len(calls), False)
+        ipc = self.ipc
+        batch = [{'function': call[0], 'args': (self.srv_type, self.pid) + tuple(call[1:]), 'kwargs': {}}
+                 for call in calls]
+        batched = True
+        try:
+            for start in range(0, len(batch), FACADE_BATCH_SIZE):
+                chunk = batch[start:start + FACADE_BATCH_SIZE]
+                replies = None
+                if batched:
+                    try:
+                        replies = ipc.batch(chunk)
+                    except RemoteException as e:
+                        if e.args != ('AttributeError',):
+                            raise
+                        batched = False
+                if replies is None:
+                    # The facade predates batching, so fall back to separate calls. They are made one at a time, as
+                    # the facade may answer them one at a time, and time spent queued there would count against the
+                    # timeout.
+                    replies = [self._call_batched(ipc, call) for call in chunk]
+                statuses.extend(FAC_OTHERERROR if 'exc' in reply else reply.get('ret') for reply in replies)
+        except Exception as e:
+            self.logger.writeError("Exception when calling IPC batch: {}".format(str(e)))
+            self._ipc_failed()
+            self.reregister = True
+            return (statuses + [None] * (len(calls) - len(statuses)), False)
+        return (statuses, True)
 
-    def updateResource(self, type, key, value):
-        value = deepcopy(value)
+    def _call_batched(self, ipc, call):
+        try:
+            return {'ret': ipc.invoke_named(call['function'], *call['args'])}
+        except RemoteException as e:
+            return {'exc': e.args[0]}
+
+    def _call_resource_method(self, method, *args):
+        if self._batched_calls is not None:
+            self._batched_calls.append((method,) + args)
+            return
+        self._call_ipc_method(method, *args)
+
+    @contextmanager
+    def batch(self):
+        """Send the calls made by addResource, updateResource and delResource within the block to the facade
+        together when the block exits, FACADE_BATCH_SIZE calls to an IPC message. The list given by the context
+        manager is then filled in with the status code of each call, or None for those which could not be sent.
+
+        with facade.batch() as statuses:
+            for receiver in receivers:
+                facade.addResource("receiver", receiver["id"], receiver)"""
+        if self._batched_calls is not None:
+            # Calls within a nested batch are sent with the enclosing one
+            yield []
+            return
+        self._batched_calls = []
+        statuses = []
+        try:
+            yield statuses
+        finally:
+            # Resources stored before any exception are still sent, to keep the facade in step with them
+            (calls, self._batched_calls) = (self._batched_calls, None)
+            statuses.extend(self._call_ipc_batch(calls)[0])
+
+    def _receiver_view(self, key, resource):
+        if not isinstance(resource, FrozenDict):
+            # A plain resource may have been changed in place since it was stored, so its view can't be kept
+            if any(hidden in resource for hidden in RECEIVER_HIDDEN_KEYS):
+                resource = dict((k, v) for (k, v) in resource.items() if k not in RECEIVER_HIDDEN_KEYS)
+            return resource
+        view = self._receiver_views.get(key)
+        if view is None or view[0] is not resource:
+            if any(hidden in resource for hidden in RECEIVER_HIDDEN_KEYS):
+                view = (resource, resource.copy_with(remove=RECEIVER_HIDDEN_KEYS))
+            else:
+                view = (resource, resource)
+            self._receiver_views[key] = view
+        return view[1]
+
+    def _store_resource(self, type, key, value):
+        # A FrozenDict is stored as it is, as is the stored resource itself after being changed in place. Anything
+        # else is copied as before, so that the caller can't change it afterwards.
+        if not isinstance(value, FrozenDict) and value is not self.resources.get(type, {}).get(key):
+            value = deepcopy(value)
         if type not in self.resources:
             self.resources[type] = {}
         self.resources[type][key] = value
-        self._call_ipc_method("res_update", type, key, value)
+        return value
 
-    def delResource(self, type, key):
+    def _forget_resource(self, type, key):
         if type in self.resources:
             # Hack until adoption of flow instances (Ensure transports for flow are deleted)
             if type == "flow" and "transport" in self.resources:
@@ -197,7 +357,49 @@ class Facade(object):
                         del self.resources["transport"][transport]
             if key in self.resources[type]:
                 del self.resources[type][key]
-        self._call_ipc_method("res_unregister", type, key)
+            if type == "receiver":
+                self._receiver_views.pop(key, None)
+
+    def addResource(self, type, key, value):
+        """Add a resource, which is stored as a copy unless it is a FrozenDict (see updateResource)"""
+        value = self._store_resource(type, key, value)
+        self._call_resource_method("res_register", type, key, value)
+
+    def updateResource(self, type, key, value):
+        """Update a resource. Passing a FrozenDict, as made by freeze, avoids copying it, and when the stored
+        resource is one, the cheapest way to make another is to change it with copy_with, which shares everything
+        unchanged with it:
+
+        flow = facade.resources["flow"][flow_id]
+        facade.updateResource("flow", flow_id, flow.copy_with({"label": label, "version": version}))"""
+        value = self._store_resource(type, key, value)
+        self._call_resource_method("res_update", type, key, value)
+
+    def delResource(self, type, key):
+        self._forget_resource(type, key)
+        self._call_resource_method("res_unregister", type, key)
+
+    def addResources(self, resources):
+        """Add each of a list of (type, key, value) resources in batches of IPC messages, returning a list of their
+        status codes, as for batch"""
+        with self.batch() as statuses:
+            for (type, key, value) in resources:
+                self.addResource(type, key, value)
+        return statuses
+
+    def updateResources(self, resources):
+        """Update each of a list of (type, key, value) resources in batches, as for addResources"""
+        with self.batch() as statuses:
+            for (type, key, value) in resources:
+                self.updateResource(type, key, value)
+        return statuses
+
+    def delResources(self, resources):
+        """Remove each of a list of (type, key) resources in batches, as for addResources"""
+        with self.batch() as statuses:
+            for (type, key) in resources:
+                self.delResource(type, key)
+        return statuses
 
     def addControl(self, device_id, control_data):
         if device_id not in self.controls:
@@ -19,6 +19,17 @@ from flask import make_response, request, current_app
 from functools import update_wrapper
 
 
+def cors_headers(origin, methods, max_age=21600, headers=None):
+    """Return the tuple of (header, value) pairs which crossdomain attaches to a response, given values which have
+    already been normalised to strings."""
+    h = (('Access-Control-Allow-Origin', origin),
+         ('Access-Control-Allow-Methods', methods),
+         ('Access-Control-Max-Age', str(max_age)))
+    if headers is not None:
+        h += (('Access-Control-Allow-Headers', headers), )
+    return h
+
+
 def crossdomain(origin=None, methods=None, headers=None,
                 max_age=21600, attach_to_all=True,
                 automatic_options=True):
@@ -31,29 +42,48 @@ def crossdomain(origin=None, methods=None, headers=None,
     if isinstance(max_age, timedelta):
         max_age = max_age.total_seconds()
 
-    def get_methods():
-        if methods is not None:
-            return methods
+    # When the methods are known the headers are the same for every response, so are only built once
+    route_cors_headers = cors_headers(origin, methods, max_age, headers) if methods is not None else None
+
+    def get_cors_headers():
+        if route_cors_headers is not None:
+            return route_cors_headers
 
         options_resp = current_app.make_default_options_response()
-        return options_resp.headers['allow']
+        return cors_headers(origin, options_resp.headers['allow'], max_age, headers)
 
     def decorator(f):
+        allow_headers = {}
+
+        def options_response():
+            # Flask's default OPTIONS response finds the allowed methods by matching the URL against every rule in
+            # the app on each request. Every rule with the same path as the matched rule matches the same URLs, so
+            # the union of their methods is worked out once per rule instead
+            rule = request.url_rule
+            if route_cors_headers is None or rule is None:
+                return current_app.make_default_options_response()
+            allow = allow_headers.get(rule.rule)
+            if allow is None:
+                methods = set(rule.methods)
+                for other in current_app.url_map.iter_rules():
+                    if other.rule == rule.rule and other.methods is not None:
+                        methods.update(other.methods)
+                allow = allow_headers[rule.rule] = ', '.join(sorted(methods))
+            resp = current_app.response_class()
+            resp.headers['Allow'] = allow
+            return resp
+
         def wrapped_function(*args, **kwargs):
             if automatic_options and request.method == 'OPTIONS':
-                resp = current_app.make_default_options_response()
+                resp = options_response()
             else:
                 resp = make_response(f(*args, **kwargs))
             if not attach_to_all and request.method != 'OPTIONS':
                 return resp
 
             h = resp.headers
-
-            h['Access-Control-Allow-Origin'] = origin
-            h['Access-Control-Allow-Methods'] = get_methods()
-            h['Access-Control-Max-Age'] = str(max_age)
-            if headers is not None:
-                h['Access-Control-Allow-Headers'] = headers
+            for (header, value) in get_cors_headers():
+                h[header] = value
             return resp
 
         f.provide_automatic_options = False
@@ -18,11 +18,23 @@ import zmq.green as zmq
 import uuid
 import os
 import os.path
+import itertools
 import gevent
+import gevent.event
+import gevent.lock
+import gevent.pool
 import traceback
 import json
 import stat
 import warnings
+from collections import OrderedDict
+from contextlib import contextmanager
+from six import PY2
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
 
 
 class RemoteException(Exception):
@@ -37,19 +49,159 @@ class LocalException(Exception):
 RemoteExcepton = RemoteException
 
 
+class JSONCodec(object):
+    """Encodes messages as a single frame of JSON. This is the encoding used by Host and Proxy, and by any
+    MultiplexedHost or MultiplexedProxy which has not agreed on another codec."""
+    name = "json"
+
+    def encode(self, msg):
+        return [json.dumps(msg).encode('utf-8')]
+
+    def decode(self, frames):
+        return json.loads(_tobytes(frames[0]).decode('utf-8'))
+
+
+class MsgpackCodec(object):
+    """Encodes messages as a single frame of msgpack, which is smaller and faster to encode and decode than JSON and
+    carries bytes values natively. Only available if msgpack is installed."""
+    name = "msgpack"
+
+    def encode(self, msg):
+        return [msgpack.packb(msg, use_bin_type=True)]
+
+    def decode(self, frames):
+        # Allow the same non-string keys as JSON does, which become strings there
+        return msgpack.unpackb(frames[0], raw=False, strict_map_key=False)
+
+
+class MultipartCodec(object):
+    """Sends bytes-like arguments and return values as frames of their own, after a frame holding the rest of the
+    message encoded by another codec. Large frames are handed to zmq without being copied, and are received as
+    memoryviews of the received frames, again without being copied. Bytes-like values nested more deeply are left
+    to the other codec, so that large resources need not be searched for them."""
+    def __init__(self, codec):
+        self.codec = codec
+        self.name = codec.name + "+frames"
+
+    def encode(self, msg):
+        frames = []
+        return self.codec.encode(_extract_frames(msg, frames)) + frames
+
+    def decode(self, frames):
+        return _insert_frames(self.codec.decode(frames[:1]), frames[1:])
+
+
+# Codecs which MultiplexedHost and MultiplexedProxy may agree to use, in order of preference
+CODECS = OrderedDict()
+if msgpack is not None:
+    CODECS["msgpack+frames"] = MultipartCodec(MsgpackCodec())
+    CODECS["msgpack"] = MsgpackCodec()
+CODECS["json+frames"] = MultipartCodec(JSONCodec())
+CODECS["json"] = JSONCodec()
+
+_FRAME_MARKER = "__ipc_frame__"
+if PY2:
+    _BINARY_TYPES = (bytearray, memoryview)
+else:
+    _BINARY_TYPES = (bytes, bytearray, memoryview)
+
+
+def _tobytes(frame):
+    if isinstance(frame, memoryview):
+        return frame.tobytes()
+    return frame
+
+
+def _extract_frames(value, frames, depth=2):
+    # Replace bytes-like values with a marker giving their index in frames, which they are appended to. The default
+    # depth reaches the return value of a reply and the positional and keyword arguments of a call.
+    if isinstance(value, _BINARY_TYPES):
+        frames.append(value)
+        return {_FRAME_MARKER: len(frames) - 1}
+    elif depth == 0:
+        return value
+    elif isinstance(value, dict):
+        return dict((k, _extract_frames(v, frames, depth - 1)) for (k, v) in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [_extract_frames(v, frames, depth - 1) for v in value]
+    return value
+
+
+def _insert_frames(value, frames, depth=2):
+    if isinstance(value, dict):
+        if len(value) == 1 and _FRAME_MARKER in value:
+            return frames[value[_FRAME_MARKER]]
+        elif depth > 0:
+            return dict((k, _insert_frames(v, frames, depth - 1)) for (k, v) in value.items())
+    elif isinstance(value, list) and depth > 0:
+        return [_insert_frames(v, frames, depth - 1) for v in value]
+    return value
+
+
+def _split_envelope(frames):
+    # Split a message into the routing frames up to and including the empty delimiter frame, and the payload after
+    for (n, frame) in enumerate(frames):
+        if len(frame) == 0:
+            return (frames[:n + 1], frames[n + 1:])
+    return ([], frames)
+
+
+def _pack(codec, msg):
+    # JSON payloads are sent as a single frame, as by Host and Proxy, and others are preceded by the codec name
+    if codec.name == JSONCodec.name:
+        return codec.encode(msg)
+    return [codec.name.encode('ascii')] + codec.encode(msg)
+
+
+def _codecs(names):
+    if names is None:
+        return OrderedDict(CODECS)
+    for name in names:
+        if name not in CODECS:
+            raise ValueError("Unknown or unavailable IPC codec: {}".format(name))
+    return OrderedDict((name, CODECS[name]) for name in names)
+
+
+def _payload_codec(payload, codecs=CODECS):
+    # Return the codec a payload was encoded with, and the frames it encoded
+    if len(payload) == 1:
+        return (CODECS[JSONCodec.name], payload)
+    codec = codecs.get(_tobytes(payload[0]).decode('ascii', 'replace'))
+    if codec is None:
+        raise ValueError("Unsupported codec")
+    return (codec, payload[1:])
+
+
+def _unpack(payload, codecs=CODECS):
+    # Return the codec a payload was encoded with, and the message it holds
+    (codec, frames) = _payload_codec(payload, codecs)
+    return (codec, codec.decode(frames))
+
+
+@contextmanager
+def _acquired(semaphore):
+    if semaphore is None:
+        yield
+    else:
+        with semaphore:
+            yield
+
+
 class Host(object):
     """This class provides a server which can make a set of ipc commands available at a well known address.
     It provides a decorator, @ipcmethod which is used to decorate methods that are to be callable remotely.
 
     The server itself should be started with start and stopped with stop when no longer needed, though exiting
     the main application thread will also shut it down, this is not clean and not recommended."""
+    SOCKET_TYPE = "REP"
+
     def __init__(self, address, timeout=100):
         self.address = address
         ctx = zmq.Context.instance()
 
         self.timeout = timeout
 
-        self.socket = ctx.socket(zmq.REP)
+        self.socket = ctx.socket(getattr(zmq, self.SOCKET_TYPE))
         self.socket.bind(self.address)
         self.socket.setsockopt(zmq.LINGER, 0)
 
@@ -84,23 +236,23 @@ class Host(object):
             r = self.socket.poll(timeout=self.timeout)
             if r != 0:
                 msg = self.socket.recv_json()
-                if ('function' not in msg or 'args' not in msg or 'kwargs' not in msg):
-                    self.socket.send_json({})
-                    continue
+                self.socket.send_json(self._dispatch(msg))
 
-                if msg['function'] not in self.methods:
-                    self.socket.send_json({'exc': 'AttributeError'})
-                    continue
+    def _dispatch(self, msg):
+        # Call the method named in a request message, returning the reply message
+        if ('function' not in msg or 'args' not in msg or 'kwargs' not in msg):
+            return {}
 
-                try:
-                    r = self.methods[msg['function']](*(msg['args']), **(msg['kwargs']))
-                except Exception:
-                    self.socket.send_json({'exc': traceback.format_exc()})
-                    continue
-                if r is not None:
-                    self.socket.send_json({'ret': r})
-                else:
-                    self.socket.send_json({})
+        if msg['function'] not in self.methods:
+            return {'exc': 'AttributeError'}
+
+        try:
+            r = self.methods[msg['function']](*(msg['args']), **(msg['kwargs']))
+        except Exception:
+            return {'exc': traceback.format_exc()}
+        if r is not None:
+            return {'ret': r}
+        return {}
 
     def ipcmethod(self, name=None):
         def _inner(function):
@@ -118,8 +270,140 @@ class Host(object):
         )
 
 
+class MultiplexedHost(Host):
+    """A Host which can have many calls in flight over a single connection, as made by a MultiplexedProxy.
+
+    Each call carries an id which is copied into its reply, and replies are routed back to the connection the call
+    arrived on, so callers need not wait for one reply before sending the next call. Calls from a plain Proxy, which
+    carry no id, are answered exactly as a Host would answer them.
+
+    By default calls are still run one at a time in the order they arrive. If concurrency is given, each call is run
+    in its own greenlet, at most that many at once, and replied to as soon as it completes, so a slow method does not
+    hold up the others. method_limits may further restrict how many calls to particular methods run at once, eg.
+    {"res_register": 1}. Calls waiting for either limit are counted as queued by stats(). At most backlog calls may
+    wait; beyond that no more calls are read from the socket until one completes, and stats() counts the overflow.
+
+    codecs lists the names of the codecs in CODECS which proxies may use to encode their calls, by default all of
+    them. A MultiplexedProxy asks for them with the getcodecs method when it first connects, and JSON is always
+    accepted.
+
+    The batch method makes many calls with a single message, replying with the result of each in turn."""
+    SOCKET_TYPE = "ROUTER"
+
+    def __init__(self, address, timeout=100, concurrency=None, method_limits=None, codecs=None, backlog=100):
+        super(MultiplexedHost, self).__init__(address, timeout=timeout)
+        self.codecs = _codecs(codecs)
+        self.methods['getcodecs'] = self.getcodecs
+        self.methods['batch'] = self.batch
+        self.concurrency = concurrency
+        self.method_limits = dict(method_limits or {})
+        self._slots = gevent.lock.BoundedSemaphore(concurrency) if concurrency is not None else None
+        self._method_slots = {}
+        self._method_stats = {}
+        self._calls = gevent.pool.Pool(concurrency + backlog) if concurrency is not None else gevent.pool.Group()
+        self._overflows = 0
+
+    def stop(self):
+        self._calls.kill()
+        super(MultiplexedHost, self).stop()
+
+    def _run(self):
+        # Unlike Host, block in recv rather than polling, which adds a noticeable delay to each call when the other
+        # end is also waiting on a green socket. stop() kills the greenlet, so there is no need to wake up.
+        while not self._stop:
+            frames = [frame.buffer for frame in self.socket.recv_multipart(copy=False)]
+            if self.concurrency is None:
+                self._call(frames)
+            else:
+                if self._calls.full():
+                    self._overflows += 1
+                # Blocks while the pool is full, so that calls wait in the socket rather than in memory
+                self._calls.spawn(self._call, frames)
+
+    def _call(self, frames):
+        # The routing envelope is sent back unchanged with the reply, which is encoded in the same way as the call
+        (envelope, payload) = _split_envelope(frames)
+        codec = CODECS[JSONCodec.name]
+        try:
+            (codec, frames) = _payload_codec(payload, self.codecs)
+            msg = codec.decode(frames)
+        except Exception:
+            msg = None
+        if not isinstance(msg, dict):
+            # The id can't be recovered, so a MultiplexedProxy will time the call out
+            self.socket.send_multipart(envelope + _pack(codec, {'exc': "Undecodable call"}), copy=False)
+            return
+
+        name = msg.get('function')
+        stats = self._stats_for(name)
+        method_slots = self._method_slots_for(name)
+        stats['queued'] += 1
+        stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+        waiting = True
+        try:
+            with _acquired(method_slots), _acquired(self._slots):
+                stats['queued'] -= 1
+                waiting = False
+                stats['active'] += 1
+                try:
+                    reply = self._reply(codec, msg)
+                finally:
+                    stats['active'] -= 1
+                    stats['calls'] += 1
+        finally:
+            if waiting:
+                stats['queued'] -= 1
+        self.socket.send_multipart(envelope + reply, copy=False)
+
+    def _reply(self, codec, msg):
+        reply = self._dispatch(msg)
+        if 'id' in msg:
+            reply['id'] = msg['id']
+        try:
+            return _pack(codec, reply)
+        except Exception:
+            return _pack(codec, {'exc': traceback.format_exc(), 'id': msg.get('id')})
+
+    def _stats_for(self, name):
+        # Calls to unknown methods are counted together, so that clients cannot grow the statistics without bound
+        if name not in self.methods:
+            name = None
+        if name not in self._method_stats:
+            self._method_stats[name] = {'calls': 0, 'active': 0, 'queued': 0, 'max_queued': 0}
+        return self._method_stats[name]
+
+    def _method_slots_for(self, name):
+        if name not in self.method_limits or name not in self.methods:
+            return None
+        if name not in self._method_slots:
+            self._method_slots[name] = gevent.lock.BoundedSemaphore(self.method_limits[name])
+        return self._method_slots[name]
+
+    def batch(self, calls):
+        """Make each of a list of calls, given as {"function": name, "args": [...], "kwargs": {...}}, in turn.
+        Return a list of replies, each holding the return value of a call as "ret" or the exception it raised as
+        "exc", as a Proxy would receive them"""
+        return [self._dispatch(call) if isinstance(call, dict) else {} for call in calls]
+
+    def getcodecs(self):
+        """Return the names of the codecs calls may be encoded with, in order of preference"""
+        return list(self.codecs)
+
+    def stats(self):
+        """Return the number of calls running and waiting to run, in total and for each method called so far, and
+        the number of times reading calls stopped because the backlog was full. Calls to unknown methods are listed
+        under None."""
+        methods = dict((name, dict(stats)) for (name, stats) in self._method_stats.items())
+        return {'active': sum(stats['active'] for stats in methods.values()),
+                'queued': sum(stats['queued'] for stats in methods.values()),
+                'overflows': self._overflows,
+                'methods': methods}
+
+
 class Proxy(object):
     """This class provides a proxy to a remote ipc host which can be used to invoke methods on that host."""
+    SOCKET_TYPE = "REQ"
+
     def __init__(self, address, timeout=100):
         self.address = address
         ctx = zmq.Context.instance()
@@ -130,7 +414,7 @@ class Proxy(object):
             if not os.path.exists(address[6:]):
                 raise RuntimeError
 
-        self.socket = ctx.socket(zmq.REQ)
+        self.socket = ctx.socket(getattr(zmq, self.SOCKET_TYPE))
         self.socket.connect(self.address)
         self.socket.setsockopt(zmq.LINGER, 0)
         self.socket.setsockopt(zmq.SNDTIMEO, 0)
@@ -173,6 +457,135 @@ class Proxy(object):
         return _invoke
 
 
+class MultiplexedProxy(Proxy):
+    """A Proxy which can be called from many greenlets at once, pipelining their calls over a single connection.
+
+    Each call is sent with an id and waits for the reply carrying the same id, so calls need not be serialised by
+    the caller. A MultiplexedHost may answer calls in any order.
+
+    Before its first call the proxy asks the host which codecs it accepts, and uses the first of codecs (by default
+    every codec in CODECS, best first) which it does, falling back to JSON. A plain Host has no getcodecs method, so
+    JSON is used with it, and calls to it are sent one at a time as by a Proxy. Otherwise calls queued behind others
+    in the Host would count their waiting time against the timeout, and the first to time out would close the
+    connection for all of them. multiplexed is True once the host is known to be a MultiplexedHost, after which a
+    call which times out fails on its own, leaving the connection open for the others.
+
+    As with any zmq socket, a proxy may only be used from the OS thread which created it, though from any number of
+    greenlets in that thread."""
+    SOCKET_TYPE = "DEALER"
+
+    def __init__(self, address, timeout=100, codecs=None):
+        self.codecs = _codecs(codecs)
+        super(MultiplexedProxy, self).__init__(address, timeout=timeout)
+        self.codec = None
+        self.multiplexed = None
+        self._negotiation = gevent.lock.Semaphore()
+        self._serial = gevent.lock.Semaphore()
+        self._ids = itertools.count()
+        self._pending = OrderedDict()
+        self._receiver = None
+
+    def invoke_named(self, name, *args, **kwargs):
+        return self._call(name, args, kwargs, self.timeout)
+
+    def batch(self, calls):
+        """Make a list of calls, given as {"function": name, "args": [...], "kwargs": {...}}, with a single message to
+        the batch method of a MultiplexedHost, returning its list of replies. As the host makes the calls in turn, the
+        reply is waited for for the proxy's timeout for each call."""
+        return self._call('batch', (calls,), {}, self.timeout * max(1, len(calls)))
+
+    def _call(self, name, args, kwargs, timeout):
+        if self.codec is None:
+            self._negotiate()
+        if self.multiplexed:
+            return self._invoke(self.codec, name, args, kwargs, timeout)
+        with self._serial:
+            return self._invoke(self.codec, name, args, kwargs, timeout)
+
+    def _negotiate(self):
+        # Calls made while the codec is being agreed wait for it, rather than each asking the host again
+        with self._negotiation:
+            if self.codec is not None:
+                return
+            codec = CODECS[JSONCodec.name]
+            try:
+                accepted = self._invoke(codec, 'getcodecs', (), {})
+                self.multiplexed = True
+            except RemoteException:
+                accepted = []
+                self.multiplexed = False
+            for name in self.codecs:
+                if name in accepted:
+                    codec = self.codecs[name]
+                    break
+            self.codec = codec
+
+    def _invoke(self, codec, name, args, kwargs, timeout=None):
+        if self.socket is None:
+            raise LocalException("Unconnected Socket")
+
+        call_id = next(self._ids)
+        msg = {'function': name,
+               'args': args,
+               'kwargs': kwargs,
+               'id': call_id}
+        result = gevent.event.AsyncResult()
+        self._pending[call_id] = result
+        try:
+            # The empty delimiter frame makes the call look like one from a REQ socket, as a Host expects
+            self.socket.send_multipart([b""] + _pack(codec, msg), copy=False)
+        except Exception:
+            del self._pending[call_id]
+            raise
+        if self._receiver is None:
+            self._receiver = gevent.spawn(self._receive)
+
+        try:
+            r = result.get(timeout=(self.timeout if timeout is None else timeout) / 1000.0)
+        except gevent.Timeout:
+            if self.multiplexed:
+                # Only this call fails, and a late reply to it is discarded as its id is no longer pending
+                self._pending.pop(call_id, None)
+                raise LocalException("Timed out")
+            # Replies from a plain Host can't be told apart, so would be out of step
+            self.close()
+            raise LocalException("Unconnected Socket")
+        if 'exc' in r:
+            raise RemoteException(r['exc'])
+        return r.get('ret')
+
+    def _receive(self):
+        # Runs until the proxy is closed, handing each reply to the call with the matching id. As in
+        # MultiplexedHost, blocking in recv is much quicker than polling.
+        while self.socket is not None:
+            (_, payload) = _split_envelope([frame.buffer for frame in self.socket.recv_multipart(copy=False)])
+            try:
+                (_, r) = _unpack(payload)
+            except Exception:
+                continue
+            if not isinstance(r, dict):
+                continue
+            call_id = r.pop('id', None)
+            if call_id is None and not self.multiplexed and len(self._pending) > 0:
+                # A plain Host answers calls in turn, but without their ids
+                call_id = next(iter(self._pending))
+            result = self._pending.pop(call_id, None)
+            if result is not None:
+                result.set(r)
+        self._receiver = None
+
+    def close(self):
+        receiver = self._receiver
+        self._receiver = None
+        if receiver is not None and receiver is not gevent.getcurrent():
+            receiver.kill()
+        super(MultiplexedProxy, self).close()
+        pending = list(self._pending.values())
+        self._pending.clear()
+        for result in pending:
+            result.set_exception(LocalException("Unconnected Socket"))
+
+
 # This is deprecated
 class Socket(object):  # pragma: no cover
     def __init__(self, name=None, rmethods=None):
@@ -41,5 +41,14 @@ class MDNSInterface(object):
     def unregisterService(self, info):
         self.zeroconf.unregister_service(info)
 
+    def updateService(self, info):
+        """Announce changed records for a registered service without withdrawing it, returning False if this
+        version of zeroconf can't"""
+        update_service = getattr(self.zeroconf, "update_service", None)
+        if update_service is None:
+            return False
+        update_service(info)
+        return True
+
     def close(self):
         self.zeroconf.close()
@@ -34,18 +34,21 @@ class MDNSRegistration(object):
 
     def register(self):
         nameList = self._makeNamesUnique()
-        regtype = self.regtype + ".local."
         for interface in self.interfaces:
-            name = nameList[interface.ip] + "." + self.regtype + ".local."
-            self.info[interface.ip] = ServiceInfo(
-                regtype,
-                name,
-                port=self.port,
-                properties=self.txtRecord,
-                address=inet_aton(interface.ip)
-            )
+            self.info[interface.ip] = self._makeServiceInfo(interface, nameList)
             interface.registerService(self.info[interface.ip])
 
+    def _makeServiceInfo(self, interface, nameList):
+        regtype = self.regtype + ".local."
+        name = nameList[interface.ip] + "." + self.regtype + ".local."
+        return ServiceInfo(
+            regtype,
+            name,
+            port=self.port,
+            properties=self.txtRecord,
+            address=inet_aton(interface.ip)
+        )
+
     """TXT record entries must only be strings"""
     def _conformTxtRecord(self, record):
         conformedRecord = {}
@@ -54,6 +57,11 @@ class MDNSRegistration(object):
         return conformedRecord
 
     def update(self, name=None, regtype=None, port=None, txtRecord=None):
+        """Update the registration. A change to the TXT record alone is announced in place, where the interfaces
+        support it, rather than withdrawing the service and registering it again."""
+        inPlace = ((name is None or name == self.name) and (regtype is None or regtype == self.regtype) and
+                   (port is None or port == self.port) and
+                   all(interface.ip in self.info for interface in self.interfaces))
         if name is not None:
             self.name = name
         if regtype is not None:
@@ -62,10 +70,21 @@ class MDNSRegistration(object):
             self.port = port
         if txtRecord is not None:
             self.txtRecord = self._conformTxtRecord(txtRecord)
+        if inPlace and self._updateInPlace():
+            return
         self.unRegister()
         time.sleep(1)  # Seems to fail without this sometimes :(
         self.register()
 
+    def _updateInPlace(self):
+        nameList = self._makeNamesUnique()
+        for interface in self.interfaces:
+            info = self._makeServiceInfo(interface, nameList)
+            if not interface.updateService(info):
+                return False
+            self.info[interface.ip] = info
+        return True
+
     def _makeNamesUnique(self):
         if len(self.interfaces) == 1:
             return {self.interfaces[0].ip: self.name}
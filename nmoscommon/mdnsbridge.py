@@ -100,6 +100,27 @@ class IppmDNSBridge(object):
         self.services[srv_type].remove(service)
         return href
 
+    def getHrefs(self, srv_type, priority=None, api_ver=None, api_proto=None):
+        # Unlike getHref, list every matching service as (href, priority), refreshing them from the mDNS bridge
+        if priority is None:
+            priority = self.config["priority"]
+
+        self._updateServices(srv_type)
+
+        hrefs = []
+        for service in self.services.get(srv_type, []):
+            if api_ver is not None and api_ver not in service["versions"]:
+                continue
+            if api_proto is not None and api_proto != service["protocol"]:
+                continue
+            if priority >= 100:
+                if service["priority"] != priority:
+                    continue
+            elif service["priority"] >= 100:
+                continue
+            hrefs.append((self._createHref(service), service["priority"]))
+        return hrefs
+
     def _createHref(self, service):
         proto = service['protocol']
         if service.get('hostname') is not None and self.config["prefer_hostnames"]:
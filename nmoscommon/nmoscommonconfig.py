@@ -26,6 +26,12 @@ config_defaults = {
     "prefer_hostnames": False,
     "node_hostname": None,
     "fix_proxy": "disabled",
+    "compact_json": "disabled",
+    "html_highlight_limit": 262144,
+    "metrics_route": "disabled",
+    "websocket_send_queue": 64,
+    "websocket_slow_consumer": "disconnect",
+    "websocket_pool_size": 100,
     "logging": {
         "level": "DEBUG",
         "fileLocation": "/var/log/nmos.log",
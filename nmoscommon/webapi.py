@@ -16,19 +16,29 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 from six import string_types
-from six import iterkeys
 from six import get_method_self
 
 import uuid
 import json
 import traceback
 import time
+import gevent
+import gevent.pool
+import gevent.queue
 
-from flask import Flask, Response, request, abort
+from flask import Flask, Response, request, abort, stream_with_context
 from flask_sockets import Sockets
 from .flask_cors import crossdomain
 from functools import wraps
 import re
+import hashlib
+import weakref
+from bisect import bisect_left
+from collections import OrderedDict
+try:
+    from collections.abc import Iterator
+except ImportError:  # pragma: no cover
+    from collections import Iterator
 
 from pygments import highlight
 from pygments.lexers import JsonLexer, PythonTracebackLexer
@@ -36,8 +46,9 @@ from pygments.formatters import HtmlFormatter
 from mediajson import NMOSJSONEncoder
 import sys
 
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, default_exceptions
 from werkzeug.wrappers import BaseResponse
+from werkzeug.http import parse_etags, quote_etag, unquote_etag
 
 # This moved in Werkzeug 0.15.0, but if it's not there try the old location in case we're on Bionic with 0.14.1
 try:
@@ -54,6 +65,7 @@ import flask_oauthlib.client
 from authlib.common.errors import AuthlibBaseError
 
 from .utils import getLocalIP
+from .logger import Logger
 
 try:  # pragma: no cover
     from six.moves.urllib.parse import urlparse
@@ -64,6 +76,77 @@ except Exception:  # pragma: no cover
 
 from .nmoscommonconfig import config as _config
 
+# Optional fast encoders used for compact JSON output. Both delegate the NMOS types they don't understand
+# (timestamps, fractions etc.) back to NMOSJSONEncoder.default, and anything they refuse outright falls back
+# to the standard library encoder.
+_nmos_json_default = NMOSJSONEncoder().default
+try:  # pragma: no cover
+    import orjson
+
+    def _fast_json_dumps(r):
+        return orjson.dumps(r, default=_nmos_json_default)
+except ImportError:  # pragma: no cover
+    try:
+        import ujson
+        ujson.dumps(None, default=str)  # Versions of ujson before 2.0 have no default hook
+
+        def _fast_json_dumps(r):
+            return ujson.dumps(r, default=_nmos_json_default, escape_forward_slashes=False)
+    except (ImportError, TypeError):
+        _fast_json_dumps = None
+
+
+class LRUCache(object):
+    """A simple bounded mapping which discards the least recently used entry once maxsize is exceeded"""
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize}
+
+
+class ResponseCache(LRUCache):
+    """A bounded LRU store of pre-serialised response bodies for routes registered with cache=True.
+
+    Entries are keyed on (request path, query string, mimetype, compact, version), where the version is the ETag
+    header supplied by the route handler (if any). Handlers which do not supply a version must call invalidate() when
+    their resources change, otherwise stale bodies will continue to be served."""
+    def invalidate(self, path=None):
+        """Drop cached bodies for the given request path and everything below it, or all bodies if no path is given"""
+        if path is None:
+            self.clear()
+            return
+        for key in [k for k in self._entries if k[0] == path or k[0].startswith(path.rstrip('/') + '/')]:
+            del self._entries[key]
+
 
 class MediaType(object):
     def __init__(self, mr):
@@ -95,42 +178,69 @@ class MediaType(object):
         return False
 
 
+# Each distinct Accept header is parsed only once into a tuple of (type, subtype, priority, source string), and
+# the outcome of negotiating it against a given tuple of candidate types is remembered
+_accept_string_cache = LRUCache(maxsize=128)
+_most_acceptable_cache = LRUCache(maxsize=256)
+
+
+def _parse_accept_string(accept_string):
+    parsed = _accept_string_cache.get(accept_string)
+    if parsed is None:
+        parsed = []
+        for x in accept_string.split(','):
+            t = MediaType(x.strip())
+            parsed.append((t.type, t.subtype, t.priority, x.strip()))
+        parsed = tuple(parsed)
+        _accept_string_cache.put(accept_string, parsed)
+    return parsed
+
+
+def _acceptable_index(type, subtype, accept_string):
+    for idx, (accept_type, accept_subtype, priority, source) in enumerate(_parse_accept_string(accept_string)):
+        if accept_type == type or accept_type == '*':
+            if accept_subtype == subtype or accept_subtype == '*':
+                return idx
+    return None
+
+
 def AcceptStringParser(accept_string):
-    return [MediaType(x.strip()) for x in accept_string.split(',')]
+    return [MediaType(source) for (_, _, _, source) in _parse_accept_string(accept_string)]
 
 
 def AcceptableType(mt, accept_string):
     if not isinstance(mt, MediaType):
         mt = MediaType(mt)
-    for idx, t in enumerate(AcceptStringParser(accept_string)):
-        if t.matches(mt):
-            t.accept_index = idx
-            return t
-    return None
+    idx = _acceptable_index(mt.type, mt.subtype, accept_string)
+    if idx is None:
+        return None
+    t = MediaType(_parse_accept_string(accept_string)[idx][3])
+    t.accept_index = idx
+    return t
+
+
+def _most_acceptable_type(type_strings, accept_string):
+    accepted = _parse_accept_string(accept_string)
+
+    def _rank(mt):
+        t = MediaType(mt)
+        idx = _acceptable_index(t.type, t.subtype, accept_string)
+        if idx is None:
+            return (1, 0, 0)
+        return (0, -accepted[idx][2], idx)
+
+    return sorted(type_strings, key=_rank)[0]
 
 
 def MostAcceptableType(type_strings, accept_string):
     """First parameter is a list of media type strings, the second is an HTTP Accept header string. Return
     value is a string which corresponds to the most acceptable type out of the list provided."""
-    def __cmp(a, b):
-        if a is None and b is None:
-            return 0
-        elif a is None:
-            return 1
-        elif b is None:
-            return -1
-        elif a.priority == b.priority:
-            return (a.accept_index > b.accept_index) - (a.accept_index < b.accept_index)
-        else:
-            return -((a.priority > b.priority) - (a.priority < b.priority))
-
-    return sorted(
-                [(mt, AcceptableType(MediaType(mt), accept_string)) for mt in type_strings],
-                cmp=lambda a, b: __cmp(
-                    a[1],
-                    b[1]
-                )
-          )[0][0]
+    key = (accept_string, tuple(type_strings))
+    result = _most_acceptable_cache.get(key)
+    if result is None:
+        result = _most_acceptable_type(type_strings, accept_string)
+        _most_acceptable_cache.put(key, result)
+    return result
 
 
 HOST = None
@@ -151,8 +261,9 @@ while not HOST:
 
 
 class LinkingHTMLFormatter(HtmlFormatter):
-    def wrap(self, source, outfile):
-        return self._wrap_linking(super(LinkingHTMLFormatter, self).wrap(source, outfile))
+    def wrap(self, source, *args):
+        # Pygments 2.12 dropped the outfile argument from wrap()
+        return self._wrap_linking(super(LinkingHTMLFormatter, self).wrap(source, *args))
 
     def _wrap_linking(self, source):
         for i, t in source:
@@ -170,6 +281,66 @@ def expects_json(func):
     return __inner
 
 
+# Bodies larger than this (in characters) are shown without syntax highlighting, which is slow for big documents
+HTML_HIGHLIGHT_LIMIT = 262144
+
+PLAIN_HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+  <title>{title}</title>
+  <meta http-equiv="content-type" content="text/html; charset=utf-8">
+</head>
+<body>
+<h2>{title}</h2>
+<pre>{body}</pre>
+</body>
+</html>
+"""
+
+
+class HTMLRenderCache(LRUCache):
+    """Rendered HTML views of JSON responses, keyed on a hash of the JSON body and the page title (which is derived
+    from the base URL and path). Also records how many views were rendered and the time spent doing so."""
+    def __init__(self, maxsize=32):
+        super(HTMLRenderCache, self).__init__(maxsize=maxsize)
+        self.highlighted_renders = 0
+        self.plain_renders = 0
+        self.render_time = 0.0
+
+    def stats(self):
+        stats = super(HTMLRenderCache, self).stats()
+        stats.update({"highlighted_renders": self.highlighted_renders,
+                      "plain_renders": self.plain_renders,
+                      "render_time": self.render_time})
+        return stats
+
+
+html_render_cache = HTMLRenderCache()
+
+
+def _render_plain_html(body, title):
+    body = body.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    body = re.sub(r'"([a-zA-Z0-9_.\-~]+)/"', r'"<a href="./\1/">\1/</a>"', body)
+    return PLAIN_HTML_TEMPLATE.format(title=title, body=body)
+
+
+def render_html(body, title):
+    """Return an HTML page showing the serialised JSON body, from the cache where possible"""
+    key = (hashlib.sha1(body.encode('utf-8')).hexdigest(), title)
+    html = html_render_cache.get(key)
+    if html is None:
+        start = time.time()
+        if len(body) > _config.get('html_highlight_limit', HTML_HIGHLIGHT_LIMIT):
+            html = _render_plain_html(body, title)
+            html_render_cache.plain_renders += 1
+        else:
+            html = highlight(body, JsonLexer(), LinkingHTMLFormatter(linenos='table', full=True, title=title))
+            html_render_cache.highlighted_renders += 1
+        html_render_cache.render_time += time.time() - start
+        html_render_cache.put(key, html)
+    return html
+
+
 def htmlify(r, mimetype, status=200):
     # if the request was proxied via the nodefacade, use the original host in response.
     # additional external proxies could cause an issue here, so we can override the hostname
@@ -190,19 +361,100 @@ def htmlify(r, mimetype, status=200):
         if x != '':
             t += '/' + x.strip('/')
             title += '/<a href="' + t + '">' + x.strip('/') + '</a>'
-    return IppResponse(highlight(json.dumps(r, indent=4, cls=NMOSJSONEncoder),
-                                 JsonLexer(),
-                                 LinkingHTMLFormatter(linenos='table',
-                                                      full=True,
-                                                      title=title)),
+    return IppResponse(render_html(json.dumps(r, indent=4, cls=NMOSJSONEncoder), title),
                        mimetype='text/html',
                        status=status)
 
 
-def jsonify(r, status=200, headers=None):
+def make_etag(data):
+    """Return a strong, quoted entity tag for a serialised response body"""
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return quote_etag(hashlib.sha1(data).hexdigest())
+
+
+def dumps_json(r, compact=False):
+    """Serialise a response body, either indented for people or compact for machine clients"""
+    if not compact:
+        return json.dumps(r, indent=4, cls=NMOSJSONEncoder)
+    if _fast_json_dumps is not None:
+        try:
+            return _fast_json_dumps(r)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return json.dumps(r, separators=(',', ':'), cls=NMOSJSONEncoder)
+
+
+def compact_json_requested():
+    """Decide whether to use compact JSON for the current request, according to the 'compact_json' config option.
+    In 'auto' mode compact output is used unless the client explicitly asks for text/html, as browsers do."""
+    mode = _config.get('compact_json', 'disabled')
+    if mode == 'enabled':
+        return True
+    elif mode == 'auto':
+        return not any(value == 'text/html' for (value, quality) in request.accept_mimetypes)
+    return False
+
+
+def jsonify(r, status=200, headers=None, cache=None, etag=False):
+    if headers is None:
+        headers = {}
+    compact = compact_json_requested()
+    if cache is not None and status == 200 and request.method in ['GET', 'HEAD']:
+        key = (request.path, request.query_string, 'application/json', compact,
+               CaseInsensitiveDict(headers).get('ETag'))
+        data = cache.get(key)
+        if data is None:
+            data = dumps_json(r, compact)
+            cache.put(key, data)
+    else:
+        data = dumps_json(r, compact)
+
+    if etag and status == 200 and request.method in ['GET', 'HEAD']:
+        # Handlers may supply their own (e.g. version based) ETag, otherwise one is derived from the body
+        headers = CaseInsensitiveDict(headers)
+        if 'ETag' not in headers:
+            headers['ETag'] = make_etag(data)
+        headers['Cache-Control'] = headers.get('Cache-Control', 'no-cache')
+        if parse_etags(request.headers.get('If-None-Match')).contains_weak(unquote_etag(headers['ETag'])[0]):
+            return IppResponse(status=304, headers=headers)
+
+    return IppResponse(data,
+                       mimetype='application/json',
+                       status=status,
+                       headers=headers)
+
+
+def is_json_stream(r):
+    """Handlers may return an iterator (e.g. a generator) in place of a list to have it streamed as a JSON array"""
+    return isinstance(r, Iterator) and not isinstance(r, (string_types, bytes, dict, list, tuple))
+
+
+def _iter_json_array(items, compact=False):
+    # Produces the same output as dumps_json(list(items), compact) one item at a time
+    opening = '[' if compact else '[\n    '
+    separator = ',' if compact else ',\n    '
+    prefix = opening
+    for item in items:
+        data = dumps_json(item, compact)
+        if not compact:
+            data = data.replace('\n', '\n    ')
+        yield prefix
+        yield data
+        prefix = separator
+    if prefix is opening:
+        yield '[]'
+    else:
+        yield ']' if compact else '\n]'
+
+
+def jsonify_stream(r, status=200, headers=None):
+    """Return a response which encodes the iterator r as a JSON array while it is being sent, so that large
+    collections need not be held in memory. An exception raised by the iterator part way through will truncate
+    the response, as the status and headers have already been sent."""
     if headers is None:
         headers = {}
-    return IppResponse(json.dumps(r, indent=4, cls=NMOSJSONEncoder),
+    return IppResponse(stream_with_context(_iter_json_array(r, compact_json_requested())),
                        mimetype='application/json',
                        status=status,
                        headers=headers)
@@ -229,7 +481,7 @@ def returns_response(f):
     return decorated_function
 
 
-def returns_json(f):
+def returns_json(f, cache=None, etag=False):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         r = f(*args, **kwargs)
@@ -241,15 +493,18 @@ def returns_json(f):
             if len(r) > 2:
                 headers = r[2]
             r = r[1]
-        if isinstance(r, list):
+        streaming = is_json_stream(r)
+        if isinstance(r, list) or streaming:
             flatfmt = True
         if isinstance(r, dict) or flatfmt:
             try:
                 bm = request.accept_mimetypes.best_match(['application/json', 'text/html', 'rick/roll'])
                 if bm in ['text/html', 'rick/roll']:
-                    return htmlify(r, bm, status=status)
+                    return htmlify(list(r) if streaming else r, bm, status=status)
+                elif streaming:
+                    return jsonify_stream(r, status=status, headers=headers)
                 else:
-                    return jsonify(r, status=status, headers=headers)
+                    return jsonify(r, status=status, headers=headers, cache=cache, etag=etag)
             except TypeError:
                 if status == 200:
                     status = 204
@@ -261,7 +516,7 @@ def returns_json(f):
     return decorated_function
 
 
-def returns_requires_auth(f):
+def returns_requires_auth(f, etag=False):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         r = f(*args, **kwargs)
@@ -294,7 +549,7 @@ def returns_requires_auth(f):
                 if bm in ['text/html', 'rick/roll']:
                     return htmlify(r, bm, status=status)
                 else:
-                    return jsonify(r, status=status, headers=headers)
+                    return jsonify(r, status=status, headers=headers, etag=etag)
             except TypeError:
                 if status == 200:
                     status = 204
@@ -341,6 +596,11 @@ def obj_path_access(f):
         rep = f(*args, **kwargs)
         if request.method == "GET":
             p = [x for x in path.split('/') if x != '']
+            if is_json_stream(rep):
+                if not p:
+                    return rep
+                # Sub-paths can't be streamed, so fall back to the whole collection
+                rep = list(rep)
             for x in p:
                 if isinstance(rep, dict):
                     if x not in rep:
@@ -373,7 +633,7 @@ def obj_path_access(f):
     return decorated_function
 
 
-def secure_route(path, methods=None, auto_json=True, headers=None, origin='*'):
+def secure_route(path, methods=None, auto_json=True, headers=None, origin='*', etag=False):
     if methods is None:
         methods = ['GET', 'HEAD']
     if headers is None:
@@ -386,6 +646,7 @@ def secure_route(path, methods=None, auto_json=True, headers=None, origin='*'):
         func.app_auto_json = auto_json
         func.app_headers = headers
         func.app_origin = origin
+        func.app_etag = etag
         return func
     return annotate_function
 
@@ -398,7 +659,7 @@ def basic_route(path):
     return annotate_function
 
 
-def route(path, methods=None, auto_json=True, headers=None, origin='*'):
+def route(path, methods=None, auto_json=True, headers=None, origin='*', cache=False, etag=False):
     if headers is None:
         headers = []
 
@@ -409,15 +670,19 @@ def route(path, methods=None, auto_json=True, headers=None, origin='*'):
         func.app_auto_json = auto_json
         func.app_headers = headers
         func.app_origin = origin
+        func.app_cache = cache
+        func.app_etag = etag
         return func
     return annotate_function
 
 
-def resource_route(path, methods=None):
+def resource_route(path, methods=None, cache=False, etag=False):
     def annotate_function(func):
         func.common_path = path
         func.app_resource_route = path
         func.app_methods = methods
+        func.app_cache = cache
+        func.app_etag = etag
         return func
     return annotate_function
 
@@ -493,38 +758,108 @@ def grain_event_wrapper(func):
     return wrapper
 
 
-class IppResponse(Response):
-    def __init__(self, response=None, status=None, headers=None, mimetype=None, content_type=None, direct_passthrough=False):
-        headers = CaseInsensitiveDict(headers) if headers is not None else None
-        if response is not None and isinstance(response, BaseResponse) and response.headers is not None:
-            headers = CaseInsensitiveDict(response.headers)
+# Defaults for websockets handled by WebAPI.handle_sock, which may be overridden in the config file
+WEBSOCKET_SEND_QUEUE = 64
+WEBSOCKET_POOL_SIZE = 100
+
+# The number of messages read from a websocket ahead of its handler, beyond which no more are read until it catches up
+WEBSOCKET_RECEIVE_QUEUE = 16
+
+logger = Logger("webapi", None)
+
+
+class WebSocketConnection(object):
+    """A websocket with a bounded queue of outgoing messages, which are sent by a separate greenlet so that a slow
+    client doesn't hold up the code sending to it. When the queue is full the client is treated as a slow consumer:
+    under the "disconnect" policy the websocket is closed, and under the "drop" policy the message is discarded.
+    Other attributes are those of the underlying websocket."""
+    def __init__(self, ws, queue_size=WEBSOCKET_SEND_QUEUE, slow_consumer="disconnect"):
+        self.ws = ws
+        self.slow_consumer = slow_consumer
+        self.dropped = 0
+        self._queue = gevent.queue.Queue(maxsize=queue_size)
+        self._sender = gevent.spawn(self._send_queued)
+
+    def send(self, message):
+        """Queue a message to be sent, returning False if it was discarded"""
+        if self._sender.dead:
+            return False
+        try:
+            self._queue.put_nowait(message)
+        except gevent.queue.Full:
+            self.dropped += 1
+            if self.slow_consumer == "disconnect":
+                logger.writeWarning("Websocket send queue full, disconnecting slow consumer")
+                self.close()
+            return False
+        return True
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def _send_queued(self):
+        while True:
+            message = self._queue.get()
+            try:
+                self.ws.send(message)
+            except Exception:
+                # The websocket has gone away, which the receiving greenlet will also notice
+                return
+
+    def stop(self):
+        """Stop sending queued messages"""
+        self._sender.kill(block=False)
+
+    def close(self):
+        self.stop()
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)
 
-        if headers is None:
-            headers = CaseInsensitiveDict()
 
-        h = headers
-        h['Access-Control-Allow-Origin'] = headers.get('Access-Control-Allow-Origin', '*')
-        h['Access-Control-Allow-Methods'] = headers.get('Access-Control-Allow-Methods', "GET, PUT, POST, HEAD, OPTIONS, DELETE")
-        h['Access-Control-Max-Age'] = headers.get('Access-Control-Max-Age', "21600")
-        h['Cache-Control'] = headers.get('Cache-Control', "no-cache, must-revalidate, no-store")
-        if 'Access-Control-Allow-Headers' not in headers and len(headers.keys()) > 0:
-            h['Access-Control-Allow-Headers'] = ', '.join(iterkeys(headers))
+# Headers added to every IppResponse which doesn't already have them
+IPP_RESPONSE_DEFAULT_HEADERS = (
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Methods', "GET, PUT, POST, HEAD, OPTIONS, DELETE"),
+    ('Access-Control-Max-Age', "21600"),
+    ('Cache-Control', "no-cache, must-revalidate, no-store"),
+)
 
+# The complete headers of an IppResponse constructed without any
+_IPP_RESPONSE_HEADERS = list(IPP_RESPONSE_DEFAULT_HEADERS) + [
+    ('Access-Control-Allow-Headers', ', '.join(header for (header, _) in IPP_RESPONSE_DEFAULT_HEADERS))]
+
+
+def _ipp_response_headers(headers):
+    if headers is None:
+        # Response copies the entries of a list into its own Headers
+        return _IPP_RESPONSE_HEADERS
+
+    h = CaseInsensitiveDict(headers)
+    for (header, value) in IPP_RESPONSE_DEFAULT_HEADERS:
+        h[header] = h.get(header, value)
+    if 'Access-Control-Allow-Headers' not in h:
+        h['Access-Control-Allow-Headers'] = ', '.join(h)
+    return h.items()
+
+
+class IppResponse(Response):
+    def __init__(self, response=None, status=None, headers=None, mimetype=None, content_type=None, direct_passthrough=False):
         data = None
         if response is not None and isinstance(response, string_types):
             data = response
             response = None
 
         if response is not None and isinstance(response, BaseResponse):
-            new_response_headers = CaseInsensitiveDict(response.headers if response.headers is not None else {})
-            new_response_headers.update(h)
-            response.headers = new_response_headers
+            # Only the body of a wrapped response is kept
             headers = None
             data = response.get_data()
-
         else:
-            headers.update(h)
-            headers = dict(headers)
+            headers = _ipp_response_headers(headers)
 
         super(IppResponse, self).__init__(response=response,
                                           status=status,
@@ -596,6 +931,159 @@ def proxied_request(uri, headers=None, data=None, method=None, proxies=None):
         return resp, content
 
 
+# The HTTP error codes which Flask will accept errorhandlers for
+ERROR_CODES = sorted(code for code in default_exceptions if 400 <= code < 600)
+
+# Attributes set by the decorators above which mark a method as something for add_routes to register
+ROUTE_ANNOTATIONS = ("common_path", "socket_path", "errorhandler_args")
+
+# Route discovery results for each class passed to add_routes, shared by all instances and basepaths
+_route_tables = weakref.WeakKeyDictionary()
+
+
+def _getbases(cls):
+    bases = list(cls.__bases__)
+    for x in cls.__bases__:
+        bases += _getbases(x)
+    return bases
+
+
+def _find_routes(obj, attrs):
+    api_paths = []
+    route_attrs = []
+    for attr in attrs:
+        member = getattr(obj, attr, None)
+        if any(hasattr(member, annotation) for annotation in ROUTE_ANNOTATIONS):
+            route_attrs.append(attr)
+            if hasattr(member, "common_path"):
+                api_paths.append(member.common_path)
+    return (api_paths, route_attrs)
+
+
+def get_route_table(cls, routesObject=None):
+    """Return a tuple of the API paths used by a class (for disambiguation of trailing slashes) and the names of
+    its attributes which need registering by add_routes, in registration order. The result is computed once per
+    class, so decorated methods shouldn't be added to a class after it has been instantiated. Properties are only
+    evaluated given an instance of the class, which is then searched instead if it has properties or attributes of
+    its own overriding those of the class."""
+    entry = _route_tables.get(cls)
+    if entry is None:
+        attrs = []
+        for c in [cls, ] + _getbases(cls):
+            for attr in c.__dict__.keys():
+                if attr not in attrs:
+                    attrs.append(attr)
+        properties = set(attr for attr in attrs if isinstance(getattr(cls, attr, None), property))
+        table = _find_routes(cls, [attr for attr in attrs if attr not in properties])
+        entry = (table, attrs, frozenset(attrs), properties)
+        _route_tables[cls] = entry
+    (table, attrs, attr_set, properties) = entry
+    if routesObject is not None:
+        overrides = any(attr in attr_set for attr in getattr(routesObject, "__dict__", ()))
+        if properties or overrides:
+            return _find_routes(routesObject, attrs)
+    return table
+
+
+# Upper bounds in seconds of the request latency histogram buckets (the defaults of the Prometheus client libraries)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class EndpointMetrics(object):
+    """Counters for the requests handled by a single endpoint"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.requests = 0
+        self.statuses = {}
+        self.latency_buckets = [0] * (len(buckets) + 1)
+        self.latency_sum = 0.0
+        self.response_bytes = 0
+
+    def record(self, status, latency, nbytes, buckets=LATENCY_BUCKETS):
+        self.requests += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latency_buckets[bisect_left(buckets, latency)] += 1
+        self.latency_sum += latency
+        self.response_bytes += nbytes
+
+    def stats(self):
+        return {"requests": self.requests,
+                "statuses": dict(self.statuses),
+                "latency_buckets": list(self.latency_buckets),
+                "latency_sum": self.latency_sum,
+                "response_bytes": self.response_bytes}
+
+
+def _prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RouteMetrics(object):
+    """Request counts, status codes, latency histograms and response sizes for each endpoint registered by
+    add_routes. Recording is done without locking, which is safe when serving with gevent (as WebAPI does), but may
+    drop occasional counts when serving from multiple threads."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._endpoints = {}
+
+    def instrument(self, endpoint, f):
+        """Wrap a view function so that each call is recorded against the endpoint"""
+        metrics = self._endpoints.setdefault(endpoint, EndpointMetrics(self.buckets))
+        buckets = self.buckets
+
+        @wraps(f)
+        def instrumented(*args, **kwargs):
+            start = time.time()
+            try:
+                resp = f(*args, **kwargs)
+            except HTTPException as e:
+                metrics.record(e.code or 500, time.time() - start, 0, buckets)
+                raise
+            except Exception:
+                metrics.record(500, time.time() - start, 0, buckets)
+                raise
+            if isinstance(resp, BaseResponse):
+                # Streamed responses have no known length, and are counted as zero bytes
+                body = resp.response
+                nbytes = sum(map(len, body)) if isinstance(body, (list, tuple)) else 0
+                metrics.record(resp.status_code, time.time() - start, nbytes, buckets)
+            else:
+                metrics.record(200, time.time() - start, 0, buckets)
+            return resp
+        return instrumented
+
+    def stats(self, endpoint=None):
+        """Return a dictionary of counters for every endpoint, or for a single endpoint"""
+        if endpoint is not None:
+            return self._endpoints[endpoint].stats()
+        return dict((name, metrics.stats()) for (name, metrics) in self._endpoints.items())
+
+    def reset(self):
+        for endpoint in self._endpoints:
+            self._endpoints[endpoint] = EndpointMetrics(self.buckets)
+
+    def prometheus(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        requests = ["# HELP nmos_http_requests_total Requests handled, by endpoint and status code.",
+                    "# TYPE nmos_http_requests_total counter"]
+        latency = ["# HELP nmos_http_request_duration_seconds Time taken to handle requests.",
+                   "# TYPE nmos_http_request_duration_seconds histogram"]
+        size = ["# HELP nmos_http_response_bytes_total Bytes sent in response bodies of known length.",
+                "# TYPE nmos_http_response_bytes_total counter"]
+        for (endpoint, metrics) in sorted(self._endpoints.items()):
+            label = 'endpoint="{}"'.format(_prometheus_label(endpoint))
+            for (status, count) in sorted(metrics.statuses.items()):
+                requests.append('nmos_http_requests_total{{{},status="{}"}} {}'.format(label, status, count))
+            cumulative = 0
+            for (le, count) in zip(self.buckets + ("+Inf", ), metrics.latency_buckets):
+                cumulative += count
+                latency.append('nmos_http_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                    label, le, cumulative))
+            latency.append('nmos_http_request_duration_seconds_sum{{{}}} {!r}'.format(label, metrics.latency_sum))
+            latency.append('nmos_http_request_duration_seconds_count{{{}}} {}'.format(label, metrics.requests))
+            size.append('nmos_http_response_bytes_total{{{}}} {}'.format(label, metrics.response_bytes))
+        return '\n'.join(requests + latency + size) + '\n'
+
+
 class WebAPI(object):
     def __init__(self, oauth_config=None):
         self.app = Flask(__name__)
@@ -603,7 +1091,10 @@ class WebAPI(object):
         self.app.before_first_request(self.torun)
         self.sockets = Sockets(self.app)
         self.socks = dict()
+        self.websocket_pool = gevent.pool.Pool(_config.get('websocket_pool_size', WEBSOCKET_POOL_SIZE))
         self.port = 0
+        self.response_cache = ResponseCache()
+        self.metrics = RouteMetrics()
 
         # authentication/authorisation
         self._oauth_config = oauth_config
@@ -612,6 +1103,9 @@ class WebAPI(object):
 
         self.add_routes(self, basepath='')
 
+        if _config.get('metrics_route') == 'enabled':
+            self.app.route('/metrics', endpoint='_metrics', methods=["GET", "HEAD"])(self.metrics_response)
+
         # If the `fix_proxy` option is "enabled", interpret it as "use one proxy"
         if _config.get('fix_proxy') == 'enabled':
             if HAS_WERKZEUG_MIDDLEWARE:
@@ -644,145 +1138,135 @@ class WebAPI(object):
                 return f(*args, **kwargs)
             return inner
 
-        def getbases(cls):
-            bases = list(cls.__bases__)
-            for x in cls.__bases__:
-                bases += getbases(x)
-            return bases
-
-        # Populate a list of API paths to be used later for disambiguation
-        api_paths = []
-        for cls in [routesObject.__class__, ] + getbases(routesObject.__class__):
-            for attr in cls.__dict__.keys():
-                routesMethod = getattr(routesObject, attr)
-                if hasattr(routesMethod, "common_path"):
-                    api_paths.append(routesMethod.common_path)
-
-        for cls in [routesObject.__class__, ] + getbases(routesObject.__class__):
-            for attr in cls.__dict__.keys():
-                routesMethod = getattr(routesObject, attr)
-                if callable(routesMethod):
-                    endpoint = "{}_{}".format(basepath.replace('/', '_'), routesMethod.__name__)
-                    if hasattr(routesMethod, 'app_methods') and routesMethod.app_methods is not None:
-                        methods = routesMethod.app_methods
-                    else:
-                        methods = ["GET", "HEAD"]
-                    if hasattr(routesMethod, 'app_headers') and routesMethod.app_headers is not None:
-                        headers = routesMethod.app_headers
-                    else:
-                        headers = []
+        (api_paths, route_attrs) = get_route_table(routesObject.__class__, routesObject)
+
+        for attr in route_attrs:
+            routesMethod = getattr(routesObject, attr)
+            if callable(routesMethod):
+                endpoint = "{}_{}".format(basepath.replace('/', '_'), routesMethod.__name__)
+                if hasattr(routesMethod, 'app_methods') and routesMethod.app_methods is not None:
+                    methods = routesMethod.app_methods
+                else:
+                    methods = ["GET", "HEAD"]
+                if hasattr(routesMethod, 'app_headers') and routesMethod.app_headers is not None:
+                    headers = routesMethod.app_headers
+                else:
+                    headers = []
 
-                    crossdomain_methods = []
-                    if hasattr(routesMethod, "common_path"):
-                        stripped_path = routesMethod.common_path.rstrip("/")
-                        trailing_slash = routesMethod.common_path.endswith("/")
-                        if trailing_slash and stripped_path not in api_paths or not trailing_slash:
-                            crossdomain_methods = ["OPTIONS", ]
+                route_cache = self.response_cache if getattr(routesMethod, 'app_cache', False) else None
+                route_etag = getattr(routesMethod, 'app_etag', False)
 
-                    if hasattr(routesMethod, "secure_route"):
+                crossdomain_methods = []
+                if hasattr(routesMethod, "common_path"):
+                    stripped_path = routesMethod.common_path.rstrip("/")
+                    trailing_slash = routesMethod.common_path.endswith("/")
+                    if trailing_slash and stripped_path not in api_paths or not trailing_slash:
+                        crossdomain_methods = ["OPTIONS", ]
+
+                if hasattr(routesMethod, "secure_route"):
+                    self.app.route(
+                        basepath + routesMethod.secure_route,
+                        endpoint=endpoint,
+                        methods=methods + crossdomain_methods)(
+                            self.metrics.instrument(endpoint, crossdomain(
+                                origin=routesMethod.app_origin,
+                                methods=methods,
+                                headers=headers + ['Content-Type', 'Authorization', 'token', ])(
+                                    returns_requires_auth(routesMethod, etag=route_etag))))
+
+                elif hasattr(routesMethod, "response_route"):
+                    self.app.route(
+                        basepath + routesMethod.response_route,
+                        endpoint=endpoint,
+                        methods=["GET", "POST", "HEAD"] + crossdomain_methods)(
+                            self.metrics.instrument(endpoint, crossdomain(
+                                origin='*',
+                                methods=['GET', 'POST', 'HEAD'],
+                                headers=['Content-Type', 'Authorization', ])(
+                                    returns_response(routesMethod))))
+
+                elif hasattr(routesMethod, "app_route"):
+                    if routesMethod.app_auto_json:
                         self.app.route(
-                            basepath + routesMethod.secure_route,
+                            basepath + routesMethod.app_route,
                             endpoint=endpoint,
                             methods=methods + crossdomain_methods)(
-                                crossdomain(
+                                self.metrics.instrument(endpoint, crossdomain(
                                     origin=routesMethod.app_origin,
                                     methods=methods,
-                                    headers=headers + ['Content-Type', 'Authorization', 'token', ])(
-                                        returns_requires_auth(routesMethod)))
-
-                    elif hasattr(routesMethod, "response_route"):
-                        self.app.route(
-                            basepath + routesMethod.response_route,
-                            endpoint=endpoint,
-                            methods=["GET", "POST", "HEAD"] + crossdomain_methods)(
-                                crossdomain(
-                                    origin='*',
-                                    methods=['GET', 'POST', 'HEAD'],
-                                    headers=['Content-Type', 'Authorization', ])(
-                                        returns_response(routesMethod)))
-
-                    elif hasattr(routesMethod, "app_route"):
-                        if routesMethod.app_auto_json:
-                            self.app.route(
-                                basepath + routesMethod.app_route,
-                                endpoint=endpoint,
-                                methods=methods + crossdomain_methods)(
-                                    crossdomain(
-                                        origin=routesMethod.app_origin,
-                                        methods=methods,
-                                        headers=headers + ['Content-Type', 'Authorization', ])(
-                                            returns_json(routesMethod)))
-                        else:
-                            self.app.route(
-                                basepath + routesMethod.app_route,
-                                endpoint=endpoint,
-                                methods=methods + crossdomain_methods)(
-                                    crossdomain(
-                                        origin=routesMethod.app_origin,
-                                        methods=methods,
-                                        headers=headers + ['Content-Type', 'Authorization', ])(
-                                            dummy(routesMethod)))
-
-                    elif hasattr(routesMethod, "app_file_route"):
+                                    headers=headers + ['Content-Type', 'Authorization', ])(
+                                        returns_json(routesMethod, cache=route_cache, etag=route_etag))))
+                    else:
                         self.app.route(
-                            basepath + routesMethod.app_file_route,
+                            basepath + routesMethod.app_route,
                             endpoint=endpoint,
                             methods=methods + crossdomain_methods)(
-                                crossdomain(
-                                    origin='*',
+                                self.metrics.instrument(endpoint, crossdomain(
+                                    origin=routesMethod.app_origin,
                                     methods=methods,
                                     headers=headers + ['Content-Type', 'Authorization', ])(
-                                        returns_file(routesMethod)))
-
-                    elif hasattr(routesMethod, "app_resource_route"):
-                        f = crossdomain(origin='*',
-                                        methods=methods,
-                                        headers=headers + ['Content-Type', 'Authorization', 'api-key', ])(
-                                            returns_json(obj_path_access(routesMethod)))
-                        self.app.route(
-                            basepath + routesMethod.app_resource_route,
-                            methods=methods + crossdomain_methods,
-                            endpoint=endpoint)(f)
-                        f.__name__ = endpoint + '_path'
-                        self.app.route(
-                            basepath + routesMethod.app_resource_route + '<path:path>/',
-                            methods=methods + crossdomain_methods,
-                            endpoint=f.__name__)(f)
-
-                    elif hasattr(routesMethod, "socket_path"):
-                        websocket_opened = getattr(routesObject, "on_websocket_connect", None)
-                        if websocket_opened is None:
-                            self.sockets.route(
-                                basepath + routesMethod.socket_path,
-                                endpoint=endpoint)(
-                                    self.handle_sock(
-                                        expects_json(routesMethod), self.socks))
-                        else:
-                            self.sockets.route(
-                                basepath + routesMethod.socket_path,
-                                endpoint=endpoint)(
-                                    websocket_opened(
-                                        expects_json(routesMethod)))
-
-                    elif hasattr(routesMethod, "errorhandler_args"):
-                        if routesMethod.errorhandler_args:
-                            self.app.errorhandler(
-                                *routesMethod.errorhandler_args,
-                                **routesMethod.errorhandler_kwargs)(
-                                    crossdomain(
-                                        origin='*',
-                                        methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD"])(
-                                            dummy(routesMethod)))
-                        else:
-                            for n in range(400, 600):
-                                try:  # Apply errorhandlers for all known error codes
-                                    self.app.errorhandler(n)(crossdomain(
-                                        origin='*',
-                                        methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD"])(
-                                            dummy(routesMethod)))
-                                except KeyError:
-                                    # Some error codes aren't valid
-                                    pass
+                                        dummy(routesMethod))))
+
+                elif hasattr(routesMethod, "app_file_route"):
+                    self.app.route(
+                        basepath + routesMethod.app_file_route,
+                        endpoint=endpoint,
+                        methods=methods + crossdomain_methods)(
+                            self.metrics.instrument(endpoint, crossdomain(
+                                origin='*',
+                                methods=methods,
+                                headers=headers + ['Content-Type', 'Authorization', ])(
+                                    returns_file(routesMethod))))
+
+                elif hasattr(routesMethod, "app_resource_route"):
+                    # Requests for paths within the resource are recorded against the resource's endpoint
+                    f = self.metrics.instrument(endpoint, crossdomain(
+                        origin='*',
+                        methods=methods,
+                        headers=headers + ['Content-Type', 'Authorization', 'api-key', ])(
+                            returns_json(obj_path_access(routesMethod), cache=route_cache, etag=route_etag)))
+                    self.app.route(
+                        basepath + routesMethod.app_resource_route,
+                        methods=methods + crossdomain_methods,
+                        endpoint=endpoint)(f)
+                    f.__name__ = endpoint + '_path'
+                    self.app.route(
+                        basepath + routesMethod.app_resource_route + '<path:path>/',
+                        methods=methods + crossdomain_methods,
+                        endpoint=f.__name__)(f)
+
+                elif hasattr(routesMethod, "socket_path"):
+                    websocket_opened = getattr(routesObject, "on_websocket_connect", None)
+                    if websocket_opened is None:
+                        self.sockets.route(
+                            basepath + routesMethod.socket_path,
+                            endpoint=endpoint)(
+                                self.handle_sock(
+                                    expects_json(routesMethod), self.socks))
+                    else:
+                        self.sockets.route(
+                            basepath + routesMethod.socket_path,
+                            endpoint=endpoint)(
+                                websocket_opened(
+                                    expects_json(routesMethod)))
+
+                elif hasattr(routesMethod, "errorhandler_args"):
+                    if routesMethod.errorhandler_args:
+                        self.app.errorhandler(
+                            *routesMethod.errorhandler_args,
+                            **routesMethod.errorhandler_kwargs)(
+                                crossdomain(
+                                    origin='*',
+                                    methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD"])(
+                                        dummy(routesMethod)))
+                    else:
+                        # Apply the same errorhandler for all known error codes
+                        handler = crossdomain(
+                            origin='*',
+                            methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD"])(
+                                dummy(routesMethod))
+                        for n in ERROR_CODES:
+                            self.app.errorhandler(n)(handler)
 
     @errorhandler()
     def error(self, e):
@@ -840,6 +1324,9 @@ class WebAPI(object):
             }
             return IppResponse(json.dumps(response), status=status_code, mimetype='application/json', headers=headers)
 
+    def metrics_response(self):
+        return IppResponse(self.metrics.prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
     def torun(self):  # pragma: no cover
         pass
 
@@ -850,7 +1337,29 @@ class WebAPI(object):
         @wraps(func)
         def inner_func(ws, **kwds):
             sock_uuid = uuid.uuid4()
-            socks[sock_uuid] = ws
+            conn = WebSocketConnection(ws,
+                                       queue_size=_config.get('websocket_send_queue', WEBSOCKET_SEND_QUEUE),
+                                       slow_consumer=_config.get('websocket_slow_consumer', "disconnect"))
+            socks[sock_uuid] = conn
+            # Messages are handled in order, by a worker in the shared pool which runs while any are waiting. When
+            # the pool or the queue of messages waiting is full, no more is read from the client until it catches up.
+            received = gevent.queue.Queue(maxsize=WEBSOCKET_RECEIVE_QUEUE)
+            worker = None
+
+            def handle_received():
+                while True:
+                    try:
+                        message = received.get_nowait()
+                    except gevent.queue.Empty:
+                        return
+                    try:
+                        func(conn, message, **kwds)
+                    except Exception:
+                        # As when messages were handled by the receiving greenlet, an error ends the connection
+                        logger.writeError("Error handling websocket message: {}".format(traceback.format_exc()))
+                        conn.close()
+                        return
+
             print("Opening Websocket {} at path /, Receiving ...".format(sock_uuid))
             while True:
                 try:
@@ -859,14 +1368,34 @@ class WebAPI(object):
                     message = None
 
                 if message is not None:
-                    func(ws, message, **kwds)
+                    received.put(message)
+                    if worker is None or worker.dead:
+                        worker = self.websocket_pool.spawn(handle_received)
                     continue
                 else:
+                    if worker is not None:
+                        worker.join()
+                    conn.stop()
                     print("Websocket {} closed".format(sock_uuid))
                     del socks[sock_uuid]
                     break
         return inner_func
 
+    def broadcast(self, message):
+        """Send a message to every websocket in self.socks, without waiting for slow clients. Messages which aren't
+        already strings are serialised to JSON once for all of the websockets. Returns the number of websockets the
+        message was sent or queued for."""
+        if not isinstance(message, (string_types, bytes)):
+            message = json.dumps(message, cls=NMOSJSONEncoder)
+        count = 0
+        for sock in list(self.socks.values()):
+            try:
+                if sock.send(message) is not False:
+                    count += 1
+            except Exception:
+                pass
+        return count
+
     def default_authorize(self, token):
         if self._oauth_config is not None:
             # Ensure the user is permitted to use function
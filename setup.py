@@ -20,6 +20,7 @@ import setuptools
 import os
 import sys
 import json
+from setuptools.command.build_py import build_py
 from setuptools.command.develop import develop
 from setuptools.command.install import install
 
@@ -37,6 +38,12 @@ def create_default_conf():
         "prefer_hostnames": False,
         "node_hostname": None,
         "fix_proxy": "disabled",
+        "compact_json": "disabled",
+        "html_highlight_limit": 262144,
+        "metrics_route": "disabled",
+        "websocket_send_queue": 64,
+        "websocket_slow_consumer": "disconnect",
+        "websocket_pool_size": 100,
         "logging": {
             "level": "DEBUG",
             "fileLocation": "/var/log/nmos.log",
@@ -91,6 +98,21 @@ class PostInstallCommand(install):
         create_default_conf()
 
 
+# Modules using syntax which Python 2 can't parse, so are left out when building for it
+PY3_ONLY_MODULES = [
+    ("nmoscommon", "asyncaggregator")
+]
+
+
+class BuildPyCommand(build_py):
+    """Leave Python 3 only modules out of Python 2 builds, which would otherwise fail to byte-compile them."""
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info[0] < 3:
+            modules = [module for module in modules if module[:2] not in PY3_ONLY_MODULES]
+        return modules
+
+
 def is_package(path):
     return (
         os.path.isdir(path) and
@@ -182,7 +204,7 @@ deps_required = []
 
 setup(
     name="nmoscommon",
-    version="0.20.1",
+    version="0.21.0",
     description="Common components for the BBC's NMOS implementations",
     url='https://github.com/bbc/nmos-common',
     author='Peter Brightwell',
@@ -196,6 +218,7 @@ setup(
     data_files=[],
     long_description="Common components for the BBC's NMOS implementations",
     cmdclass={
+        'build_py': BuildPyCommand,
         'develop': PostDevelopCommand,
         'install': PostInstallCommand,
     }
@@ -0,0 +1,272 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests of AsyncAggregator, which are imported by test_asyncaggregator on Python 3 only, as they use syntax Python 2
+# can't parse
+
+import asyncio
+import json
+import unittest
+import mock
+
+from nmoscommon.asyncaggregator import AsyncAggregator, PipelinedHTTPClient
+from nmoscommon.aggregator import AGGREGATOR_APIVERSION
+
+
+class StubRegistry(object):
+    """A Registration API which records the requests it receives, optionally holding back its responses. A request
+    for /drop closes the connection without a response, and one for /twice is answered twice."""
+    def __init__(self):
+        self.requests = []
+        self.connections = 0
+        self.resources = {}
+        self.delay = 0
+        self.chunked = False
+        self.interim = False
+        self.server = None
+        self.handlers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.href = "http://127.0.0.1:{}".format(self.server.sockets[0].getsockname()[1])
+
+    async def stop(self):
+        self.server.close()
+        for handler in self.handlers:
+            handler.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                (method, path, _) = request_line.decode().split(" ")
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line == b"\r\n":
+                        break
+                    (name, _, value) = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = path.split("/x-nmos/registration/{}".format(AGGREGATOR_APIVERSION))[-1]
+                self.requests.append((method, path))
+                (status, content) = self.respond(method, path, json.loads(body.decode()) if body else None)
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                if path == "/drop":
+                    break
+                if self.interim:
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                self._write(writer, status, content)
+                if path == "/twice":
+                    self._write(writer, status, content)
+        finally:
+            writer.close()
+
+    def _write(self, writer, status, content):
+        lines = ["HTTP/1.1 {} OK".format(status)]
+        if content is None:
+            lines.append("")
+            writer.write(("\r\n".join(lines) + "\r\n").encode())
+            return
+        content = json.dumps(content).encode()
+        lines.append("Content-Type: application/json")
+        if self.chunked:
+            lines.append("Transfer-Encoding: chunked")
+            body = b"".join(b"%x\r\n%s\r\n" % (len(content[n:n + 4]), content[n:n + 4])
+                            for n in range(0, len(content), 4)) + b"0\r\n\r\n"
+        else:
+            lines.append("Content-Length: {}".format(len(content)))
+            body = content
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+
+    def respond(self, method, path, data):
+        if method == "POST" and path == "/resource":
+            self.resources[data["data"]["id"]] = data
+            return (201, data)
+        elif method == "POST" and path.startswith("/health/nodes/"):
+            return (200, {"health": 0}) if path.split("/")[-1] in self.resources else (404, {"code": 404})
+        elif method == "DELETE":
+            return (204, None) if self.resources.pop(path.split("/")[-1], None) else (404, {"code": 404})
+        return (200, {"path": path})
+
+
+class TestAsyncAggregator(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.registry = StubRegistry()
+        self.run_async(self.registry.start())
+        self.addCleanup(self.run_async, self.registry.stop())
+        patcher = mock.patch('nmoscommon.asyncaggregator.Logger')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_requests_are_pipelined(self):
+        async def requests(client):
+            responses = await asyncio.gather(*[client.request("GET", "/{}".format(n)) for n in range(8)])
+            await client.close()
+            return responses
+
+        self.registry.delay = 0.01
+        self.registry.chunked = True
+        client = PipelinedHTTPClient(self.registry.href, connections=2, pipeline_depth=4)
+        responses = self.run_async(requests(client))
+
+        self.assertEqual([response.json()["path"] for response in responses], ["/{}".format(n) for n in range(8)])
+        self.assertEqual(self.registry.connections, 2)
+
+    def test_timeout_closes_connection(self):
+        async def requests(client):
+            self.registry.delay = 0.05
+            with self.assertRaises(asyncio.TimeoutError):
+                await client.request("GET", "/slow")
+            self.registry.delay = 0
+            response = await client.request("GET", "/fast")
+            await client.close()
+            return response
+
+        client = PipelinedHTTPClient(self.registry.href, connections=1, timeout=0.02)
+        self.assertEqual(self.run_async(requests(client)).json(), {"path": "/fast"})
+        self.assertEqual(self.registry.connections, 2)
+
+    def test_only_idempotent_requests_are_pipelined(self):
+        async def requests(client, method):
+            depths = []
+
+            async def sample():
+                while True:
+                    depths.append(max([len(connection) for connection in client._connections] or [0]))
+                    await asyncio.sleep(0.001)
+
+            sampler = asyncio.ensure_future(sample())
+            responses = await asyncio.gather(*[client.request(method, "/{}".format(n)) for n in range(4)])
+            sampler.cancel()
+            await client.close()
+            return ([response.status_code for response in responses], max(depths))
+
+        self.registry.delay = 0.01
+        posts = self.run_async(requests(PipelinedHTTPClient(self.registry.href, connections=1, pipeline_depth=4),
+                                        "POST"))
+        gets = self.run_async(requests(PipelinedHTTPClient(self.registry.href, connections=1, pipeline_depth=4),
+                                       "GET"))
+
+        self.assertEqual(posts, ([200] * 4, 1))
+        self.assertEqual(gets, ([200] * 4, 4))
+
+    def test_interim_responses_are_skipped(self):
+        async def requests(client):
+            responses = await asyncio.gather(*[client.request("GET", "/{}".format(n)) for n in range(3)])
+            await client.close()
+            return responses
+
+        self.registry.interim = True
+        client = PipelinedHTTPClient(self.registry.href, connections=1)
+        responses = self.run_async(requests(client))
+
+        self.assertEqual([response.json()["path"] for response in responses], ["/{}".format(n) for n in range(3)])
+
+    def test_failed_connection_fails_waiting_requests(self):
+        async def requests(client):
+            dropped = await asyncio.gather(client.request("GET", "/drop"), client.request("GET", "/after"),
+                                           return_exceptions=True)
+            response = await client.request("GET", "/twice")
+            await asyncio.sleep(0.01)
+            unsolicited = [connection.closed for connection in client._connections]
+            response = await client.request("GET", "/fast")
+            await client.close()
+            return (dropped, unsolicited, response)
+
+        client = PipelinedHTTPClient(self.registry.href, connections=1)
+        (dropped, unsolicited, response) = self.run_async(requests(client))
+
+        self.assertEqual([type(result) for result in dropped], [ConnectionError, ConnectionError])
+        self.assertEqual(unsolicited, [True])
+        self.assertEqual(response.json(), {"path": "/fast"})
+        self.assertEqual(self.registry.connections, 3)
+
+    def test_register_and_unregister(self):
+        async def lifecycle():
+            async with AsyncAggregator(api_href=self.registry.href, heartbeat_interval=0.05) as UUT:
+                UUT.register("node", "node_0", label="node")
+                for n in range(3):
+                    UUT.register("device", "device_{}".format(n), node_id="node_0")
+                UUT.register("flow", "flow_0")
+                await asyncio.sleep(0.1)
+                status = UUT.status()
+                UUT.unregister("flow", "flow_0")
+                UUT.unregister("node", "node_0")
+            return status
+
+        status = self.run_async(lifecycle())
+
+        self.assertEqual(status, {"api_href": self.registry.href, "api_version": AGGREGATOR_APIVERSION,
+                                  "registered": True})
+        requests = self.registry.requests
+        self.assertEqual(requests[:3], [("DELETE", "/resource/nodes/node_0"), ("POST", "/resource"),
+                                        ("POST", "/health/nodes/node_0")])
+        self.assertEqual(requests[3:7], [("POST", "/resource")] * 4)
+        self.assertIn(("POST", "/health/nodes/node_0"), requests[7:])
+        self.assertEqual(requests[-2:], [("DELETE", "/resource/flows/flow_0"), ("DELETE", "/resource/nodes/node_0")])
+
+    def test_heartbeat_404_reregisters(self):
+        async def lifecycle():
+            async with AsyncAggregator(api_href=self.registry.href, heartbeat_interval=0.05) as UUT:
+                UUT.register("node", "node_0")
+                UUT.register("device", "device_0")
+                await asyncio.sleep(0.03)
+                self.registry.resources.clear()
+                await asyncio.sleep(0.1)
+                return set(self.registry.resources)
+
+        self.assertEqual(self.run_async(lifecycle()), {"node_0", "device_0"})
+        self.assertGreaterEqual(self.registry.requests.count(("DELETE", "/resource/nodes/node_0")), 2)
+
+    def test_heartbeats_continue_during_replay(self):
+        UUT = AsyncAggregator(api_href=self.registry.href, heartbeat_interval=0.02)
+        heartbeats = []
+
+        async def _SEND(method, url, data=None):
+            if url.startswith("/health/nodes/") and UUT._reregistering:
+                heartbeats.append(url)
+            elif data and data["type"] == "device":
+                await asyncio.sleep(0.2)
+
+        async def lifecycle():
+            async with UUT:
+                UUT.register("node", "node_0")
+                UUT.register("device", "device_0")
+                await asyncio.sleep(0.1)
+                replaying = UUT._reregistering
+                await asyncio.sleep(0.2)
+            return replaying
+
+        with mock.patch.object(UUT, "_SEND", side_effect=_SEND):
+            self.assertTrue(self.run_async(lifecycle()))
+
+        self.assertGreaterEqual(len(heartbeats), 2)
+        self.assertFalse(UUT._reregistering)
+
+
+if __name__ == "__main__":
+    unittest.main()
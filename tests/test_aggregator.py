@@ -0,0 +1,754 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+from six import PY2
+
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+import gevent
+from nmoscommon.aggregator import *
+
+
+class TestHeartbeatScheduler(unittest.TestCase):
+    def test_heartbeats_are_called_when_due(self):
+        UUT = HeartbeatScheduler()
+        calls = []
+
+        def heartbeat(name, delay, count):
+            def _heartbeat():
+                calls.append(name)
+                if calls.count(name) < count:
+                    return delay
+            return _heartbeat
+
+        UUT.add(heartbeat("fast", 0.02, 3))
+        UUT.add(heartbeat("slow", 0.05, 2), 0.01)
+        self.assertEqual(len(UUT), 2)
+        gevent.sleep(0.15)
+
+        self.assertEqual(calls, ["fast", "slow", "fast", "fast", "slow"])
+        self.assertEqual(len(UUT), 0)
+
+    def test_remove_stops_heartbeat(self):
+        UUT = HeartbeatScheduler()
+        heartbeat = mock.MagicMock(return_value=0.01)
+        UUT.add(heartbeat)
+        gevent.sleep(0.015)
+        UUT.remove(heartbeat)
+        count = heartbeat.call_count
+        gevent.sleep(0.03)
+
+        self.assertEqual(heartbeat.call_count, count)
+        self.assertGreaterEqual(count, 2)
+        self.assertEqual(len(UUT), 0)
+
+    def test_heartbeat_due_whilst_in_progress_waits_for_it(self):
+        UUT = HeartbeatScheduler()
+        calls = []
+
+        def heartbeat():
+            calls.append("start")
+            gevent.sleep(0.02)
+            calls.append("end")
+            return 0.01 if len(calls) < 6 else None
+
+        UUT.add(heartbeat)
+        gevent.sleep(0.01)
+        # Brought forward whilst in progress, as when an Aggregator is given its Node
+        UUT.add(heartbeat)
+        gevent.sleep(0.1)
+
+        self.assertEqual(calls, ["start", "end"] * 3)
+        self.assertEqual(len(UUT), 0)
+
+    def test_add_brings_heartbeat_forward(self):
+        UUT = HeartbeatScheduler()
+        heartbeat = mock.MagicMock(return_value=None)
+        UUT.add(heartbeat, 10)
+        UUT.add(heartbeat)
+        gevent.sleep(0.01)
+        heartbeat.assert_called_once_with()
+        self.assertEqual(len(UUT), 0)
+
+
+class TestRegistrationQueue(unittest.TestCase):
+    def pending(self, queue):
+        items = []
+        while not queue.empty():
+            item = queue.get()
+            items.append((item["method"], item["key"]))
+        return items
+
+    def test_repeated_requests_keep_their_place(self):
+        UUT = RegistrationQueue()
+        UUT.put("POST", "resource", "device", "d0")
+        UUT.put("POST", "resource", "flow", "f0")
+        UUT.put("POST", "resource", "device", "d0")
+        UUT.put("DELETE", "resource", "sender", "s0")
+        UUT.put("DELETE", "resource", "sender", "s0")
+
+        self.assertEqual(UUT.stats(), {"pending": 3, "coalesced": 2, "replaced": 0, "cancelled": 0})
+        self.assertEqual(self.pending(UUT), [("POST", "d0"), ("POST", "f0"), ("DELETE", "s0")])
+
+    def test_changed_requests_move_to_the_back(self):
+        UUT = RegistrationQueue()
+        UUT.put("POST", "resource", "device", "d0")
+        UUT.put("POST", "resource", "sender", "s0")
+        UUT.put("DELETE", "resource", "sender", "s0")
+        UUT.put("DELETE", "resource", "device", "d0")
+        UUT.put("DELETE", "resource", "flow", "f0")
+        UUT.put("POST", "resource", "flow", "f0")
+
+        self.assertEqual(UUT.stats(), {"pending": 3, "coalesced": 0, "replaced": 3, "cancelled": 0})
+        self.assertEqual(self.pending(UUT), [("DELETE", "s0"), ("DELETE", "d0"), ("POST", "f0")])
+
+    def test_delete_cancels_post_of_new_resource(self):
+        UUT = RegistrationQueue()
+        UUT.put("POST", "resource", "device", "d0", new=True)
+        UUT.put("POST", "resource", "device", "d0")
+        UUT.put("DELETE", "resource", "device", "d0")
+
+        self.assertEqual(UUT.stats(), {"pending": 0, "coalesced": 1, "replaced": 0, "cancelled": 1})
+        self.assertRaises(KeyError, UUT.get)
+
+
+class TestRegistryPool(unittest.TestCase):
+    def make_pool(self, registries, **kwargs):
+        discover = mock.MagicMock(return_value=registries)
+        return RegistryPool(discover, **kwargs)
+
+    def test_select_prefers_priority_then_health(self):
+        UUT = self.make_pool([("http://a", 20), ("http://b", 10), ("http://c", 10)])
+        self.assertIn(UUT.select(), ["http://b", "http://c"])
+        UUT.record_success("http://b", 0.05)
+        UUT.record_success("http://c", 0.01)
+        UUT.record_success("http://a", 0.001)
+        self.assertEqual(UUT.ranked(), ["http://c", "http://b", "http://a"])
+
+        UUT.record_failure("http://c")
+        self.assertEqual(UUT.select(), "http://b")
+        self.assertEqual(UUT.select(exclude=["http://b"]), "http://c")
+        self.assertEqual(UUT.select(exclude=["http://a", "http://b", "http://c"]), "http://b")
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        UUT = self.make_pool([("http://a", 10), ("http://b", 20)], failure_threshold=2, circuit_timeout=0.02)
+        UUT.refresh()
+        for _ in range(2):
+            self.assertEqual(UUT.select(), "http://a")
+            UUT.record_failure("http://a")
+        self.assertTrue(UUT.stats()["http://a"]["circuit_open"])
+        self.assertEqual(UUT.select(), "http://b")
+
+        gevent.sleep(0.03)
+        self.assertEqual(UUT.select(), "http://a")
+        UUT.record_failure("http://a")
+        self.assertEqual(UUT.select(), "http://b")
+
+    def test_refresh_keeps_scores_of_known_registries(self):
+        UUT = self.make_pool([("http://a", 10)], refresh_interval=0)
+        UUT.select()
+        UUT.record_success("http://a", 0.1)
+        UUT._discover.return_value = [("http://a", 30), ("http://b", 20)]
+        self.assertEqual(UUT.select(), "http://b")
+        self.assertEqual(UUT.stats()["http://a"]["latency"], 0.1)
+        self.assertEqual(UUT.stats()["http://a"]["priority"], 30)
+
+
+class TestRegistrationJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "journal")
+
+    def resource(self, res_type, key, version="1"):
+        return {"type": res_type, "data": {"id": key, "version": version}}
+
+    def test_records_are_loaded_after_restart(self):
+        UUT = RegistrationJournal(self.path, fsync="never")
+        self.assertEqual(UUT.load(), {"node": None, "entities": {"resource": {}}, "acked": {}})
+        UUT.register("resource", "node", "node", self.resource("node", "node"))
+        UUT.register("resource", "device", "d0", self.resource("device", "d0"))
+        UUT.register("resource", "device", "d1", self.resource("device", "d1"))
+        UUT.ack("resource", "device", "d0", "1")
+        UUT.ack("resource", "device", "d1", "1")
+        UUT.unregister("resource", "device", "d1")
+        UUT.ack("resource", "device", "d1", None)
+        UUT.close()
+        with open(self.path, "a") as f:
+            f.write('{"op": "register", "namesp')
+
+        UUT = RegistrationJournal(self.path)
+        loaded = UUT.load()
+        UUT.close()
+        self.assertEqual(loaded["node"], self.resource("node", "node"))
+        self.assertEqual(loaded["entities"], {"resource": {"device": {"d0": self.resource("device", "d0")}}})
+        self.assertEqual(loaded["acked"], {("resource", "device", "d0"): "1"})
+
+    def test_records_appended_after_a_crash_are_loaded(self):
+        UUT = RegistrationJournal(self.path, fsync="never")
+        UUT.load()
+        UUT.register("resource", "device", "d0", self.resource("device", "d0"))
+        UUT.close()
+        with open(self.path, "a") as f:
+            f.write('{"op": "register", "namesp')
+
+        UUT = RegistrationJournal(self.path, fsync="never")
+        UUT.load()
+        UUT.register("resource", "device", "d1", self.resource("device", "d1"))
+        UUT.close()
+
+        UUT = RegistrationJournal(self.path, fsync="never")
+        loaded = UUT.load()
+        UUT.close()
+        self.assertEqual(loaded["entities"], {"resource": {"device": {"d0": self.resource("device", "d0"),
+                                                                      "d1": self.resource("device", "d1")}}})
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_records_are_written_in_batches(self):
+        UUT = RegistrationJournal(self.path, flush_interval=0.01)
+        UUT.load()
+        with mock.patch('os.fsync') as fsync:
+            for n in range(10):
+                UUT.register("resource", "device", "d{}".format(n), self.resource("device", "d{}".format(n)))
+            self.assertEqual(os.path.getsize(self.path), 0)
+            gevent.sleep(0.02)
+            self.assertEqual(fsync.call_count, 1)
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 10)
+        UUT.close()
+
+    def test_always_syncs_each_record(self):
+        UUT = RegistrationJournal(self.path, fsync="always")
+        UUT.load()
+        with mock.patch('os.fsync') as fsync:
+            UUT.register("resource", "device", "d0", self.resource("device", "d0"))
+            UUT.ack("resource", "device", "d0", "1")
+            self.assertEqual(fsync.call_count, 2)
+        UUT.close()
+        self.assertRaises(ValueError, RegistrationJournal, self.path, fsync="sometimes")
+
+    def test_journal_is_compacted(self):
+        UUT = RegistrationJournal(self.path, fsync="never", compact_ratio=2, compact_min=10)
+        UUT.load()
+        for n in range(20):
+            UUT.register("resource", "device", "d0", self.resource("device", "d0", str(n)))
+            UUT.ack("resource", "device", "d0", str(n))
+        UUT.flush()
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        UUT.close()
+        UUT = RegistrationJournal(self.path)
+        loaded = UUT.load()
+        UUT.close()
+        self.assertEqual(loaded["entities"]["resource"]["device"]["d0"]["data"]["version"], "19")
+        self.assertEqual(loaded["acked"], {("resource", "device", "d0"): "19"})
+
+
+class TestAggregator(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestAggregator, self).__init__(*args, **kwargs)
+        if PY2:
+            self.assertCountEqual = self.assertItemsEqual
+
+    def setUp(self):
+        paths = ['nmoscommon.aggregator.Logger',
+                 'nmoscommon.aggregator.IppmDNSBridge', ]
+        for path in paths:
+            patcher = mock.patch(path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_aggregator(self, **kwargs):
+        # The background greenlets aren't started, so that tests can drive the methods they call directly
+        with mock.patch('gevent.spawn'):
+            UUT = Aggregator(**kwargs)
+        UUT.aggregator = "http://example.com"
+        return UUT
+
+    def reregister(self, UUT):
+        # Re-register, waiting for any replay of the local mirror to finish
+        UUT._process_reregister()
+        if UUT._replay_thread is not None:
+            UUT._replay_thread.join()
+
+    def register_resources(self, UUT, counts):
+        UUT._registered["node"] = {"type": "node", "data": {"id": "node"}}
+        UUT._registered["registered"] = True
+        for (res_type, count) in counts:
+            for n in range(count):
+                UUT.register(res_type, "{}_{}".format(res_type, n))
+
+    def test_batch_stages_follow_registration_order(self):
+        UUT = self.make_aggregator()
+        self.register_resources(UUT, [("device", 2), ("source", 2), ("flow", 2), ("sender", 2), ("receiver", 2)])
+        batch = [UUT._reg_queue.get() for _ in range(10)]
+
+        stages = UUT._batch_stages(batch)
+        self.assertEqual([[item["key"] for item in stage] for stage in stages],
+                         [["device_0", "device_1"], ["source_0", "source_1"], ["flow_0", "flow_1"],
+                          ["sender_0", "sender_1"], ["receiver_0", "receiver_1"]])
+
+    def test_batch_stages_keep_dependencies_and_repeated_keys_apart(self):
+        UUT = self.make_aggregator()
+        item = lambda method, res_type, key: {"method": method, "namespace": "resource", "res_type": res_type,
+                                              "key": key}
+        batch = [item("POST", "flow", "f0"),
+                 item("POST", "source", "s1"),  # Flows queued earlier can't depend on a later source
+                 item("POST", "flow", "f1"),  # ...but this one may
+                 item("POST", "flow", "f1"),
+                 item("DELETE", "sender", "x0"),
+                 item("DELETE", "device", "d0"),  # May be the parent of the sender queued before it
+                 item("DELETE", "sender", "x1"),
+                 item("POST", "node", "node"),
+                 item("POST", "device", "d1")]
+
+        stages = UUT._batch_stages(batch)
+        self.assertEqual([[(i["method"], i["key"]) for i in stage] for stage in stages],
+                         [[("POST", "f0"), ("POST", "s1")],
+                          [("POST", "f1")],
+                          [("POST", "f1")],
+                          [("DELETE", "x0")],
+                          [("DELETE", "d0"), ("DELETE", "x1")],
+                          [("POST", "node")],
+                          [("POST", "d1")]])
+
+    def test_process_queue_sends_stages_concurrently_in_order(self):
+        UUT = self.make_aggregator(concurrency=4)
+        self.register_resources(UUT, [("device", 3), ("source", 3), ("flow", 3)])
+        UUT._running = False
+
+        sent = []
+        in_flight = [0, 0]
+
+        def _SEND(method, url, data=None):
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+            gevent.sleep(0.001)
+            sent.append(data["type"])
+            in_flight[0] -= 1
+
+        with mock.patch.object(UUT, '_SEND', side_effect=_SEND):
+            UUT._process_queue()
+
+        self.assertEqual(sent, ["device"] * 3 + ["source"] * 3 + ["flow"] * 3)
+        self.assertEqual(in_flight[1], 3)
+        self.assertTrue(UUT._reg_queue.empty())
+
+    def test_process_queue_stops_batch_when_registration_lost(self):
+        UUT = self.make_aggregator()
+        self.register_resources(UUT, [("device", 1), ("source", 1)])
+        UUT._running = False
+
+        with mock.patch.object(UUT, '_SEND', side_effect=NoAggregator()) as _SEND:
+            UUT._process_queue()
+
+        _SEND.assert_called_once_with("POST", "/resource", mock.ANY)
+        self.assertFalse(UUT._registered["registered"])
+
+    def test_queue_request_wakes_queue_thread(self):
+        UUT = self.make_aggregator()
+        self.assertFalse(UUT._queue_wakeup.is_set())
+        UUT.register("device", "device_0")
+        self.assertTrue(UUT._queue_wakeup.is_set())
+
+    @mock.patch('nmoscommon.aggregator.requests.Session')
+    def test_send_reuses_session_per_href(self, Session):
+        UUT = self.make_aggregator()
+        Session.return_value.request.return_value.status_code = 204
+
+        UUT._SEND("POST", "/health/nodes/node")
+        UUT._SEND("DELETE", "/resource/devices/device_0")
+        Session.assert_called_once_with()
+        self.assertEqual(Session.return_value.request.call_count, 2)
+        Session.return_value.request.assert_called_with(
+            "DELETE", "http://example.com/x-nmos/registration/{}/resource/devices/device_0".format(
+                AGGREGATOR_APIVERSION), data=None, timeout=1.0, headers=None)
+
+        UUT.aggregator = "http://example.org"
+        UUT._SEND("POST", "/health/nodes/node")
+        self.assertEqual(Session.call_count, 2)
+
+    @mock.patch('nmoscommon.aggregator.requests.Session')
+    def test_send_raises_invalid_request_on_client_error(self, Session):
+        UUT = self.make_aggregator()
+        Session.return_value.request.return_value.status_code = 404
+
+        with self.assertRaises(InvalidRequest) as cm:
+            UUT._SEND("POST", "/health/nodes/node")
+        self.assertEqual(cm.exception.status_code, 404)
+
+    @mock.patch('nmoscommon.aggregator.requests.Session')
+    def test_send_fails_over_to_healthiest_registry(self, Session):
+        UUT = self.make_aggregator()
+        UUT.mdnsbridge.getHrefs.return_value = [("http://a", 10), ("http://b", 10), ("http://c", 20)]
+        UUT._registries.select()
+        UUT._registries.record_success("http://c", 0.01)
+        UUT.aggregator = "http://a"
+
+        def request(method, url, **kwargs):
+            if url.startswith("http://a"):
+                raise requests.exceptions.ConnectionError()
+            return mock.MagicMock(status_code=204)
+        Session.return_value.request.side_effect = request
+
+        UUT._SEND("POST", "/health/nodes/node")
+        self.assertEqual(UUT.aggregator, "http://b")
+        self.assertEqual(Session.return_value.request.call_count, 2)
+        stats = UUT.registry_stats()
+        self.assertEqual(stats["http://a"]["failures"], 1)
+        self.assertIsNotNone(stats["http://b"]["latency"])
+
+    @mock.patch('nmoscommon.aggregator.requests.Session')
+    def test_send_hedges_slow_requests(self, Session):
+        UUT = self.make_aggregator(hedge_delay=0.01)
+        UUT.mdnsbridge.getHrefs.return_value = [("http://a", 10), ("http://b", 10)]
+        UUT.aggregator = "http://a"
+
+        def request(method, url, **kwargs):
+            if url.startswith("http://a"):
+                gevent.sleep(0.05)
+            return mock.MagicMock(status_code=204)
+        Session.return_value.request.side_effect = request
+
+        UUT._SEND("GET", "/resource/nodes/node")
+        self.assertEqual(UUT.aggregator, "http://b")
+        self.assertIsNone(UUT.registry_stats()["http://a"]["latency"])
+        gevent.sleep(0.06)
+        self.assertGreater(UUT.registry_stats()["http://a"]["latency"], 0.04)
+
+    @mock.patch('nmoscommon.aggregator.requests.Session')
+    def test_send_does_not_hedge_writes(self, Session):
+        UUT = self.make_aggregator(hedge_delay=0.01)
+        UUT.mdnsbridge.getHrefs.return_value = [("http://a", 10), ("http://b", 10)]
+        UUT.aggregator = "http://a"
+
+        def request(method, url, **kwargs):
+            gevent.sleep(0.05)
+            return mock.MagicMock(status_code=204)
+        Session.return_value.request.side_effect = request
+
+        UUT._SEND("POST", "/resource", {})
+        UUT._SEND("DELETE", "/resource/nodes/node")
+        UUT._SEND("POST", "/health/nodes/node")
+        self.assertEqual(UUT.aggregator, "http://a")
+        self.assertEqual([call[1][1][:8] for call in Session.return_value.request.mock_calls], ["http://a"] * 3)
+
+    def test_register_and_unregister_are_coalesced(self):
+        UUT = self.make_aggregator()
+        self.register_resources(UUT, [("device", 1)])
+        UUT._reg_queue.get()
+        for n in range(10):
+            UUT.register("flow", "flow_0", label=str(n))
+        UUT.register("flow", "flow_1")
+        UUT.unregister("flow", "flow_1")
+        UUT.register("device", "device_0", label="updated")
+        UUT.unregister("device", "device_0")
+
+        self.assertEqual(UUT.queue_stats(), {"pending": 2, "coalesced": 9, "replaced": 1, "cancelled": 1})
+        UUT._running = False
+        with mock.patch.object(UUT, '_SEND') as _SEND:
+            UUT._process_queue()
+        self.assertListEqual(_SEND.mock_calls, [
+            mock.call("POST", "/resource", {"type": "flow", "data": {"id": "flow_0", "label": "9"}}),
+            mock.call("DELETE", "/resource/devices/device_0")])
+
+    def test_reregister_replays_mirror_by_tier(self):
+        UUT = self.make_aggregator(concurrency=4)
+        self.register_resources(UUT, [("device", 3), ("widget", 1), ("source", 2), ("flow", 3)])
+        UUT._registered["registered"] = False
+
+        sent = []
+        in_flight = [0, 0]
+
+        def _SEND(method, url, data=None):
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+            gevent.sleep(0.001)
+            sent.append(data["type"] if data else (method, url))
+            in_flight[0] -= 1
+
+        with mock.patch.object(UUT, '_SEND', side_effect=_SEND):
+            self.reregister(UUT)
+
+        self.assertEqual(sent, [("DELETE", "/resource/nodes/node"), "node", ("POST", "/health/nodes/node")] +
+                         ["device"] * 3 + ["source"] * 2 + ["flow"] * 3 + ["widget"])
+        self.assertEqual(in_flight[1], 3)
+        self.assertTrue(UUT._reg_queue.empty())
+        self.assertFalse(UUT._reregistering)
+        status = UUT.status()
+        self.assertTrue(status["registered"])
+        self.assertEqual(status["reregistration"]["state"], "complete")
+        self.assertEqual(status["reregistration"]["total"], 9)
+        self.assertEqual(status["reregistration"]["registered"], 9)
+        self.assertEqual(status["reregistration"]["failed"], 0)
+        self.assertGreater(status["reregistration"]["time_to_registered"], 0)
+
+    def test_heartbeats_continue_during_replay(self):
+        UUT = self.make_aggregator(concurrency=1)
+        self.register_resources(UUT, [("device", 20)])
+        UUT._registered["registered"] = False
+        sent = []
+
+        def _SEND(method, url, data=None):
+            sent.append((method, url))
+            if data and data["type"] == "device":
+                gevent.sleep(0.005)
+
+        with mock.patch.object(UUT, '_SEND', side_effect=_SEND):
+            UUT._process_reregister()
+            gevent.sleep(0.02)
+            replaying = UUT._reregistering
+            delay = UUT._heartbeat()
+            heartbeats = sent.count(("POST", "/health/nodes/node"))
+            UUT._replay_thread.join()
+
+        self.assertTrue(replaying)
+        self.assertAlmostEqual(delay, HEARTBEAT_INTERVAL, delta=HEARTBEAT_INTERVAL * HEARTBEAT_JITTER)
+        self.assertEqual(heartbeats, 2)
+        self.assertFalse(UUT._reregistering)
+        self.assertEqual(UUT.reregistration_stats()["registered"], 20)
+
+    def test_reregister_stops_when_registration_lost(self):
+        UUT = self.make_aggregator()
+        self.register_resources(UUT, [("device", 1), ("source", 2), ("flow", 1)])
+        UUT._registered["registered"] = False
+
+        def _SEND(method, url, data=None):
+            if data and data["data"]["id"] == "source_0":
+                raise InvalidRequest(400)
+            elif data and data["data"]["id"] == "source_1":
+                raise NoAggregator()
+
+        with mock.patch.object(UUT, '_SEND', side_effect=_SEND) as send:
+            self.reregister(UUT)
+
+        self.assertEqual(send.call_count, 6)
+        self.assertNotIn("source_0", UUT._registered["entities"]["resource"]["source"])
+        self.assertFalse(UUT._registered["registered"])
+        stats = UUT.reregistration_stats()
+        self.assertEqual((stats["state"], stats["total"], stats["registered"], stats["failed"]),
+                         ("failed", 4, 1, 2))
+        self.assertIsNone(stats["time_to_registered"])
+
+        # The next attempt is timed from the first
+        started = stats["started"]
+        with mock.patch.object(UUT, '_SEND'):
+            self.reregister(UUT)
+        stats = UUT.reregistration_stats()
+        self.assertEqual((stats["state"], stats["total"], stats["registered"]), ("complete", 3, 3))
+        self.assertEqual(stats["started"], started)
+
+    def test_reregister_can_queue_resources(self):
+        UUT = self.make_aggregator(parallel_reregister=False)
+        self.register_resources(UUT, [("flow", 1), ("device", 1)])
+        UUT._registered["registered"] = False
+
+        with mock.patch.object(UUT, '_SEND') as _SEND:
+            self.reregister(UUT)
+        self.assertEqual(_SEND.call_count, 3)
+        self.assertEqual([UUT._reg_queue.get()["key"] for _ in range(2)], ["device_0", "flow_0"])
+        self.assertEqual(UUT.reregistration_stats()["state"], "queued")
+
+    def test_delta_sync_sends_only_changes(self):
+        UUT = self.make_aggregator(delta_sync=True)
+        UUT._registered["node"] = {"type": "node", "data": {"id": "node", "version": "1"}}
+        UUT._registered["registered"] = True
+        UUT._ack("resource", "node", "node", UUT._registered["node"])
+        for key in ["device_0", "device_1", "flow_0"]:
+            UUT.register(key.split("_")[0], key, version="1")
+        UUT._running = False
+        with mock.patch.object(UUT, '_SEND'):
+            UUT._process_queue()
+        self.assertEqual(len(UUT._registered["acked"]), 4)
+
+        UUT._registered["registered"] = False
+        UUT.register("device", "device_1", version="2")
+        UUT.unregister("flow", "flow_0")
+        UUT.register("source", "source_0", version="1")
+
+        def _SEND(method, url, data=None):
+            if method == "GET":
+                return {"type": "device", "data": {"id": "device_0", "version": "1"}}
+        with mock.patch.object(UUT, '_SEND', side_effect=_SEND) as send:
+            self.reregister(UUT)
+
+        calls = [(c[1][0], c[1][1], c[1][2]["data"]["id"] if len(c[1]) > 2 else None) for c in send.mock_calls]
+        self.assertEqual(calls[:2], [("POST", "/health/nodes/node", None), ("DELETE", "/resource/flows/flow_0", None)])
+        self.assertCountEqual(calls[2:4], [("GET", "/resource/devices/device_0", None),
+                                           ("POST", "/resource", "device_1")])
+        self.assertEqual(calls[4:], [("POST", "/resource", "source_0")])
+        self.assertTrue(UUT._registered["registered"])
+        self.assertTrue(UUT._reg_queue.empty())
+        self.assertEqual(UUT._registered["acked"], {("resource", "node", "node"): "1",
+                                                    ("resource", "device", "device_0"): "1",
+                                                    ("resource", "device", "device_1"): "2",
+                                                    ("resource", "source", "source_0"): "1"})
+        stats = UUT.reregistration_stats()
+        self.assertEqual((stats["state"], stats["total"], stats["unchanged"], stats["registered"], stats["deleted"]),
+                         ("complete", 4, 1, 2, 1))
+
+    def test_delta_sync_resends_resources_registry_lost(self):
+        UUT = self.make_aggregator(delta_sync=True)
+        self.register_resources(UUT, [("device", 1)])
+        UUT.register("device", "device_0", version="1")
+        UUT._ack("resource", "node", "node", UUT._registered["node"])
+        UUT._ack("resource", "device", "device_0", UUT._registered["entities"]["resource"]["device"]["device_0"])
+        UUT._registered["registered"] = False
+
+        def _SEND(method, url, data=None):
+            if method == "GET":
+                raise InvalidRequest(404)
+        with mock.patch.object(UUT, '_SEND', side_effect=_SEND) as send:
+            self.reregister(UUT)
+        self.assertEqual(send.call_args_list[-1], mock.call("POST", "/resource", mock.ANY))
+        self.assertEqual(UUT.reregistration_stats()["registered"], 1)
+
+    def test_delta_sync_registers_everything_when_node_missing(self):
+        UUT = self.make_aggregator(delta_sync=True)
+        self.register_resources(UUT, [("device", 1)])
+        UUT._ack("resource", "device", "device_0", UUT._registered["entities"]["resource"]["device"]["device_0"])
+        UUT._registered["registered"] = False
+
+        with mock.patch.object(UUT, '_SEND', side_effect=[InvalidRequest(404), None, None, None, None]) as send:
+            self.reregister(UUT)
+        self.assertEqual([c[1][:2] for c in send.mock_calls],
+                         [("POST", "/health/nodes/node"), ("DELETE", "/resource/nodes/node"),
+                          ("POST", "/resource"), ("POST", "/health/nodes/node"), ("POST", "/resource")])
+        self.assertTrue(UUT._registered["registered"])
+
+    def test_journal_restores_mirror_after_restart(self):
+        path = os.path.join(tempfile.mkdtemp(), "journal")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        UUT = self.make_aggregator(journal_path=path)
+        self.assertTrue(UUT.delta_sync)
+        UUT.register("node", "node", version="1")
+        UUT.register("device", "device_0", version="1")
+        UUT.register("device", "device_1", version="1")
+        UUT._registered["registered"] = True
+        UUT._running = False
+        with mock.patch.object(UUT, '_SEND'):
+            UUT._process_queue()
+        UUT.unregister("device", "device_1")
+        UUT.stop()
+
+        UUT = self.make_aggregator(journal_path=path)
+        self.assertEqual(UUT._registered["node"]["data"], {"id": "node", "version": "1"})
+        self.assertEqual(list(UUT._registered["entities"]["resource"]["device"]), ["device_0"])
+        self.assertEqual(len(UUT._registered["acked"]), 3)
+        self.assertFalse(UUT._registered["registered"])
+
+        # Registering again the same versions as the Registration API has doesn't send them again
+        UUT.register("node", "node", version="1")
+        UUT.register("device", "device_0", version="1")
+        self.assertTrue(UUT._reg_queue.empty())
+        UUT.register("device", "device_0", version="2")
+        self.assertEqual(len(UUT._reg_queue), 1)
+        UUT.stop()
+
+    @mock.patch('nmoscommon.aggregator.random.uniform', side_effect=lambda a, b: b)
+    def test_heartbeat_delay_backs_off_with_jitter(self, uniform):
+        UUT = self.make_aggregator(heartbeat_interval=4, heartbeat_jitter=0.25, heartbeat_max_backoff=10)
+        self.assertEqual([UUT._next_heartbeat_delay(False) for _ in range(4)], [5.0, 10.0, 12.5, 12.5])
+        self.assertEqual(UUT._next_heartbeat_delay(True), 5.0)
+        self.assertEqual(UUT._next_heartbeat_delay(False), 5.0)
+
+    def test_heartbeat(self):
+        UUT = self.make_aggregator()
+        self.register_resources(UUT, [])
+        with mock.patch.object(UUT, '_SEND') as _SEND:
+            self.assertAlmostEqual(UUT._heartbeat(), HEARTBEAT_INTERVAL, delta=HEARTBEAT_INTERVAL * HEARTBEAT_JITTER)
+            _SEND.assert_called_once_with("POST", "/health/nodes/node")
+
+            _SEND.side_effect = InvalidRequest(404)
+            self.assertEqual(UUT._heartbeat(), 0)
+            self.assertFalse(UUT._registered["registered"])
+
+            _SEND.side_effect = None
+            UUT._heartbeat()
+            self.assertTrue(UUT._registered["registered"])
+
+            _SEND.side_effect = InvalidRequest(400)
+            self.assertIsNone(UUT._heartbeat())
+            self.assertFalse(UUT._running)
+
+    def test_heartbeat_thread_runs_until_stopped(self):
+        scheduler = mock.MagicMock(name="scheduler")
+        with mock.patch.object(Aggregator, '_process_queue'):
+            UUT = Aggregator(heartbeat_scheduler=scheduler)
+        gevent.sleep(0)
+        self.assertFalse(UUT.heartbeat_thread.dead)
+
+        UUT.stop()
+        UUT.heartbeat_thread.join(1)
+        self.assertTrue(UUT.heartbeat_thread.dead)
+        scheduler.remove.assert_called_once_with(UUT._heartbeat)
+
+    def test_heartbeat_scheduler_can_be_shared(self):
+        scheduler = HeartbeatScheduler()
+        with mock.patch.object(scheduler, 'add') as add:
+            aggregators = [self.make_aggregator(heartbeat_scheduler=scheduler) for _ in range(3)]
+        self.assertCountEqual([call[1][0] for call in add.mock_calls],
+                              [aggregator._heartbeat for aggregator in aggregators])
+
+
+class TestMDNSUpdater(unittest.TestCase):
+    def make_updater(self, **kwargs):
+        self.mdns = mock.MagicMock()
+        UUT = MDNSUpdater(self.mdns, "_nmos-node._tcp", "node_test", {"device": "ver_dvc", "flow": "ver_flw"}, 12345,
+                          mock.MagicMock(), txt_recs={"api_ver": "v1.3"}, **kwargs)
+        self.addCleanup(UUT.stop)
+        return UUT
+
+    def test_updates_are_debounced(self):
+        UUT = self.make_updater(p2p_enable=True, debounce=0.02)
+        for _ in range(200):
+            UUT.update_mdns("device", "register")
+        UUT.update_mdns("flow", "update")
+        gevent.sleep(0.05)
+
+        self.mdns.update.assert_called_once_with("node_test", "_nmos-node._tcp",
+                                                 {"api_ver": "v1.3", "ver_dvc": 200, "ver_flw": 1})
+        self.assertEqual(UUT.mdns_updates_coalesced, 200)
+
+        UUT.P2P_disable()
+        gevent.sleep(0.05)
+        self.mdns.update.assert_called_with("node_test", "_nmos-node._tcp", {"api_ver": "v1.3"})
+
+    def test_nothing_is_published_without_changes(self):
+        UUT = self.make_updater(debounce=0.01)
+        UUT.update_mdns("device", "register")
+        gevent.sleep(0.03)
+        self.mdns.register.assert_called_once_with("node_test", "_nmos-node._tcp", 12345, {"api_ver": "v1.3"})
+        self.mdns.update.assert_not_called()
+        UUT.stop()
+        self.assertTrue(UUT.mdns_thread.dead)
+
+    def test_pending_update_is_published_on_stop(self):
+        UUT = self.make_updater(p2p_enable=True, debounce=10)
+        UUT.update_mdns("device", "register")
+        gevent.sleep(0)
+        UUT.update_mdns("flow", "register")
+        with gevent.Timeout(1):
+            UUT.stop()
+
+        self.assertTrue(UUT.mdns_thread.dead)
+        self.mdns.update.assert_called_once_with("node_test", "_nmos-node._tcp",
+                                                 {"api_ver": "v1.3", "ver_dvc": 1, "ver_flw": 1})
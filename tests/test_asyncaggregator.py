@@ -0,0 +1,28 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+from six import PY2
+
+import unittest
+
+# AsyncAggregator and its tests use async syntax, which Python 2 can't parse, so they are only imported on Python 3
+if not PY2:
+    from asyncaggregator_cases import StubRegistry, TestAsyncAggregator  # noqa: F401
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,291 @@
+# Copyright 2017 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+from six import PY2
+
+import copy
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import mock
+import gevent
+from nmoscommon.facade import *
+from nmoscommon.ipc import Host, LocalException, MultiplexedHost, RemoteException
+
+
+class TestFacade(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestFacade, self).__init__(*args, **kwargs)
+        if PY2:
+            self.assertCountEqual = self.assertItemsEqual
+
+    def setUp(self):
+        paths = ['nmoscommon.facade.Logger',
+                 'nmoscommon.facade.MultiplexedProxy']
+        patchers = dict((name, mock.patch(name)) for name in paths)
+        self.mocks = dict((name, patcher.start()) for (name, patcher) in patchers.items())
+        for patcher in patchers.values():
+            self.addCleanup(patcher.stop)
+        self.ipc = self.mocks['nmoscommon.facade.MultiplexedProxy'].return_value
+        self.UUT = Facade("test")
+        self.UUT.srv_registered = True
+
+    def test_add_resources_sends_one_batch(self):
+        self.ipc.batch.return_value = [{'ret': FAC_SUCCESS}, {'exc': "Traceback"}]
+        receivers = [("receiver", "r{}".format(n), {"id": "r{}".format(n)}) for n in range(2)]
+
+        statuses = self.UUT.addResources(receivers)
+
+        self.assertEqual(statuses, [FAC_SUCCESS, FAC_OTHERERROR])
+        self.ipc.batch.assert_called_once_with([
+            {'function': "res_register", 'args': ("test", self.UUT.pid, "receiver", "r0", {"id": "r0"}), 'kwargs': {}},
+            {'function': "res_register", 'args': ("test", self.UUT.pid, "receiver", "r1", {"id": "r1"}), 'kwargs': {}}
+        ])
+        self.ipc.invoke_named.assert_not_called()
+        self.assertEqual(self.UUT.resources, {"receiver": {"r0": {"id": "r0"}, "r1": {"id": "r1"}}})
+
+    def test_batch_context_manager(self):
+        self.ipc.batch.side_effect = lambda calls: [{'ret': FAC_SUCCESS} for call in calls]
+
+        with self.UUT.batch() as statuses:
+            self.UUT.addResource("flow", "f0", {"id": "f0"})
+            self.UUT.updateResource("flow", "f0", {"id": "f0", "label": "updated"})
+            with self.UUT.batch():
+                self.UUT.delResource("sender", "s0")
+            self.assertEqual(statuses, [])
+
+        self.assertEqual(statuses, [FAC_SUCCESS] * 3)
+        self.assertEqual([call['function'] for call in self.ipc.batch.call_args[0][0]],
+                         ["res_register", "res_update", "res_unregister"])
+        self.assertEqual(self.ipc.batch.call_count, 1)
+
+    def test_batch_falls_back_to_separate_calls(self):
+        self.ipc.batch.side_effect = RemoteException("AttributeError")
+        self.ipc.invoke_named.side_effect = [FAC_SUCCESS, RemoteException("Traceback")]
+
+        statuses = self.UUT.delResources([("flow", "f0"), ("flow", "f1")])
+
+        self.assertEqual(statuses, [FAC_SUCCESS, FAC_OTHERERROR])
+        self.ipc.invoke_named.assert_has_calls([mock.call("res_unregister", "test", self.UUT.pid, "flow", "f0"),
+                                                mock.call("res_unregister", "test", self.UUT.pid, "flow", "f1")])
+
+    def test_batch_failure(self):
+        self.ipc.batch.side_effect = Exception("Unconnected Socket")
+        self.ipc.socket = None
+
+        statuses = self.UUT.addResources([("flow", "f0", {"id": "f0"})])
+
+        self.assertEqual(statuses, [None])
+        self.assertIsNone(self.UUT.ipc)
+        self.assertTrue(self.UUT.reregister)
+
+    def test_batches_are_split(self):
+        self.ipc.batch.side_effect = [[{'ret': FAC_SUCCESS}] * FACADE_BATCH_SIZE, Exception("Unconnected Socket")]
+        flows = [("flow", "f{}".format(n), {"id": "f{}".format(n)}) for n in range(FACADE_BATCH_SIZE * 2 + 5)]
+
+        statuses = self.UUT.addResources(flows)
+
+        self.assertEqual(statuses, [FAC_SUCCESS] * FACADE_BATCH_SIZE + [None] * (FACADE_BATCH_SIZE + 5))
+        self.assertEqual([len(call[0][0]) for call in self.ipc.batch.call_args_list],
+                         [FACADE_BATCH_SIZE, FACADE_BATCH_SIZE])
+        self.assertTrue(self.UUT.reregister)
+
+    def test_call_timeout_keeps_proxy(self):
+        self.ipc.invoke_named.side_effect = LocalException("Timed out")
+
+        self.UUT.addResource("flow", "f0", {"id": "f0"})
+
+        self.assertIs(self.UUT.ipc, self.ipc)
+        self.assertTrue(self.UUT.reregister)
+
+    def test_reregister_all_sends_one_batch(self):
+        self.UUT.resources = {"receiver": {"r0": {"id": "r0", "pipel_id": "p", "pipeline_id": "p"}},
+                              "flow": {"f0": {"id": "f0"}}}
+        self.UUT.controls = {"d0": {"http://control": {"href": "http://control"}}}
+        self.UUT.reregister = True
+        self.ipc.srv_heartbeat.return_value = FAC_SUCCESS
+        self.ipc.srv_register.return_value = FAC_SUCCESS
+        self.ipc.batch.side_effect = lambda calls: [{'ret': FAC_SUCCESS} for call in calls]
+
+        self.UUT.heartbeat_service()
+
+        calls = self.ipc.batch.call_args[0][0]
+        self.assertCountEqual([call['args'][2:] for call in calls],
+                              [("receiver", "r0", {"id": "r0"}), ("flow", "f0", {"id": "f0"}),
+                               ("d0", {"href": "http://control"})])
+        self.assertEqual(self.UUT.resources["receiver"]["r0"]["pipel_id"], "p")
+        self.assertFalse(self.UUT.reregister)
+
+    def test_plain_resources_are_copied(self):
+        value = {"id": "f0", "tags": {"urn:x-nmos:tag:grouphint/v1.0": ["Video 1:Video"]}}
+
+        self.UUT.addResource("flow", "f0", value)
+        value["tags"]["extra"] = []
+        stored = self.UUT.resources["flow"]["f0"]
+        stored["label"] = "updated"
+        self.UUT.updateResource("flow", "f0", stored)
+
+        self.assertEqual(stored, {"id": "f0", "tags": {"urn:x-nmos:tag:grouphint/v1.0": ["Video 1:Video"]},
+                                  "label": "updated"})
+        self.assertIs(self.UUT.resources["flow"]["f0"], stored)
+        self.assertIs(self.ipc.invoke_named.call_args[0][5], stored)
+
+    def test_frozen_resources_are_stored_without_copying(self):
+        value = freeze({"id": "f0", "tags": {"urn:x-nmos:tag:grouphint/v1.0": ["Video 1:Video"]}})
+
+        self.UUT.addResource("flow", "f0", value)
+        stored = self.UUT.resources["flow"]["f0"]
+        self.UUT.updateResource("flow", "f0", stored.copy_with({"label": "updated"}))
+        updated = self.UUT.resources["flow"]["f0"]
+
+        self.assertIs(stored, value)
+        self.assertIs(updated["tags"], stored["tags"])
+        self.assertEqual(updated["label"], "updated")
+        self.assertIs(self.ipc.invoke_named.call_args[0][5], updated)
+
+    def test_receiver_view_is_cached(self):
+        self.ipc.srv_register.return_value = FAC_SUCCESS
+        self.ipc.batch.side_effect = lambda calls: [{'ret': FAC_SUCCESS} for call in calls]
+        self.UUT.addResource("receiver", "r0", freeze({"id": "r0", "pipel_id": "p"}))
+
+        self.UUT.reregister_all()
+        self.UUT.reregister_all()
+        views = [call[0][0][0]['args'][4] for call in self.ipc.batch.call_args_list]
+        self.UUT.updateResource("receiver", "r0", freeze({"id": "r0", "label": "updated"}))
+        self.UUT.reregister_all()
+
+        self.assertEqual(views[0], {"id": "r0"})
+        self.assertIs(views[0], views[1])
+        self.assertEqual(self.ipc.batch.call_args[0][0][0]['args'][4], {"id": "r0", "label": "updated"})
+        self.assertEqual(self.UUT.resources["receiver"]["r0"], {"id": "r0", "label": "updated"})
+
+    def test_plain_receiver_view_follows_changes(self):
+        self.ipc.srv_register.return_value = FAC_SUCCESS
+        self.ipc.batch.side_effect = lambda calls: [{'ret': FAC_SUCCESS} for call in calls]
+        self.UUT.addResource("receiver", "r0", {"id": "r0", "pipel_id": "p"})
+
+        self.UUT.reregister_all()
+        self.UUT.resources["receiver"]["r0"]["label"] = "updated"
+        self.UUT.reregister_all()
+
+        self.assertEqual(self.ipc.batch.call_args[0][0][0]['args'][4], {"id": "r0", "label": "updated"})
+        self.assertEqual(self.UUT.resources["receiver"]["r0"], {"id": "r0", "pipel_id": "p", "label": "updated"})
+
+
+class TestFacadeWithHost(unittest.TestCase):
+    """A Facade talking to a Host, which answers one call at a time, over a real ipc socket"""
+    def __init__(self, *args, **kwargs):
+        super(TestFacadeWithHost, self).__init__(*args, **kwargs)
+        if PY2:
+            self.assertCountEqual = self.assertItemsEqual
+
+    def setUp(self):
+        patcher = mock.patch('nmoscommon.facade.Logger')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.address = "ipc://" + os.path.join(tmpdir, "facade.test")
+        self.registered = []
+
+    def start_host(self, host_class=Host):
+        host = host_class(self.address)
+        for name in ("srv_register", "srv_unregister", "srv_heartbeat", "control_register"):
+            host.ipcmethod(name)(lambda *args: FAC_SUCCESS)
+
+        @host.ipcmethod()
+        def res_register(srv_type, pid, type, key, value):
+            gevent.sleep(0.002)
+            self.registered.append(key)
+            return FAC_SUCCESS
+
+        host.start()
+        self.addCleanup(host.stop)
+
+    def test_reregister_all_without_batch(self):
+        self.start_host()
+        UUT = Facade("test", address=self.address)
+        for n in range(200):
+            UUT.addResource("receiver", "r{}".format(n), {"id": "r{}".format(n)})
+        self.assertTrue(UUT.reregister)
+
+        UUT.heartbeat_service()
+
+        self.assertFalse(UUT.reregister)
+        self.assertTrue(UUT.srv_registered)
+        self.assertCountEqual(self.registered, ["r{}".format(n) for n in range(200)])
+
+    def test_reregister_all_with_slow_batch(self):
+        self.start_host(MultiplexedHost)
+        UUT = Facade("test", address=self.address)
+        for n in range(200):
+            UUT.addResource("receiver", "r{}".format(n), {"id": "r{}".format(n)})
+        self.assertTrue(UUT.reregister)
+
+        UUT.heartbeat_service()
+
+        self.assertFalse(UUT.reregister)
+        self.assertCountEqual(self.registered, ["r{}".format(n) for n in range(200)])
+
+        statuses = UUT.addResources([("receiver", "s{}".format(n), {"id": "s{}".format(n)}) for n in range(100)])
+
+        self.assertEqual(statuses, [FAC_SUCCESS] * 100)
+        self.assertEqual(len(self.registered), 300)
+
+
+class TestFreeze(unittest.TestCase):
+    def test_freeze(self):
+        value = {"a": [1, {"b": 2}], "c": (3, )}
+
+        UUT = freeze(value)
+
+        self.assertEqual(UUT, {"a": [1, {"b": 2}], "c": [3]})
+        self.assertIsInstance(UUT["a"], FrozenList)
+        self.assertIsInstance(UUT["a"][1], FrozenDict)
+        self.assertIs(freeze(UUT), UUT)
+        self.assertIs(copy.deepcopy(UUT), UUT)
+        self.assertEqual(json.loads(json.dumps(UUT)), {"a": [1, {"b": 2}], "c": [3]})
+        self.assertEqual(pickle.loads(pickle.dumps(UUT)), UUT)
+
+    def test_frozen_values_cannot_be_modified(self):
+        UUT = freeze({"a": [1], "b": 2})
+
+        for modify in (lambda: UUT.__setitem__("b", 3), lambda: UUT.pop("b"), lambda: UUT.update(b=3),
+                       lambda: UUT.__ior__({"b": 3}), lambda: UUT["a"].append(2),
+                       lambda: UUT["a"].__setitem__(0, 2), lambda: UUT["a"].clear()):
+            with self.assertRaises(TypeError):
+                modify()
+        UUT.__init__({"c": 4})
+        UUT["a"].__init__([5])
+        self.assertEqual(UUT, {"a": [1], "b": 2})
+
+    def test_copy_with(self):
+        UUT = freeze({"a": [1], "b": 2, "c": 3})
+
+        changed = UUT.copy_with({"b": {"d": 4}}, remove=("c", ))
+
+        self.assertEqual(changed, {"a": [1], "b": {"d": 4}})
+        self.assertIs(changed["a"], UUT["a"])
+        self.assertIsInstance(changed["b"], FrozenDict)
+        self.assertEqual(UUT, {"a": [1], "b": 2, "c": 3})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -27,7 +27,7 @@ class TestCrossDomain(unittest.TestCase):
 
     def assert_crossdomain_call_correct(self, method, methods=None, headers=None,
                                         max_age=21600, attach_to_all=True,
-                                        origin="localhost", automatic_options=True):
+                                        origin="localhost", automatic_options=True, url_rule=True):
         args = [ mock.sentinel.arg1, mock.sentinel.arg2 ]
         kwargs = { "kw1" : mock.sentinel.kwarg1,
                    "kw2" : mock.sentinel.kwarg2 }
@@ -44,9 +44,15 @@ class TestCrossDomain(unittest.TestCase):
             with mock.patch('nmoscommon.flask_cors.request') as request:
                 with mock.patch('nmoscommon.flask_cors.make_response') as make_response:
                     request.method = method
+                    if url_rule:
+                        request.url_rule.rule = "/"
+                        request.url_rule.methods = set([ "GET", "HEAD", "OPTIONS" ])
+                    else:
+                        request.url_rule = None
                     # This makes the headers entry behave like a dict, but returning new MagicMocks whenever an empry entry is needed
                     resp_headers = {}
                     def_opt_headers = {}
+                    opt_headers = {}
 
                     def getitem(d):
                         def __inner(key):
@@ -62,6 +68,9 @@ class TestCrossDomain(unittest.TestCase):
                     current_app.make_default_options_response.return_value.headers.__getitem__.side_effect = getitem(def_opt_headers)
                     current_app.make_default_options_response.return_value.headers.__setitem__.side_effect = setitem(def_opt_headers)
 
+                    current_app.response_class.return_value.headers.__getitem__.side_effect = getitem(opt_headers)
+                    current_app.response_class.return_value.headers.__setitem__.side_effect = setitem(opt_headers)
+
                     make_response.return_value.headers.__getitem__.side_effect = getitem(resp_headers)
                     make_response.return_value.headers.__setitem__.side_effect = setitem(resp_headers)
 
@@ -76,10 +85,17 @@ class TestCrossDomain(unittest.TestCase):
                     if isinstance(max_age, timedelta):
                         max_age = max_age.total_seconds()
 
+                    fast_options = (methods is not None and url_rule)
                     if methods is None:
                         methods = current_app.make_default_options_response.return_value.headers["allow"]
 
-                    if automatic_options and method == "OPTIONS":
+                    if automatic_options and method == "OPTIONS" and fast_options:
+                        self.assertEqual(resp, current_app.response_class.return_value)
+                        current_app.make_default_options_response.assert_not_called()
+                        F.assert_not_called()
+                        h = opt_headers
+                        self.assertEqual(h['Allow'], "GET, HEAD, OPTIONS")
+                    elif automatic_options and method == "OPTIONS":
                         self.assertEqual(resp, current_app.make_default_options_response.return_value)
                         h = def_opt_headers
                     else:
@@ -103,6 +119,9 @@ class TestCrossDomain(unittest.TestCase):
     def test_methods_overrides_automatic_options(self):
         self.assert_crossdomain_call_correct("OPTIONS", automatic_options=True, methods=[ "GET", "PUT", "POTATO" ])
 
+    def test_methods_overrides_automatic_options_without_url_rule(self):
+        self.assert_crossdomain_call_correct("OPTIONS", automatic_options=True, methods=[ "GET", "PUT", "POTATO" ], url_rule=False)
+
     def test_headers_passed_through_in_automatic_options(self):
         self.assert_crossdomain_call_correct("OPTIONS", automatic_options=True, headers=[ "foo", "bar", "baz" ])
 
@@ -124,5 +143,54 @@ class TestCrossDomain(unittest.TestCase):
     def test_can_handle_list_origin(self):
         self.assert_crossdomain_call_correct("GET", origin=["foo", "bar"])
 
+    def test_cors_headers(self):
+        self.assertEqual(cors_headers("*", "GET, HEAD", 60),
+                         (('Access-Control-Allow-Origin', "*"),
+                          ('Access-Control-Allow-Methods', "GET, HEAD"),
+                          ('Access-Control-Max-Age', "60")))
+        self.assertEqual(cors_headers("*", "GET", headers="CONTENT-TYPE")[-1],
+                         ('Access-Control-Allow-Headers', "CONTENT-TYPE"))
+
     def test_can_handle_timedelta_max_age(self):
         self.assert_crossdomain_call_correct("GET", max_age=timedelta(20))
+
+    def test_options_preflight_does_not_call_view(self):
+        from flask import Flask
+        app = Flask(__name__)
+        view = mock.MagicMock(return_value="POTATO")
+
+        def test_function():
+            return view()
+        app.route('/test', methods=["GET", "OPTIONS"])(crossdomain(origin="*", methods=["GET"])(test_function))
+
+        resp = app.test_client().open('/test', method="OPTIONS")
+        view.assert_not_called()
+        self.assertEqual(resp.headers['Allow'], "GET, HEAD, OPTIONS")
+        self.assertEqual(resp.headers['Access-Control-Allow-Methods'], "GET")
+        self.assertEqual(resp.headers['Access-Control-Allow-Origin'], "*")
+
+        resp = app.test_client().get('/test')
+        view.assert_called_once_with()
+        self.assertEqual(resp.get_data(), b"POTATO")
+        self.assertEqual(resp.headers['Access-Control-Max-Age'], "21600")
+
+    def test_options_preflight_allows_methods_of_every_rule_for_the_path(self):
+        from flask import Flask
+        app = Flask(__name__)
+
+        def get_function():
+            return "GET"
+
+        def post_function():
+            return "POST"
+        app.route('/test', methods=["GET", "OPTIONS"])(crossdomain(origin="*", methods=["GET"])(get_function))
+        app.route('/test', methods=["POST"])(crossdomain(origin="*", methods=["POST"])(post_function))
+        app.route('/other', methods=["PUT"], endpoint="other")(crossdomain(origin="*", methods=["PUT"])(post_function))
+
+        with app.test_request_context('/test', method="OPTIONS"):
+            default_allow = app.make_default_options_response().headers['Allow']
+
+        for n in range(2):
+            resp = app.test_client().open('/test', method="OPTIONS")
+            self.assertEqual(resp.headers['Allow'], "GET, HEAD, OPTIONS, POST")
+            self.assertCountEqual(resp.headers['Allow'].split(", "), default_allow.split(", "))
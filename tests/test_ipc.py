@@ -21,6 +21,10 @@ from six import iteritems
 
 import unittest
 import mock
+import os
+import shutil
+import tempfile
+import gevent
 from nmoscommon.ipc import *
 
 if PY2:
@@ -450,6 +454,226 @@ class TestProxy(unittest.TestCase):
                 r = getattr(UUT, method_name)(*args, **kwargs)
             self.assertEqual(cm.exception.args, ( EXPECTED_EXCEPTION_MESSAGE, ))
 
+class TestMultiplexed(unittest.TestCase):
+    """Calls made over real ipc sockets between multiplexed and plain Hosts and Proxies"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.address = "ipc://" + os.path.join(self.tmpdir, "ipc.test")
+
+    def make_host(self, host_class=MultiplexedHost, **kwargs):
+        host = host_class(self.address, **kwargs)
+
+        @host.ipcmethod()
+        def echo(value, delay=0):
+            """Return the value given"""
+            gevent.sleep(delay)
+            return value
+
+        @host.ipcmethod()
+        def fail():
+            raise ValueError("failed")
+
+        host.start()
+        self.addCleanup(host.stop)
+        return host
+
+    def make_proxy(self, proxy_class=MultiplexedProxy, timeout=1000, **kwargs):
+        proxy = proxy_class(self.address, timeout=timeout, **kwargs)
+        self.addCleanup(proxy.close)
+        return proxy
+
+    def test_concurrent_calls_share_one_connection(self):
+        self.make_host()
+        UUT = self.make_proxy()
+
+        calls = [gevent.spawn(UUT.echo, n) for n in range(10)]
+        gevent.joinall(calls, timeout=5)
+
+        self.assertEqual([call.value for call in calls], list(range(10)))
+        self.assertEqual(UUT._pending, {})
+        self.assertEqual(UUT.getmethods()["echo"], "Return the value given")
+
+    def test_remote_exception(self):
+        self.make_host()
+        UUT = self.make_proxy()
+
+        with self.assertRaises(RemoteException) as cm:
+            UUT.fail()
+        self.assertIn("ValueError: failed", cm.exception.args[0])
+        with self.assertRaises(RemoteException) as cm:
+            UUT.missing()
+        self.assertEqual(cm.exception.args, ("AttributeError", ))
+        self.assertEqual(UUT.echo("still connected"), "still connected")
+
+    def test_timeout_fails_only_its_own_call(self):
+        self.make_host(concurrency=4)
+        UUT = self.make_proxy(timeout=50)
+
+        def call(value, delay):
+            try:
+                return UUT.echo(value, delay=delay)
+            except LocalException as e:
+                return e
+
+        calls = [gevent.spawn(call, "slow", 0.1), gevent.spawn(call, "fast", 0.01)]
+        gevent.joinall(calls, timeout=5)
+        gevent.sleep(0.1)
+
+        self.assertIsInstance(calls[0].value, LocalException)
+        self.assertEqual(calls[1].value, "fast")
+        self.assertIsNotNone(UUT.socket)
+        self.assertEqual(UUT.echo("after"), "after")
+        self.assertEqual(UUT._pending, {})
+
+    def test_concurrent_calls_reply_out_of_order(self):
+        host = self.make_host(concurrency=4)
+        UUT = self.make_proxy()
+
+        slow = gevent.spawn(UUT.echo, "slow", delay=0.2)
+        gevent.sleep(0.05)
+        self.assertEqual(UUT.echo("fast"), "fast")
+        self.assertFalse(slow.ready())
+        self.assertEqual(host.stats()["active"], 1)
+        self.assertEqual(slow.get(timeout=5), "slow")
+        self.assertEqual(host.stats()["methods"]["echo"]["calls"], 2)
+
+    def test_concurrency_limits_queue_calls(self):
+        host = self.make_host(concurrency=2, method_limits={"echo": 1})
+        UUT = self.make_proxy()
+
+        calls = [gevent.spawn(UUT.echo, n, delay=0.05) for n in range(3)]
+        gevent.sleep(0.02)
+        methods = UUT.getmethods()
+        stats = host.stats()
+        gevent.joinall(calls, timeout=5)
+
+        self.assertIn("echo", methods)
+        self.assertEqual(stats["active"], 1)
+        self.assertEqual(stats["queued"], 2)
+        self.assertEqual(stats["methods"]["echo"]["max_queued"], 2)
+        self.assertEqual(stats["methods"]["getmethods"]["calls"], 1)
+        self.assertEqual([call.value for call in calls], list(range(3)))
+        self.assertEqual(host.stats()["queued"], 0)
+
+    def test_batch(self):
+        self.make_host()
+        UUT = self.make_proxy()
+
+        replies = UUT.batch([{"function": "echo", "args": [1], "kwargs": {}},
+                             {"function": "fail", "args": [], "kwargs": {}},
+                             {"function": "missing", "args": [], "kwargs": {}},
+                             {"function": "echo"}])
+
+        self.assertEqual(replies[0], {"ret": 1})
+        self.assertIn("ValueError: failed", replies[1]["exc"])
+        self.assertEqual(replies[2:], [{"exc": "AttributeError"}, {}])
+
+    def test_batch_timeout_grows_with_calls(self):
+        self.make_host()
+        UUT = self.make_proxy(timeout=50)
+
+        replies = UUT.batch([{"function": "echo", "args": [n], "kwargs": {"delay": 0.03}} for n in range(5)])
+
+        self.assertEqual(replies, [{"ret": n} for n in range(5)])
+
+    def test_backlog_limits_calls_read(self):
+        host = self.make_host(concurrency=1, backlog=1)
+        UUT = self.make_proxy()
+
+        calls = [gevent.spawn(UUT.echo, n, delay=0.02) for n in range(5)]
+        gevent.sleep(0.01)
+        waiting = len(host._calls)
+        gevent.joinall(calls, timeout=5)
+
+        self.assertEqual(waiting, 2)
+        self.assertEqual([call.value for call in calls], list(range(5)))
+        self.assertGreaterEqual(host.stats()["overflows"], 1)
+        self.assertEqual(host.stats()["queued"], 0)
+
+    def test_codec_negotiation(self):
+        self.make_host(codecs=["json+frames", "json"])
+        UUT = self.make_proxy()
+
+        payload = bytearray(b"\x00\xff" * 1024)
+        result = UUT.echo(payload)
+
+        self.assertEqual(UUT.codec.name, "json+frames")
+        self.assertIsInstance(result, memoryview)
+        self.assertEqual(result.tobytes(), bytes(payload))
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack_codec(self):
+        self.make_host()
+        UUT = self.make_proxy(codecs=["msgpack", "json"])
+
+        self.assertEqual(UUT.echo({"key": [1, 2.5, None]}), {"key": [1, 2.5, None]})
+        self.assertEqual(UUT.echo({1: "a"}), {1: "a"})
+        self.assertEqual(UUT.codec.name, "msgpack")
+        with self.assertRaises(RemoteException):
+            UUT.fail()
+
+    def test_undecodable_call_gets_exception(self):
+        self.make_host()
+        socket = zmq.Context.instance().socket(zmq.DEALER)
+        self.addCleanup(socket.close, linger=0)
+        socket.connect(self.address)
+
+        socket.send_multipart([b"", b"json+frames", b"not json"])
+        reply = socket.recv_multipart()
+        socket.send_multipart([b"", b"[1, 2]"])
+        second_reply = socket.recv_multipart()
+
+        self.assertEqual(reply[1], b"json+frames")
+        self.assertEqual(json.loads(reply[2].decode('utf-8')), {"exc": "Undecodable call"})
+        self.assertEqual(json.loads(second_reply[1].decode('utf-8')), {"exc": "Undecodable call"})
+
+    def test_plain_host_negotiates_json(self):
+        self.make_host(Host)
+        UUT = self.make_proxy()
+
+        self.assertEqual(UUT.echo("value"), "value")
+        self.assertEqual(UUT.codec.name, "json")
+
+    def test_multipart_codec_round_trip(self):
+        UUT = MultipartCodec(JSONCodec())
+        msg = {"args": [bytearray(b"one"), {"nested": [1]}], "kwargs": {"data": memoryview(b"two")}}
+
+        frames = UUT.encode(msg)
+
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(UUT.decode(frames), msg)
+        with self.assertRaises(ValueError):
+            MultiplexedProxy(self.address, codecs=["unknown"])
+
+    def test_multiplexed_proxy_calls_plain_host(self):
+        self.make_host(Host)
+        UUT = self.make_proxy()
+
+        calls = [gevent.spawn(UUT.invoke_named, "echo", n) for n in range(5)]
+        gevent.joinall(calls, timeout=5)
+
+        self.assertEqual([call.value for call in calls], list(range(5)))
+
+    def test_concurrent_calls_to_plain_host_are_serialised(self):
+        self.make_host(Host)
+        UUT = self.make_proxy(timeout=100)
+
+        calls = [gevent.spawn(UUT.echo, n, delay=0.003) for n in range(100)]
+        gevent.joinall(calls, timeout=10)
+
+        self.assertFalse(UUT.multiplexed)
+        self.assertEqual([call.value for call in calls], list(range(100)))
+
+    def test_plain_proxy_calls_multiplexed_host(self):
+        self.make_host()
+        UUT = self.make_proxy(Proxy)
+
+        self.assertEqual(UUT.echo({"key": "value"}), {"key": "value"})
+        with self.assertRaises(RemoteException):
+            UUT.fail()
+
+
 class TestMain(unittest.TestCase):
     def setUp(self):
         paths = ['nmoscommon.ipc.zmq',
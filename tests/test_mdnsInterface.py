@@ -40,6 +40,17 @@ class TestMDNSInterface(unittest.TestCase):
             with self.assertRaises(InterfaceNotFoundException):
                 MDNSInterface(self.address)
 
+    """Test services are updated in place where zeroconf supports it"""
+    def test_update_service(self):
+        with patch('nmoscommon.mdns.mdnsInterface.Zeroconf') as zeroconf:
+            self.dut = MDNSInterface(self.address)
+            self.assertTrue(self.dut.updateService("info"))
+            zeroconf.return_value.update_service.assert_called_once_with("info")
+
+            del zeroconf.return_value.update_service
+            self.assertFalse(self.dut.updateService("info"))
+            zeroconf.return_value.unregister_service.assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()
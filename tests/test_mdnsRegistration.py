@@ -100,6 +100,23 @@ class TestMDNSRegistration(unittest.TestCase):
         actual = self.dut.interfaces[0].unregisterService.call_args
         self.assertEqual(actual[0][0], expected)
 
+    """Test a change to the TXT record alone is announced without unregistering"""
+    def test_update_txt_in_place(self):
+        with patch('nmoscommon.mdns.mdnsRegistration.ServiceInfo') as info, \
+                patch('nmoscommon.mdns.mdnsRegistration.time.sleep') as sleep:
+            self.dut.update(txtRecord={"ver_dvc": 1})
+            self.assertFalse(self.interface.unregisterService.called)
+            self.assertFalse(sleep.called)
+            self.interface.updateService.assert_called_once_with(info.return_value)
+            self.assertEqual(info.call_args[1]["properties"], {"ver_dvc": "1"})
+            self.assertEqual(self.dut.info, {"192.168.0.5": info.return_value})
+
+            self.interface.updateService.return_value = False
+            self.dut.update(txtRecord={"ver_dvc": 2})
+            self.assertTrue(self.interface.unregisterService.called)
+            self.assertTrue(self.interface.registerService.called)
+            self.assertTrue(sleep.called)
+
     def test_update_name(self):
         self.dut.update(name="main")
         self.assertEqual(self.dut.name, "main")
@@ -21,9 +21,11 @@ import unittest
 import mock
 
 from nmoscommon.webapi import *
+import nmoscommon.webapi
 
 from datetime import timedelta
 import re
+import gevent
 
 import flask
 
@@ -1179,7 +1181,8 @@ Differences:
 
             self.assertListEqual(ws.receive.mock_calls, [ mock.call(), mock.call() ])
 
-            m.assert_called_once_with(ws, { "foo" : "bar", "baz" : [ "boop", ] })
+            m.assert_called_once_with(mock.ANY, { "foo" : "bar", "baz" : [ "boop", ] })
+            self.assertIs(m.call_args[0][0].ws, ws)
 
     def test_on_json_with_on_websocket_connect(self):
         """This tests the on_json decorator which is used for websocket end-points and so has a slightly different
@@ -1217,7 +1220,8 @@ Differences:
 
             self.assertListEqual(ws.receive.mock_calls, [ mock.call(), mock.call() ])
 
-            m.assert_called_once_with(ws, { "foo" : "bar", "baz" : [ "boop", ] })
+            m.assert_called_once_with(mock.ANY, { "foo" : "bar", "baz" : [ "boop", ] })
+            self.assertIs(m.call_args[0][0].ws, ws)
             print(ws.receive.send.mock_calls)
 
     @mock.patch("nmoscommon.webapi.Flask")
@@ -1231,11 +1235,11 @@ Differences:
         app.errorhandler.side_effect = lambda n : getattr(app, 'error_handler_for_' + str(n))
         UUT = StubWebAPI()
         Flask.assert_called_once_with('nmoscommon.webapi')
-        expected_calls = [ mock.call(n) for n in range(400, 600) ]
+        expected_calls = [ mock.call(n) for n in nmoscommon.webapi.ERROR_CODES ]
         # This checks that all expected elements are in the list, but doesn't mind if the list has extra elements
         self.assertCountEqual([ call for call in app.errorhandler.mock_calls if call[0] == '' and call in expected_calls ],  expected_calls)
         f = getattr(app, 'error_handler_for_' + str(status_code)).call_args[0][0]
-        for n in range(400, 600):
+        for n in nmoscommon.webapi.ERROR_CODES:
             getattr(app, 'error_handler_for_' + str(n)).assert_called_once_with(mock.ANY)
             self.assertEqual(getattr(app, 'error_handler_for_' + str(n)).call_args[0][0].__name__, f.__name__)
 
@@ -1347,3 +1351,475 @@ Differences:
                                      msg="html output has not converted a list entry with a trailing slash into a link")
         self.assertNotRegexpMatches(html, r'<a href="\./boop/?">boop/?</a>',
                                      msg="html output contains a link for an entry that lacked a trailing slash, this is wrong")
+
+    def test_response_cache_evicts_least_recently_used(self):
+        cache = ResponseCache(maxsize=2)
+        cache.put(('/a', b'', 'application/json', None), "A")
+        cache.put(('/b', b'', 'application/json', None), "B")
+        self.assertEqual(cache.get(('/a', b'', 'application/json', None)), "A")
+        cache.put(('/c', b'', 'application/json', None), "C")
+        self.assertIsNone(cache.get(('/b', b'', 'application/json', None)))
+        self.assertEqual(cache.get(('/c', b'', 'application/json', None)), "C")
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1, "size": 2, "maxsize": 2})
+
+    def test_response_cache_invalidate(self):
+        cache = ResponseCache()
+        cache.put(('/devices/', b'', 'application/json', None), "D")
+        cache.put(('/devices/abc/', b'', 'application/json', None), "E")
+        cache.put(('/devicesx/', b'', 'application/json', None), "F")
+        cache.invalidate('/devices/')
+        self.assertIsNone(cache.get(('/devices/', b'', 'application/json', None)))
+        self.assertIsNone(cache.get(('/devices/abc/', b'', 'application/json', None)))
+        self.assertEqual(cache.get(('/devicesx/', b'', 'application/json', None)), "F")
+        cache.invalidate()
+        self.assertEqual(cache.stats()["size"], 0)
+
+    @mock.patch('nmoscommon.webapi.request', path='/self/', query_string=b'', method='GET')
+    def test_returns_json_with_cache_skips_encoding_of_unchanged_resources(self, request):
+        request.accept_mimetypes.best_match.return_value = 'application/json'
+        cache = ResponseCache()
+        data = {'foo': 'bar'}
+        etag = {'value': '"1"'}
+        f = returns_json(lambda: (200, data, {'ETag': etag['value']}), cache=cache)
+
+        first = f()
+        data['foo'] = 'baz'
+        second = f()
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        etag['value'] = '"2"'
+        third = f()
+        self.assertEqual(json.loads(third.get_data()), {'foo': 'baz'})
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    @mock.patch('nmoscommon.webapi.request', path='/self/', query_string=b'', method='GET')
+    def test_returns_json_with_cache_does_not_cache_errors(self, request):
+        request.accept_mimetypes.best_match.return_value = 'application/json'
+        cache = ResponseCache()
+        f = returns_json(lambda: (400, {'code': 400}), cache=cache)
+        f()
+        f()
+        self.assertEqual(cache.stats()["size"], 0)
+
+    @mock.patch('nmoscommon.webapi.request', path='/self/', query_string=b'', method='GET', headers={})
+    def test_returns_json_with_etag_adds_strong_etag(self, request):
+        request.accept_mimetypes.best_match.return_value = 'application/json'
+        f = returns_json(lambda: {'foo': 'bar'}, etag=True)
+
+        r = f()
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['ETag'], make_etag(json.dumps({'foo': 'bar'}, indent=4)))
+        self.assertEqual(r.headers['Cache-Control'], 'no-cache')
+
+    @mock.patch('nmoscommon.webapi.request', path='/self/', query_string=b'', method='GET')
+    def test_returns_json_with_etag_answers_if_none_match_with_304(self, request):
+        request.accept_mimetypes.best_match.return_value = 'application/json'
+        request.headers = {'If-None-Match': make_etag(json.dumps({'foo': 'bar'}, indent=4))}
+        f = returns_json(lambda: {'foo': 'bar'}, etag=True)
+
+        r = f()
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.get_data(), b'')
+
+        request.headers = {'If-None-Match': '"stale"'}
+        self.assertEqual(f().status_code, 200)
+
+    @mock.patch('nmoscommon.webapi.request', path='/self/', query_string=b'', method='GET')
+    def test_returns_json_with_etag_prefers_handler_supplied_etag(self, request):
+        request.accept_mimetypes.best_match.return_value = 'application/json'
+        request.headers = {'If-None-Match': 'W/"42", "43"'}
+        f = returns_json(lambda: (200, {'foo': 'bar'}, {'ETag': '"42"'}), etag=True)
+
+        r = f()
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.headers['ETag'], '"42"')
+
+    @mock.patch('nmoscommon.webapi.request', path='/self/', query_string=b'', method='GET', headers={})
+    def test_returns_json_without_etag_keeps_no_store(self, request):
+        request.accept_mimetypes.best_match.return_value = 'application/json'
+        r = returns_json(lambda: {'foo': 'bar'})()
+        self.assertNotIn('ETag', r.headers)
+        self.assertEqual(r.headers['Cache-Control'], 'no-cache, must-revalidate, no-store')
+
+    def test_dumps_json_compact(self):
+        data = {'id': 'abc', 'tags': {}, 'caps': {'media_types': ['video/raw']}, 'version': '1:0'}
+        compact = dumps_json(data, compact=True)
+        if not isinstance(compact, str):
+            compact = compact.decode('utf-8')
+        self.assertEqual(json.loads(compact), data)
+        self.assertNotIn('\n', compact)
+        self.assertNotIn(', ', compact)
+        self.assertEqual(dumps_json(data), json.dumps(data, indent=4))
+
+    def test_dumps_json_compact_falls_back_to_standard_encoder(self):
+        with mock.patch('nmoscommon.webapi._fast_json_dumps', side_effect=TypeError):
+            self.assertEqual(dumps_json({'foo': [1, 2]}, compact=True), '{"foo":[1,2]}')
+        with mock.patch('nmoscommon.webapi._fast_json_dumps', None):
+            self.assertEqual(dumps_json({'foo': [1, 2]}, compact=True), '{"foo":[1,2]}')
+
+    @mock.patch('nmoscommon.webapi.request')
+    def test_compact_json_requested(self, request):
+        request.accept_mimetypes = [('application/json', 1), ('*/*', 0.8)]
+        with mock.patch('nmoscommon.webapi._config', {}):
+            self.assertFalse(compact_json_requested())
+        with mock.patch('nmoscommon.webapi._config', {'compact_json': 'enabled'}):
+            self.assertTrue(compact_json_requested())
+        with mock.patch('nmoscommon.webapi._config', {'compact_json': 'auto'}):
+            self.assertTrue(compact_json_requested())
+            request.accept_mimetypes = [('text/html', 1), ('application/xhtml+xml', 1), ('*/*', 0.8)]
+            self.assertFalse(compact_json_requested())
+
+    def test_jsonify_stream_matches_jsonify(self):
+        items = [{'id': 'a', 'tags': {'foo': ['bar']}}, {'id': 'b', 'parents': []}, "c"]
+        with mock.patch('nmoscommon.webapi.stream_with_context', side_effect=lambda g: g), \
+                mock.patch('nmoscommon.webapi.compact_json_requested', return_value=False):
+            self.assertEqual(jsonify_stream(iter(items)).get_data(), jsonify(items).get_data())
+            self.assertEqual(jsonify_stream(iter([])).get_data(), b'[]')
+        with mock.patch('nmoscommon.webapi.stream_with_context', side_effect=lambda g: g), \
+                mock.patch('nmoscommon.webapi.compact_json_requested', return_value=True):
+            self.assertEqual(json.loads(jsonify_stream(iter(items)).get_data()), items)
+            self.assertEqual(jsonify_stream(iter([])).get_data(), b'[]')
+
+    @mock.patch('nmoscommon.webapi.stream_with_context', side_effect=lambda g: g)
+    @mock.patch('nmoscommon.webapi.request', method='GET', headers={})
+    def test_returns_json_streams_generators(self, request, stream_with_context):
+        request.accept_mimetypes.best_match.return_value = 'application/json'
+        consumed = []
+
+        def resources():
+            for n in range(3):
+                consumed.append(n)
+                yield {'id': n}
+
+        r = returns_json(lambda: resources())()
+        self.assertTrue(r.is_streamed)
+        self.assertEqual(consumed, [])
+        self.assertEqual(json.loads(r.get_data()), [{'id': 0}, {'id': 1}, {'id': 2}])
+        self.assertEqual(r.mimetype, 'application/json')
+
+    @mock.patch('nmoscommon.webapi.request', method='GET')
+    def test_obj_path_access_with_generator(self, request):
+        f = obj_path_access(lambda: (x for x in [{'id': 'a'}, {'id': 'b'}]))
+        self.assertTrue(is_json_stream(f(path='')))
+        self.assertEqual(f(path='1/id'), jsonify('b'))
+
+    def test_accept_string_parser(self):
+        parsed = AcceptStringParser("text/html;level=1, application/json;q=0.9, */*;q=0.1")
+        self.assertEqual([(t.type, t.subtype, t.priority, t.options) for t in parsed],
+                         [('text', 'html', 1.0, ['level=1']),
+                          ('application', 'json', 0.9, []),
+                          ('*', '*', 0.1, [])])
+
+    def test_acceptable_type(self):
+        accept = "text/html, application/*;q=0.9"
+        t = AcceptableType("application/json", accept)
+        self.assertEqual((t.type, t.subtype, t.priority, t.accept_index), ('application', '*', 0.9, 1))
+        self.assertIsNone(AcceptableType("image/png", accept))
+
+    def test_most_acceptable_type(self):
+        types = ["application/json", "text/html", "application/sdp"]
+        self.assertEqual(MostAcceptableType(types, "text/html, application/json"), "text/html")
+        self.assertEqual(MostAcceptableType(types, "application/json;q=0.5, text/html;q=0.4"), "application/json")
+        self.assertEqual(MostAcceptableType(types, "application/sdp, */*;q=0.1"), "application/sdp")
+        self.assertEqual(MostAcceptableType(types, "image/png"), "application/json")
+
+    def test_most_acceptable_type_is_memoised(self):
+        types = ["application/json", "text/html"]
+        accept = "text/html;q=0.8, application/json;q=0.9, x-memo/test"
+        MostAcceptableType(types, accept)
+        with mock.patch('nmoscommon.webapi.MediaType', side_effect=AssertionError("Accept string was parsed again")):
+            self.assertEqual(MostAcceptableType(types, accept), "application/json")
+
+    @mock.patch('nmoscommon.webapi.html_render_cache', HTMLRenderCache())
+    @mock.patch('nmoscommon.webapi.highlight', side_effect=lambda body, lexer, formatter: "<html>" + body + "</html>")
+    def test_render_html_is_cached(self, highlight):
+        self.assertEqual(render_html('["foo/"]', "title"), '<html>["foo/"]</html>')
+        self.assertEqual(render_html('["foo/"]', "title"), '<html>["foo/"]</html>')
+        self.assertEqual(highlight.call_count, 1)
+        render_html('["foo/"]', "other title")
+        render_html('["bar/"]', "title")
+        self.assertEqual(highlight.call_count, 3)
+
+        stats = nmoscommon.webapi.html_render_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["highlighted_renders"], stats["plain_renders"]),
+                         (1, 3, 3, 0))
+
+    @mock.patch('nmoscommon.webapi.html_render_cache', HTMLRenderCache())
+    @mock.patch('nmoscommon.webapi._config', {'html_highlight_limit': 10})
+    @mock.patch('nmoscommon.webapi.highlight')
+    def test_render_html_skips_highlighting_large_bodies(self, highlight):
+        html = render_html('[\n    "foo/",\n    "<b>"\n]', '<a href="http://example.com/">title</a>')
+        highlight.assert_not_called()
+        self.assertIn('<h2><a href="http://example.com/">title</a></h2>', html)
+        self.assertIn('"<a href="./foo/">foo/</a>"', html)
+        self.assertIn('"&lt;b&gt;"', html)
+        self.assertEqual(nmoscommon.webapi.html_render_cache.plain_renders, 1)
+
+    def test_get_route_table_is_computed_once_per_class(self):
+        class BaseAPI(object):
+            @route('/')
+            def root(self):
+                pass
+
+            @route('/things/')
+            def things(self):
+                pass
+
+            @property
+            def broken(self):
+                raise AssertionError("Property was evaluated during route discovery")
+
+        class DerivedAPI(BaseAPI):
+            @route('/things/')
+            def things(self):
+                pass
+
+            @resource_route('/things/<thing_id>/')
+            def thing(self, thing_id):
+                pass
+
+            def helper(self):
+                pass
+
+        (api_paths, route_attrs) = get_route_table(DerivedAPI)
+        self.assertEqual(route_attrs, ["things", "thing", "root"])
+        self.assertCountEqual(api_paths, ['/', '/things/', '/things/<thing_id>/'])
+        with mock.patch('nmoscommon.webapi._getbases', side_effect=AssertionError("Route table was rebuilt")):
+            self.assertIs(get_route_table(DerivedAPI), get_route_table(DerivedAPI))
+
+    @mock.patch('nmoscommon.webapi._config', {'fix_proxy': 'disabled'})
+    def test_add_routes_registers_subclass_instance_and_property_overrides(self):
+        class BaseAPI(WebAPI):
+            @route('/things/')
+            def things(self):
+                return ["base"]
+
+            def status(self):
+                pass
+
+        class DerivedAPI(BaseAPI):
+            def __init__(self):
+                @route('/status/')
+                def status():
+                    return ["instance"]
+                self.status = status
+                super(DerivedAPI, self).__init__()
+
+            @route('/things/')
+            def things(self):
+                return ["derived"]
+
+            @property
+            def extra(self):
+                @route('/extra/')
+                def extra():
+                    return ["property"]
+                return extra
+
+        self.assertNotIn("status", get_route_table(DerivedAPI)[1])
+        self.assertNotIn("extra", get_route_table(DerivedAPI)[1])
+        client = DerivedAPI().app.test_client()
+        for (path, body) in [('/things/', ["derived"]), ('/status/', ["instance"]), ('/extra/', ["property"])]:
+            resp = client.get(path, headers={'Accept': 'application/json'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.get_data(as_text=True)), body)
+
+    def test_ippresponse_default_headers(self):
+        r = IppResponse("POTATO")
+        self.assertEqual(r.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(r.headers['Cache-Control'], "no-cache, must-revalidate, no-store")
+        self.assertEqual(r.headers['Access-Control-Allow-Headers'],
+                         "Access-Control-Allow-Origin, Access-Control-Allow-Methods, Access-Control-Max-Age, Cache-Control")
+
+        r = IppResponse("POTATO", headers={'cache-control': "max-age=60", 'X-Foo': "bar"})
+        self.assertEqual(r.headers['Cache-Control'], "max-age=60")
+        self.assertEqual(r.headers['X-Foo'], "bar")
+        self.assertEqual(r.headers['Access-Control-Allow-Methods'], "GET, PUT, POST, HEAD, OPTIONS, DELETE")
+        self.assertEqual(set(h.strip() for h in r.headers['Access-Control-Allow-Headers'].split(',')),
+                         set(['X-Foo', 'Access-Control-Allow-Origin', 'Access-Control-Allow-Methods',
+                              'Access-Control-Max-Age', 'Cache-Control']))
+        self.assertEqual(len(r.headers.getlist('Cache-Control')), 1)
+
+    def test_route_metrics_records_requests(self):
+        metrics = RouteMetrics(buckets=(0.1, 1.0))
+
+        def ok():
+            return IppResponse("POTATO", status=201)
+
+        def not_found():
+            abort(404)
+
+        def fails():
+            raise ValueError
+
+        with mock.patch('nmoscommon.webapi.time.time', side_effect=[0.0, 0.05, 1.0, 1.5, 2.0, 4.0]):
+            self.assertEqual(metrics.instrument("ok", ok)().status_code, 201)
+            self.assertRaises(HTTPException, metrics.instrument("not_found", not_found))
+            self.assertRaises(ValueError, metrics.instrument("fails", fails))
+
+        self.assertEqual(metrics.stats("ok"), {"requests": 1, "statuses": {201: 1}, "latency_buckets": [1, 0, 0],
+                                               "latency_sum": 0.05, "response_bytes": 6})
+        self.assertEqual(metrics.stats("not_found")["statuses"], {404: 1})
+        self.assertEqual(metrics.stats("not_found")["latency_buckets"], [0, 1, 0])
+        self.assertEqual(metrics.stats("fails")["statuses"], {500: 1})
+        self.assertEqual(metrics.stats("fails")["latency_buckets"], [0, 0, 1])
+
+        metrics.reset()
+        self.assertEqual(metrics.stats("ok")["requests"], 0)
+
+    def test_route_metrics_prometheus(self):
+        metrics = RouteMetrics(buckets=(0.1, 1.0))
+        with mock.patch('nmoscommon.webapi.time.time', side_effect=[0.0, 0.5]):
+            metrics.instrument('_x-nmos_"node"', lambda: IppResponse("POTATO"))()
+
+        self.assertEqual(metrics.prometheus().split('\n'), [
+            '# HELP nmos_http_requests_total Requests handled, by endpoint and status code.',
+            '# TYPE nmos_http_requests_total counter',
+            'nmos_http_requests_total{endpoint="_x-nmos_\\"node\\"",status="200"} 1',
+            '# HELP nmos_http_request_duration_seconds Time taken to handle requests.',
+            '# TYPE nmos_http_request_duration_seconds histogram',
+            'nmos_http_request_duration_seconds_bucket{endpoint="_x-nmos_\\"node\\"",le="0.1"} 0',
+            'nmos_http_request_duration_seconds_bucket{endpoint="_x-nmos_\\"node\\"",le="1.0"} 1',
+            'nmos_http_request_duration_seconds_bucket{endpoint="_x-nmos_\\"node\\"",le="+Inf"} 1',
+            'nmos_http_request_duration_seconds_sum{endpoint="_x-nmos_\\"node\\""} 0.5',
+            'nmos_http_request_duration_seconds_count{endpoint="_x-nmos_\\"node\\""} 1',
+            '# HELP nmos_http_response_bytes_total Bytes sent in response bodies of known length.',
+            '# TYPE nmos_http_response_bytes_total counter',
+            'nmos_http_response_bytes_total{endpoint="_x-nmos_\\"node\\""} 6',
+            ''])
+
+    @mock.patch('nmoscommon.webapi._config', {'metrics_route': 'enabled', 'fix_proxy': 'disabled'})
+    def test_webapi_records_metrics_and_serves_them(self):
+        class MetricsAPI(WebAPI):
+            @route('/things/')
+            def things(self):
+                return ["foo/", "bar/"]
+
+        UUT = MetricsAPI()
+        client = UUT.app.test_client()
+        self.assertEqual(client.get('/things/', headers={'Accept': 'application/json'}).status_code, 200)
+        self.assertEqual(client.get('/things/', headers={'Accept': 'application/json'}).status_code, 200)
+
+        stats = UUT.metrics.stats("_things")
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["statuses"], {200: 2})
+        self.assertEqual(stats["response_bytes"], 2 * len(json.dumps(["foo/", "bar/"], indent=4)))
+
+        resp = client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn(b'nmos_http_requests_total{endpoint="_things",status="200"} 2', resp.get_data())
+
+    def test_websocket_connection_sends_queued_messages(self):
+        ws = mock.MagicMock(name="ws")
+        conn = WebSocketConnection(ws, queue_size=2)
+        self.assertTrue(conn.send("foo"))
+        self.assertTrue(conn.send("bar"))
+        self.assertEqual(conn.queued(), 2)
+        ws.send.assert_not_called()
+
+        gevent.sleep(0)
+        self.assertListEqual(ws.send.mock_calls, [mock.call("foo"), mock.call("bar")])
+        self.assertEqual(conn.queued(), 0)
+        self.assertEqual(conn.receive, ws.receive)
+        conn.stop()
+
+    def test_websocket_connection_disconnects_slow_consumer(self):
+        ws = mock.MagicMock(name="ws")
+        conn = WebSocketConnection(ws, queue_size=1)
+        self.assertTrue(conn.send("foo"))
+        self.assertFalse(conn.send("bar"))
+        self.assertEqual(conn.dropped, 1)
+        ws.close.assert_called_once_with()
+        self.assertFalse(conn.send("baz"))
+        gevent.sleep(0)
+        ws.send.assert_not_called()
+
+    def test_websocket_connection_drops_messages_for_slow_consumer(self):
+        ws = mock.MagicMock(name="ws")
+        conn = WebSocketConnection(ws, queue_size=1, slow_consumer="drop")
+        self.assertTrue(conn.send("foo"))
+        self.assertFalse(conn.send("bar"))
+        self.assertEqual(conn.dropped, 1)
+        ws.close.assert_not_called()
+        gevent.sleep(0)
+        self.assertTrue(conn.send("baz"))
+        gevent.sleep(0)
+        self.assertListEqual(ws.send.mock_calls, [mock.call("foo"), mock.call("baz")])
+        conn.stop()
+
+    @mock.patch("nmoscommon.webapi.Flask")
+    @mock.patch("nmoscommon.webapi.Sockets")
+    def test_broadcast_encodes_once(self, Sockets, Flask):
+        UUT = WebAPI()
+        conns = [WebSocketConnection(mock.MagicMock(name="ws")) for _ in range(3)]
+        for n, conn in enumerate(conns):
+            UUT.socks[n] = conn
+        raw = mock.MagicMock(name="raw_ws")
+        UUT.socks["raw"] = raw
+
+        with mock.patch("nmoscommon.webapi.json.dumps", wraps=json.dumps) as dumps:
+            self.assertEqual(UUT.broadcast({"foo": "bar"}), 4)
+            self.assertEqual(dumps.call_count, 1)
+        gevent.sleep(0)
+        for conn in conns:
+            conn.ws.send.assert_called_once_with('{"foo": "bar"}')
+            conn.stop()
+        raw.send.assert_called_once_with('{"foo": "bar"}')
+
+    @mock.patch('nmoscommon.webapi._config', {'websocket_send_queue': 1, 'fix_proxy': 'disabled'})
+    def test_on_json_handler_replies_go_through_send_queue(self):
+        sent = []
+
+        def handler(ws, msg):
+            sent.append(ws.send(json.dumps(msg)))
+
+        m = mock.MagicMock(name="webapi", side_effect=handler)
+        (f, UUT, calls) = self.initialise_webapi_with_method_using_decorator(m, on_json('/'), is_socket=True)
+
+        ws = mock.MagicMock(name="ws")
+        ws.receive.side_effect = [json.dumps({"n": 0}), json.dumps({"n": 1}), None]
+        f(ws)
+
+        # The second reply finds the queue full, so the slow consumer is disconnected and only the first is sent
+        self.assertEqual(sent, [True, False])
+        self.assertListEqual(ws.send.mock_calls, [mock.call(json.dumps({"n": 0}))])
+        ws.close.assert_called_once_with()
+
+    def test_on_json_handles_each_websockets_messages_in_order(self):
+        events = []
+
+        def handler(ws, msg):
+            events.append(("start", msg["ws"], msg["n"]))
+            gevent.sleep(0.01 if msg["n"] == 0 else 0)
+            events.append(("end", msg["ws"], msg["n"]))
+
+        m = mock.MagicMock(name="webapi", side_effect=handler)
+        (f, UUT, calls) = self.initialise_webapi_with_method_using_decorator(m, on_json('/'), is_socket=True)
+
+        sockets = []
+        for n in range(2):
+            ws = mock.MagicMock(name="ws{}".format(n))
+            ws.receive.side_effect = [json.dumps({"ws": n, "n": 0}), json.dumps({"ws": n, "n": 1}), None]
+            sockets.append(gevent.spawn(f, ws))
+        gevent.joinall(sockets, timeout=5)
+
+        self.assertEqual(m.call_count, 4)
+        for n in range(2):
+            self.assertEqual([event for event in events if event[1] == n],
+                             [("start", n, 0), ("end", n, 0), ("start", n, 1), ("end", n, 1)])
+        # The websockets are handled at the same time
+        self.assertLess(events.index(("start", 1, 0)), events.index(("end", 0, 0)))
+        self.assertEqual(UUT.socks, {})
+
+    def test_on_json_handler_error_closes_websocket(self):
+        m = mock.MagicMock(name="webapi", side_effect=ValueError)
+        (f, UUT, calls) = self.initialise_webapi_with_method_using_decorator(m, on_json('/'), is_socket=True)
+
+        ws = mock.MagicMock(name="ws")
+        ws.receive.side_effect = [json.dumps({"n": 0}), None]
+        f(ws)
+
+        ws.close.assert_called_once_with()
+        self.assertEqual(UUT.socks, {})